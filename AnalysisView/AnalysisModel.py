@@ -11,6 +11,7 @@ class AnalysisModel:
         self.group_names = []
         self.append_cluster_labels = False
         self.num_clusters = 11
+        self.cluster_method = "default"
         self.cluster_labels = []
         self.cluster_events = None
         self.selected_clusters = []
@@ -72,6 +73,9 @@ class AnalysisModel:
             self.reference_process_ref_id = None
             self.reference_count = None
             self.process_filter = None
+            self.correlation_table = None
+            self.regression_table = None
+            self.residuals_table = None
 
         def reset(self):
             self.__init__()
@@ -21,11 +21,18 @@ from src.SourceCode import (
     generate_source_code_table,
     generate_empty_table,
     generate_source_code_info,
+    generate_source_code_rows,
 )
 import src.GlobalData as GlobalData
 from src.FlameGraphUtils import FlameGraph
 from src.StackData import write_flamegraph_stacks
 from src.DataAnalysis import GeneralAnalysis
+from src.ClusterMethods import cluster_methods
+from src.EventCorrelation import (
+    generate_correlation_table,
+    generate_regression_table,
+    generate_residuals_table,
+)
 from src.CustomEvents import event_to_raw_event, raw_event_to_event
 from AnalysisView.AnalysisModel import AnalysisModel
 
@@ -179,7 +186,8 @@ def general_analysis():
         analysis_model=analysis_model,
         enabled_modes=GlobalData.enabled_modes,
         ids=ids,
-        colours=colours
+        colours=colours,
+        cluster_methods=cluster_methods,
     )
 
 
@@ -323,6 +331,8 @@ def update_cluster_parameters():
     analysis_data = all_analysis_data[analysis_type]
     num_clusters = data["num_clusters"]
     analysis_model.num_clusters = num_clusters
+    if "cluster_method" in data:
+        analysis_model.cluster_method = data["cluster_method"]
     event1 = analysis_model.event1
     event2 = analysis_model.event2
     centred = analysis_model.centred_scatter_plot == "centred"
@@ -635,6 +645,21 @@ def update_all_charts():
     return jsonify(analysis_model.layout.to_dict())
 
 
+@AnalysisView.route("/update_correlation_analysis", methods=["GET", "POST"])
+def update_correlation_analysis():
+    global analysis_model
+    analysis_type = analysis_model.analysis_type
+    analysis_data = all_analysis_data[analysis_type]
+    (
+        analysis_model.layout.correlation_table,
+        analysis_model.layout.regression_table,
+        analysis_model.layout.residuals_table,
+    ) = get_correlation_tables(
+        analysis_data, analysis_model.event1, analysis_model.event2
+    )
+    return jsonify(analysis_model.layout.to_dict())
+
+
 @AnalysisView.route("/update_flamegraph_ids", methods=["GET", "POST"])
 def update_flamegraph_ids():
     global svgchart
@@ -689,6 +714,17 @@ def update_source_code():
     return jsonify(analysis_model.layout.to_dict())
 
 
+@AnalysisView.route("/update_source_lines", methods=["GET", "POST"])
+def update_source_lines():
+    data = request.get_json()
+    source_symbol = data["source_symbol"]
+    label = data["id"]
+    rows, start, stop = get_source_lines(
+        source_symbol, label, int(data["start"]), int(data["stop"])
+    )
+    return jsonify({"rows": rows, "start": start, "stop": stop})
+
+
 @AnalysisView.route("/update_flamegraph_mode", methods=["GET", "POST"])
 def update_flamegraph_mode():
     global analysis_model
@@ -750,6 +786,26 @@ def get_source_code(symbol, label, get_source_table=True):
     return source_code_table, source_code_info, source_code_line
 
 
+def get_source_lines(symbol, label, start, stop):
+    job_id = get_job(label)
+    if re.match(".*\[\[cluster", symbol):
+        symbol = symbol.rpartition("[[cluster")[0]
+    for i in range(len(GlobalData.hpc_results)):
+        if job_id == GlobalData.hpc_results[i].get_job_id():
+            process_id = all_stack_data[
+                analysis_model.reference_process
+            ].get_process_id_from_label(label)
+            return generate_source_code_rows(
+                all_stack_data[analysis_model.reference_process],
+                process_id,
+                symbol,
+                GlobalData.hpc_results[i],
+                start,
+                stop,
+            )
+    return "", start, start - 1
+
+
 def get_barchart(process_list, hotspots, svg_chart):
     # Setup Bar Chart
     barchart_filename = timestamp("barchart.svg")
@@ -801,7 +857,7 @@ def get_analysis(analysis_type):
     # determine type of analysis, and create on first use
     new_analysis = analysis_type not in all_analysis_data
     if new_analysis:
-        analysis_data = GeneralAnalysis()
+        analysis_data = GeneralAnalysis(n_proc=GlobalData.n_proc)
         all_analysis_data["general"] = analysis_data
     else:
         analysis_data = all_analysis_data["general"]
@@ -849,7 +905,15 @@ def run_analysis(
     raw_event2 = event_to_raw_event(event2, GlobalData.loaded_cpu_definition)
     analysis_data.make_data(reference_process, centred=centred, log_scale=log_scale)
     analysis_data.group_data(
-        num_clusters, raw_event1, raw_event2, xlower, xupper, ylower, yupper, group_by_log10=log_scale
+        num_clusters,
+        raw_event1,
+        raw_event2,
+        xlower,
+        xupper,
+        ylower,
+        yupper,
+        group_by_log10=log_scale,
+        method=analysis_model.cluster_method,
     )
     n = analysis_data.get_num_clusters()
     analysis_model.clusters = [str(i) for i in range(0, n)]
@@ -1003,3 +1067,22 @@ def get_hotspot_scatter_plot(
     svgfile = GlobalData.local_data + os.sep + scatter_plot_filename
     svgfile = os.path.relpath(svgfile, AnalysisView.template_folder)
     return svgfile
+
+
+def get_correlation_tables(analysis_data, event1, event2):
+    raw_event1 = event_to_raw_event(event1, GlobalData.loaded_cpu_definition)
+    raw_event2 = event_to_raw_event(event2, GlobalData.loaded_cpu_definition)
+    events, correlations, fits, residuals = analysis_data.get_correlation_analysis(
+        raw_event1, raw_event2
+    )
+    event_names = [
+        " / ".join(
+            raw_event_to_event(e, GlobalData.loaded_cpu_definition)
+            for e in event.split("-divide-")
+        )
+        for event in events
+    ]
+    correlation_table = generate_correlation_table(event_names, correlations)
+    regression_table = generate_regression_table(fits)
+    residuals_table = generate_residuals_table(residuals, event2, event1)
+    return correlation_table, regression_table, residuals_table
@@ -24,8 +24,7 @@ def add_custom_event():
     status = ""
     layout["Results"] = GlobalData.results_files
     if "event_ratio_btn" in request.form:
-        # Force read of modified data
-        reset_event_view()
+        # Event view data is unchanged by a custom event, which is evaluated when loaded
         reset_process_view()
         reset_analysis_view()
         event1 = request.form["event1"]
@@ -35,8 +34,7 @@ def add_custom_event():
         status = "Added " + custom_event_ratio
         return redirect(url_for("EventView.event_view", event=custom_event_ratio))
     elif "event_sum_btn" in request.form:
-        # Force read of modified data
-        reset_event_view()
+        # Event view data is unchanged by a custom event, which is evaluated when loaded
         reset_process_view()
         reset_analysis_view()
         event1 = request.form["event3"]
@@ -57,6 +55,7 @@ def add_custom_event():
                 GlobalData.results_files,
                 output_job_totals=False,
                 output_process_totals=True,
+                n_proc=GlobalData.n_proc,
             )
             return redirect(url_for("EventView.event_view", event="Cycles"))
         elif event1 == "Job-Cumulative-Counts":
@@ -65,6 +64,7 @@ def add_custom_event():
                 GlobalData.results_files,
                 output_job_totals=True,
                 output_process_totals=False,
+                n_proc=GlobalData.n_proc,
             )
             return redirect(url_for("EventView.event_view", event="Cycles"))
         else:
@@ -14,6 +14,7 @@ from src.SourceCode import (
     generate_source_code_table,
     generate_empty_table,
     generate_source_code_info,
+    generate_source_code_rows,
 )
 
 
@@ -275,6 +276,17 @@ def update_source_code():
     return jsonify(event_model.layout.to_dict())
 
 
+@EventView.route("/update_source_lines", methods=["GET", "POST"])
+def update_source_lines():
+    data = request.get_json()
+    source_symbol = data["source_symbol"]
+    label = data["id"]
+    rows, start, stop = get_source_lines(
+        source_symbol, label, int(data["start"]), int(data["stop"])
+    )
+    return jsonify({"rows": rows, "start": start, "stop": stop})
+
+
 @EventView.route("/update_flamegraph_mode", methods=["GET", "POST"])
 def update_flamegraph_mode():
     global event_model
@@ -383,6 +395,24 @@ def get_source_code(symbol, label, get_source_table=True):
     return source_code_table, source_code_info, source_code_line
 
 
+def get_source_lines(symbol, label, start, stop):
+    job_id = get_job(label)
+    for i in range(len(GlobalData.hpc_results)):
+        if job_id == GlobalData.hpc_results[i].get_job_id():
+            process_id = all_stack_data[event_model.event].get_process_id_from_label(
+                label
+            )
+            return generate_source_code_rows(
+                all_stack_data[event_model.event],
+                process_id,
+                symbol,
+                GlobalData.hpc_results[i],
+                start,
+                stop,
+            )
+    return "", start, start - 1
+
+
 def get_barchart(event, hotspots, diff, svg_chart):
     # Setup Bar Chart
     barchart_filename = timestamp("barchart.svg")
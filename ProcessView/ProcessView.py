@@ -13,6 +13,7 @@ from src.SourceCode import (
     generate_source_code_table,
     generate_empty_table,
     generate_source_code_info,
+    generate_source_code_rows,
 )
 
 all_stack_data = {}
@@ -244,6 +245,17 @@ def update_source_code():
     return jsonify(process_model.layout.to_dict())
 
 
+@ProcessView.route("/update_source_lines", methods=["GET", "POST"])
+def update_source_lines():
+    data = request.get_json()
+    source_symbol = data["source_symbol"]
+    label = data["id"]
+    rows, start, stop = get_source_lines(
+        source_symbol, label, int(data["start"]), int(data["stop"])
+    )
+    return jsonify({"rows": rows, "start": start, "stop": stop})
+
+
 def update_process_model(process):
     global process_model
     process_model.text_filter = ""
@@ -310,6 +322,24 @@ def get_source_code(symbol, label, get_source_table=True):
     return source_code_table, source_code_info, source_code_line
 
 
+def get_source_lines(symbol, label, start, stop):
+    job_id = get_job(label)
+    for i in range(len(GlobalData.hpc_results)):
+        if job_id == GlobalData.hpc_results[i].get_job_id():
+            process_id = all_stack_data[
+                process_model.process
+            ].get_process_id_from_label(label)
+            return generate_source_code_rows(
+                all_stack_data[process_model.process],
+                process_id,
+                symbol,
+                GlobalData.hpc_results[i],
+                start,
+                stop,
+            )
+    return "", start, start - 1
+
+
 def get_barchart(process, hotspots, svg_chart):
     # Setup Bar Charts
     event_totals_chart_title = "Total Event Counts for {}: Reference = {}".format(
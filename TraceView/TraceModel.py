@@ -9,6 +9,7 @@ class TraceModel:
         self.job = ""
         self.selected_ids = []
         self.flamegraph_type = "cumulative"
+        self.call_statistics_sort_key = "total"
         self.process_names = []
         self.jobs = []
         self.system_wide = False
@@ -23,6 +24,7 @@ class TraceModel:
             self.results = None
             self.flamegraph = None
             self.timeline = None
+            self.call_statistics_table = None
             self.title = None
             self.footer = None
             self.process_filter = None
@@ -11,6 +11,7 @@ import src.GlobalData as GlobalData
 from src.FlameGraphUtils import FlameGraph
 from src.TimeLines import TimeLines
 from src.TraceData import write_flamegraph_stacks, get_timeline_data
+from src.CallStatistics import sort_call_statistics, generate_call_statistics_table
 from TraceView.TraceModel import TraceModel
 
 all_stack_data = {}
@@ -221,6 +222,19 @@ def find_function():
     return jsonify(trace_model.layout.to_dict())
 
 
+@TraceView.route("/update_call_statistics", methods=["GET", "POST"])
+def update_call_statistics():
+    global trace_model
+    data = request.get_json()
+    job = trace_model.job
+    if "sort_key" in data:
+        trace_model.call_statistics_sort_key = data["sort_key"]
+    trace_model.layout.call_statistics_table = get_call_statistics_table(
+        job, trace_model.start, trace_model.stop
+    )
+    return jsonify(trace_model.layout.to_dict())
+
+
 def update_trace_model(job):
     global trace_model
     trace_model.selected_ids = all_stack_data[job].get_selected_process_ids()
@@ -284,3 +298,13 @@ def get_timelines(job, start, stop):
     svgfile = GlobalData.local_data + os.sep + timelines_filename
     svgfile = os.path.relpath(svgfile, TraceView.template_folder)
     return svgfile
+
+
+def get_call_statistics_table(job, start, stop):
+    statistics = all_stack_data[job].get_call_statistics(start, stop)
+    sort_key = trace_model.call_statistics_sort_key
+    statistics = sort_call_statistics(
+        statistics, sort_key=sort_key, descending=(sort_key != "function")
+    )
+    unit = "&#x03BC;s"  # xml unicode: micro-seconds
+    return generate_call_statistics_table(statistics, unit, sort_key=sort_key)
@@ -522,6 +522,10 @@ class Config(CommonConfig):
     pretty_print = Key(
         False, bool, "Misc", "Pretty print the svg")
 
+    tooltips = Key(
+        True, bool, "Misc", "Add the tooltip data and scripts",
+        "Disable for smaller and faster charts with many values")
+
     strict = Key(
         False, bool, "Misc",
         "If True don't try to adapt / filter wrong values")
@@ -68,11 +68,17 @@ class BaseGraph(object):
 
     def __getattribute__(self, name):
         """Get an attribute from the class or from the state if there is one"""
-        if name.startswith('__') or name == 'state' or getattr(
-                self, 'state', None
-        ) is None or name not in self.state.__dict__:
-            return super(BaseGraph, self).__getattribute__(name)
-        return getattr(self.state, name)
+        get = super(BaseGraph, self).__getattribute__
+        if name.startswith('__') or name == 'state':
+            return get(name)
+        # Looked up directly, as this is called for every config value
+        state = get('__dict__').get('state')
+        if state is None:
+            return get(name)
+        values = state.__dict__
+        if name in values:
+            return values[name]
+        return get(name)
 
     def prepare_values(self, raw, offset=0):
         """Prepare the values to start with sane values"""
@@ -475,6 +475,8 @@ class Graph(PublicApi):
 
     def _tooltip_data(self, node, value, x, y, classes=None, xlabel=None):
         """Insert in desc tags informations for the javascript tooltip"""
+        if not self.tooltips:
+            return
         self.svg.node(node, 'desc', class_="value").text = value
         if classes is None:
             classes = []
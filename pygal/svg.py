@@ -24,6 +24,7 @@ from pygal.etree import etree
 import io
 import os
 import json
+from collections import OrderedDict
 from datetime import date, datetime
 from numbers import Number
 from math import pi
@@ -34,6 +35,11 @@ from pygal import __version__
 
 nearly_2pi = 2 * pi - .00001
 
+# Templated css, shared by all the charts with the same style
+css_cache = OrderedDict()
+max_cached_css = 64
+css_cache_id = '#chart-00000000-0000-0000-0000-000000000000 '
+
 
 class Svg(object):
 
@@ -87,8 +93,6 @@ class Svg(object):
 
     def add_styles(self):
         """Add the css to the svg"""
-        colors = self.graph.style.get_colors(self.id, self.graph._order)
-        strokes = self.get_strokes()
         all_css = []
         auto_css = ['file://base.css']
 
@@ -102,22 +106,12 @@ class Svg(object):
             css_text = None
             if css.startswith('inline:'):
                 css_text = css[len('inline:'):]
+                if not self.graph.pretty_print:
+                    css_text = minify_css(css_text)
             elif css.startswith('file://'):
-                if not os.path.exists(css):
-                    css = os.path.join(
-                        os.path.dirname(__file__), 'css', css[len('file://'):])
-
-                with io.open(css, encoding='utf-8') as f:
-                    css_text = template(
-                        f.read(),
-                        style=self.graph.style,
-                        colors=colors,
-                        strokes=strokes,
-                        id=self.id)
+                css_text = self.get_css_file(css)
 
             if css_text is not None:
-                if not self.graph.pretty_print:
-                    css_text = minify_css(css_text)
                 all_css.append(css_text)
             else:
                 if css.startswith('//') and self.graph.force_uri_protocol:
@@ -128,6 +122,36 @@ class Svg(object):
         self.node(
             self.defs, 'style', type='text/css').text = '\n'.join(all_css)
 
+    def get_css_file(self, css):
+        """Return the templated css file. It is cached with a placeholder
+        for the chart id, so it is only templated once per style"""
+        prefix = css_cache_id if self.id else ''
+        key = (css, self.graph.pretty_print, self.graph._order,
+               repr(sorted(self.graph.style.to_dict().items())),
+               self.get_strokes(prefix))
+        if key in css_cache:
+            css_cache.move_to_end(key)
+        else:
+            path = css
+            if not os.path.exists(path):
+                path = os.path.join(
+                    os.path.dirname(__file__), 'css', css[len('file://'):])
+
+            with io.open(path, encoding='utf-8') as f:
+                css_text = template(
+                    f.read(),
+                    style=self.graph.style,
+                    colors=self.graph.style.get_colors(
+                        prefix, self.graph._order),
+                    strokes=key[-1],
+                    id=prefix)
+            if not self.graph.pretty_print:
+                css_text = minify_css(css_text)
+            css_cache[key] = css_text
+            if len(css_cache) > max_cached_css:
+                css_cache.popitem(last=False)
+        return css_cache[key].replace(css_cache_id, self.id)
+
     def add_scripts(self):
         """Add the js to the svg"""
         common_script = self.node(self.defs, 'script', type='text/javascript')
@@ -422,7 +446,8 @@ class Svg(object):
     def pre_render(self):
         """Last things to do before rendering"""
         self.add_styles()
-        self.add_scripts()
+        if self.graph.tooltips:
+            self.add_scripts()
         self.root.set(
             'viewBox', '0 0 %d %d' % (self.graph.width, self.graph.height))
         if self.graph.explicit_size:
@@ -466,12 +491,15 @@ class Svg(object):
             svg = svg.decode('utf-8')
         return svg
 
-    def get_strokes(self):
+    def get_strokes(self, prefix=None):
         """Return a css snippet containing all stroke style options"""
+        if prefix is None:
+            prefix = self.id
+
         def stroke_dict_to_css(stroke, i=None):
             """Return a css style for the given option"""
             css = ['%s.series%s {\n' % (
-                self.id, '.serie-%d' % i if i is not None else '')]
+                prefix, '.serie-%d' % i if i is not None else '')]
             for key in (
                     'width', 'linejoin', 'linecap',
                     'dasharray', 'dashoffset'):
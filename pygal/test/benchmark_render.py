@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+# This file is part of pygal
+#
+# A python svg graph plotting library
+# Copyright © 2012-2016 Kozea
+#
+# This library is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# This library is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with pygal. If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Render time and size of large charts, with and without tooltips.
+
+Run with: python -m pygal.test.benchmark_render
+"""
+
+from __future__ import print_function
+
+import time
+
+from pygal import HorizontalStackedBar, StackedBar, XY
+from pygal.test.test_render_options import make_chart
+
+modes = [
+    ('tooltips', {}),
+    ('no tooltips', {'tooltips': False}),
+]
+
+
+def benchmark(Chart, n, kwargs, repeat=3):
+    """Best render time of the chart, and the svg"""
+    best = None
+    for _ in range(repeat):
+        chart = make_chart(Chart, n, **kwargs)
+        start = time.time()
+        svg = chart.render(is_unicode=True)
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best, svg
+
+
+def main():
+    print('%-20s %6s %-12s %8s %10s' % (
+        'Chart', 'Values', 'Mode', 'Time (s)', 'Size (kB)'))
+    for Chart in (StackedBar, HorizontalStackedBar, XY):
+        for n in (100, 500, 2000):
+            for name, kwargs in modes:
+                elapsed, svg = benchmark(Chart, n, kwargs)
+                print('%-20s %6d %-12s %8.3f %10d' % (
+                    Chart.__name__, 5 * n, name, elapsed, len(svg) // 1024))
+
+
+if __name__ == '__main__':
+    main()
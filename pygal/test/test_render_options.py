@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+# This file is part of pygal
+#
+# A python svg graph plotting library
+# Copyright © 2012-2016 Kozea
+#
+# This library is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# This library is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with pygal. If not, see <http://www.gnu.org/licenses/>.
+
+"""Tooltips option and css cache tests"""
+
+import re
+
+from pygal import Bar, StackedBar, XY
+from pygal import svg
+
+
+def make_chart(Chart, n=20, **kwargs):
+    """Make a chart with labelled values"""
+    chart = Chart(title='Fast & "render"', x_label_rotation=25, **kwargs)
+    for s in range(5):
+        if Chart is XY:
+            values = [(i, (i * 7 + s) % 13) for i in range(n)]
+        else:
+            values = [{'value': (i * 7 + s) % 13 + .5,
+                       'label': 'p%d: <f%d>' % (i, s)} for i in range(n)]
+        chart.add('f%d' % s, values)
+    chart.x_labels = ['p%d' % i for i in range(n)]
+    return chart
+
+
+def get_css(chart):
+    """The css of a rendered chart"""
+    return re.search('<style type="text/css">(.*?)</style>',
+                     chart.render(is_unicode=True), re.DOTALL).group(1)
+
+
+def test_no_tooltips():
+    """Test tooltip data and scripts are not written without tooltips"""
+    chart = make_chart(StackedBar, tooltips=False)
+    svg = chart.render(is_unicode=True)
+    assert '<desc' not in svg
+    assert '<script' not in svg
+    assert svg.count('<rect') == len(
+        make_chart(StackedBar).render(is_unicode=True).split('<rect')) - 1
+
+
+def test_css_shared_across_charts():
+    """Test the css is the same, up to the chart id, for the same style"""
+    charts = [make_chart(Bar) for _ in range(2)]
+    styles = [get_css(chart) for chart in charts]
+    assert charts[0].uuid in styles[0]
+    assert styles[0].replace(charts[0].uuid, 'chart') == (
+        styles[1].replace(charts[1].uuid, 'chart'))
+
+
+def test_css_cache_same_css():
+    """Test the cached css is the same as the css templated for the chart"""
+    chart = make_chart(Bar)
+    svg.css_cache.clear()
+    css = get_css(chart)
+    assert get_css(chart) == css
@@ -229,7 +229,7 @@ def decorate(svg, node, metadata):
     if 'style' in metadata:
         node.attrib['style'] = metadata.pop('style')
 
-    if 'label' in metadata:
+    if 'label' in metadata and svg.graph.tooltips:
         svg.node(node, 'desc', class_='label').text = to_unicode(
             metadata['label'])
     return node
@@ -21,7 +21,7 @@ from src.ResultsHandler import (
     get_run_summary,
     get_trace_jobs,
 )
-from src.Utilities import purge, get_datetime, get_datetime_diff, format_number
+from src.Utilities import purge, get_datetime, format_number
 from src.Utilities import format_percentage as utils_format_percentage
 from src.Utilities import replace_operators as utils_replace_operators
 from src.Utilities import abs_path_to_rel_path as utils_abs_path_to_rel_path
@@ -35,6 +35,7 @@ from src.PerfEvents import (
     reset_enabled_modes,
 )
 from src.JobHandler import JobHandler, Job
+from src.JobQueue import JobQueue, get_job_duration
 from TraceView.TraceView import TraceView, reset_trace_view
 from EventView.EventView import EventView, reset_event_view
 from CustomEventsView.CustomEventsView import CustomEventsView
@@ -95,7 +96,6 @@ def utility_function():
 
 
 log_stream = StringIO()
-submitted_jobs = []
 main_logger = None
 logfile = ""
 layout = {"Results": ["None"]}
@@ -140,6 +140,35 @@ def initialise_app():
     GlobalData.job_settings = initialise_default_job_settings(
         cpu, GlobalData.loaded_cpu_definition
     )
+    if GlobalData.job_queue is None:
+        GlobalData.job_queue = JobQueue(
+            GlobalData.local_data,
+            max_jobs=GlobalData.max_jobs,
+            max_jobs_per_host=GlobalData.max_jobs_per_host,
+        )
+        GlobalData.job_queue.add_listener(log_job_state)
+
+
+def log_job_state(job_id, job):
+    """Log each change of state of a queued job"""
+    time_now = get_datetime()
+    if job["state"] == "done":
+        main_logger.info(
+            u"Job "
+            + job_id
+            + " has finished at "
+            + time_now.strftime("%Y-%m-%d %H:%M:%S")
+            + " ("
+            + get_job_duration(job, time_now)
+            + ")"
+        )
+        main_logger.info(
+            u"Load perf profile " + GlobalData.local_data + os.sep + job_id + ".results"
+        )
+    elif job["state"] == "failed":
+        main_logger.info(u"Job " + job_id + " has failed: " + job["error"])
+    else:
+        main_logger.info(u"Job " + job_id + " is " + job["state"])
 
 
 def allowed_file(filename):
@@ -169,7 +198,6 @@ def index():
     global layout
     global main_logger
     global logfile
-    global submitted_jobs
     global initialise
     if request.method == "POST":
         # Load requested results - just check which events can be found in requested results files at this point
@@ -407,7 +435,9 @@ def index():
                 GlobalData.selected_cpu_definition.get_active_raw_events(),
             )
 
-            jobhandler = JobHandler(GlobalData.root_directory, job)
+            jobhandler = JobHandler(
+                GlobalData.root_directory, job, GlobalData.job_queue
+            )
 
             report_error = False
             if GlobalData.job_settings.use_ssh:
@@ -475,14 +505,6 @@ def index():
                 + " submitted at "
                 + start_time.strftime("%Y-%m-%d %H:%M:%S")
             )
-            submitted_jobs.append(
-                {
-                    "job_name": GlobalData.job_settings.job_name,
-                    "job_status": "running",
-                    "start_time": start_time,
-                }
-            )
-            main_logger.info(u"Job " + GlobalData.job_settings.job_name + " is running")
 
     # Display
     if initialise:
@@ -563,46 +585,38 @@ def run_summary():
 
 @app.route("/check_for_results", methods=["GET", "POST"])
 def check_for_results():
-    # Poll for finished job - check for existence of 'job'.done file
-    global submitted_jobs
-    global main_logger
+    # Poll for the log, and the state of unfinished jobs. Finished jobs are logged
+    # when they finish, by log_job_state
     global log_stream
-    job_durations = {}
-    for job in submitted_jobs:
-        job_name = job["job_name"]
-        if job["job_status"] == "running":
-            start_time = job["start_time"]
-            time_now = get_datetime()
-            duration = get_datetime_diff(time_now, start_time)
-            filename = GlobalData.local_data + os.sep + job["job_name"] + ".done"
-            if os.path.isfile(filename):
-                main_logger.info(
-                    u"Job "
-                    + job["job_name"]
-                    + " has finished at "
-                    + time_now.strftime("%Y-%m-%d %H:%M:%S")
-                    + " ("
-                    + str(duration)
-                    + ")"
-                )
-                main_logger.info(
-                    u"Load perf profile "
-                    + GlobalData.local_data
-                    + os.sep
-                    + job["job_name"]
-                    + ".results"
-                )
-                job["job_status"] = "finished"
-            else:
-                job_durations[job_name] = str(duration)
     job_run_info = []
-    if len(job_durations) > 0:
-        job_run_info.append("Running Jobs:")
-        for job_name in job_durations:
-            job_run_info.append(job_name + " - " + job_durations[job_name])
+    if GlobalData.job_queue:
+        job_summary = GlobalData.job_queue.get_job_summary()
+        if len(job_summary) > 0:
+            job_run_info.append("Queued and Running Jobs:")
+            job_run_info += job_summary
     return log_stream.getvalue() + "\n".join(job_run_info)
 
 
+@app.route("/cancel_job", methods=["GET", "POST"])
+def cancel_job():
+    job_name = request.form["job_name"]
+    if GlobalData.job_queue and GlobalData.job_queue.cancel(job_name):
+        main_logger.info(u"Job " + job_name + " cancelled")
+    else:
+        main_logger.info(u"Job " + job_name + " is not queued or running")
+    return check_for_results()
+
+
+@app.route("/retry_job", methods=["GET", "POST"])
+def retry_job():
+    job_name = request.form["job_name"]
+    if GlobalData.job_queue and GlobalData.job_queue.retry(job_name):
+        main_logger.info(u"Job " + job_name + " resubmitted")
+    else:
+        main_logger.info(u"Job " + job_name + " has not failed or been cancelled")
+    return check_for_results()
+
+
 @app.route("/clear_html_log", methods=["GET", "POST"])
 def clear_html_log():
     # Clear progress window
@@ -679,6 +693,22 @@ if __name__ == "__main__":
         default=1,
         help="Number of processes for processing results data (default: 1)",
     )
+    parser.add_argument(
+        "-jobs",
+        "--jobs",
+        type=int,
+        dest="max_jobs",
+        default=4,
+        help="Maximum number of jobs to run at a time (default: 4)",
+    )
+    parser.add_argument(
+        "-jobs_per_host",
+        "--jobs_per_host",
+        type=int,
+        dest="max_jobs_per_host",
+        default=1,
+        help="Maximum number of jobs to run at a time on each host (default: 1)",
+    )
     parser.add_argument(
         "-debug",
         "--debug",
@@ -707,6 +737,8 @@ if __name__ == "__main__":
     port = args.port
     GlobalData.debug = args.debug
     GlobalData.n_proc = args.n_proc
+    GlobalData.max_jobs = args.max_jobs
+    GlobalData.max_jobs_per_host = args.max_jobs_per_host
     browser = args.browser
     profile = args.profile
     url = "http://{}:{}/index".format(host, port)
@@ -0,0 +1,147 @@
+import math
+import re
+from collections import namedtuple
+
+CallStatistics = namedtuple(
+    "CallStatistics",
+    [
+        "function",
+        "calls",
+        "total",
+        "mean",
+        "median",
+        "p90",
+        "p99",
+        "max",
+        "threads",
+        "imbalance",
+    ],
+)
+
+call_statistics_headers = [
+    ("function", "Function"),
+    ("calls", "Calls"),
+    ("total", "Total"),
+    ("mean", "Mean"),
+    ("median", "Median"),
+    ("p90", "90th Percentile"),
+    ("p99", "99th Percentile"),
+    ("max", "Max"),
+    ("threads", "Threads"),
+    ("imbalance", "Load Imbalance (Max / Mean)"),
+]
+
+
+def percentile(sorted_values, p):
+    """Nearest rank percentile of a sorted list"""
+    if len(sorted_values) == 0:
+        return 0.0
+    rank = int(math.ceil(p / 100.0 * len(sorted_values))) - 1
+    return sorted_values[max(rank, 0)]
+
+
+def get_call_intervals(trace, t1, t2):
+    """Find the start and end of each call instance in a thread trace, clipped to [t1, t2].
+    Call instances are identified by the context (the first function in the stack),
+    and the _[[call_N]] tag of each subsequent frame."""
+    calls = {}
+    for time_index, time_slice in enumerate(trace):
+        if int(t1) <= time_index <= int(t2):
+            for time_slice_interval in time_slice:
+                start = time_slice_interval["samples"][0]
+                end = time_slice_interval["samples"][-1]
+                if end > t1 and start <= t2:
+                    x1 = max(start, t1)
+                    x2 = min(end, t2)
+                    frames = time_slice_interval["stack"].split(";")
+                    for frame in frames[2:]:
+                        key = (frames[1], frame)
+                        if key in calls:
+                            calls[key][1] = x2
+                        else:
+                            calls[key] = [x1, x2]
+    return calls
+
+
+def compute_call_statistics(threads, t1, t2, time_scale):
+    """Compute call counts, durations and load imbalance for each function,
+    where threads is a list of thread traces"""
+    durations = {}
+    thread_totals = {}
+    for n, trace in enumerate(threads):
+        calls = get_call_intervals(trace, t1, t2)
+        for (context, frame), (x1, x2) in calls.items():
+            function = re.sub("_\[\[call_[0-9]+\]\]$", "", frame)
+            if function not in durations:
+                durations[function] = []
+                thread_totals[function] = [0.0] * len(threads)
+            duration = time_scale * (x2 - x1)
+            durations[function].append(duration)
+            thread_totals[function][n] += duration
+    statistics = []
+    for function in durations:
+        values = sorted(durations[function])
+        total = sum(values)
+        totals = thread_totals[function]
+        mean_thread_total = sum(totals) / float(len(totals))
+        if mean_thread_total > 0.0:
+            imbalance = max(totals) / mean_thread_total
+        else:
+            imbalance = 1.0
+        statistics.append(
+            CallStatistics(
+                function=function,
+                calls=len(values),
+                total=total,
+                mean=total / float(len(values)),
+                median=percentile(values, 50.0),
+                p90=percentile(values, 90.0),
+                p99=percentile(values, 99.0),
+                max=values[-1],
+                threads=len([t for t in totals if t > 0.0]),
+                imbalance=imbalance,
+            )
+        )
+    return statistics
+
+
+def sort_call_statistics(statistics, sort_key="total", descending=True):
+    if sort_key not in CallStatistics._fields:
+        sort_key = "total"
+    return sorted(
+        statistics, key=lambda row: getattr(row, sort_key), reverse=descending
+    )
+
+
+def generate_call_statistics_table(statistics, unit, sort_key="total", max_rows=200):
+    """Return raw html table with call statistics, with sortable column headers"""
+    table_html = ["<table>", "<thead>", "<tr>"]
+    for key, header in call_statistics_headers:
+        if key in ["function", "calls", "threads", "imbalance"]:
+            label = header
+        else:
+            label = header + " (" + unit + ")"
+        if key == sort_key:
+            label += " &#x25BC;"
+        table_html.append(
+            '<th class="call_statistics_header" data-sort-key="'
+            + key
+            + '">'
+            + label
+            + "</th>"
+        )
+    table_html += ["</tr>", "</thead>", "<tbody>"]
+    for row in statistics[0:max_rows]:
+        function = re.sub("&", "&amp;", row.function)
+        function = re.sub("<", "&lt;", function)
+        function = re.sub(">", "&gt;", function)
+        table_html.append("<tr>")
+        table_html.append("<td>" + function + "</td>")
+        table_html.append("<td>" + str(row.calls) + "</td>")
+        for value in [row.total, row.mean, row.median, row.p90, row.p99, row.max]:
+            table_html.append("<td>" + "{:.1f}".format(value) + "</td>")
+        table_html.append("<td>" + str(row.threads) + "</td>")
+        table_html.append("<td>" + "{:.2f}".format(row.imbalance) + "</td>")
+        table_html.append("</tr>")
+    table_html += ["</tbody>", "</table>"]
+    return "".join(table_html)
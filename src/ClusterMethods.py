@@ -0,0 +1,306 @@
+import random
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from itertools import product
+from math import log, exp, pi, sqrt, floor
+
+# Clustering of functions by their full counter signature. Each method is fitted, in a
+# worker process, to a random sample of the (standardised) feature vectors, and every
+# vector is then assigned to a cluster by the fitted model, in parallel chunks for
+# large inputs.
+# Labels are ordered by cluster size, and -1 denotes a point which is not in any cluster.
+
+
+def squared_distance(a, b):
+    return sum((x - y) * (x - y) for x, y in zip(a, b))
+
+
+def nearest(point, centres):
+    best = 0
+    best_distance = squared_distance(point, centres[0])
+    for i in range(1, len(centres)):
+        distance = squared_distance(point, centres[i])
+        if distance < best_distance:
+            best = i
+            best_distance = distance
+    return best, best_distance
+
+
+def standardise(points):
+    """Scale each feature to zero mean and unit variance"""
+    if len(points) == 0:
+        return []
+    n = float(len(points))
+    means = [sum(column) / n for column in zip(*points)]
+    scales = []
+    for column, mean in zip(zip(*points), means):
+        variance = sum((x - mean) * (x - mean) for x in column) / n
+        scales.append(1.0 / sqrt(variance) if variance > 0.0 else 0.0)
+    return [[(x - m) * s for x, m, s in zip(p, means, scales)] for p in points]
+
+
+class KMeansClustering:
+    """Mini-batch k-means, with k-means++ initialisation"""
+
+    def __init__(self, n_clusters, batch_size=256, iterations=100, seed=0):
+        self.n_clusters = n_clusters
+        self.batch_size = batch_size
+        self.iterations = iterations
+        self.seed = seed
+        self.centres = []
+
+    def initialise(self, points, rng):
+        centres = [points[rng.randrange(len(points))]]
+        distances = [squared_distance(p, centres[0]) for p in points]
+        while len(centres) < self.n_clusters:
+            total = sum(distances)
+            if total <= 0.0:
+                break
+            r = rng.random() * total
+            i = 0
+            while i < len(points) - 1 and r > distances[i]:
+                r -= distances[i]
+                i += 1
+            centres.append(points[i])
+            distances = [
+                min(d, squared_distance(p, points[i])) for p, d in zip(points, distances)
+            ]
+        return [list(c) for c in centres]
+
+    def fit(self, points):
+        rng = random.Random(self.seed)
+        self.centres = self.initialise(points, rng)
+        counts = [0] * len(self.centres)
+        batch_size = min(self.batch_size, len(points))
+        for _ in range(self.iterations):
+            batch = [points[rng.randrange(len(points))] for _ in range(batch_size)]
+            for point in batch:
+                i = nearest(point, self.centres)[0]
+                counts[i] += 1
+                eta = 1.0 / counts[i]
+                centre = self.centres[i]
+                for j, x in enumerate(point):
+                    centre[j] += eta * (x - centre[j])
+        return self
+
+    def predict(self, points):
+        return [nearest(point, self.centres)[0] for point in points]
+
+
+class DBSCANClustering:
+    """Density based clustering. Points of the sample with at least min_samples neighbours
+    within eps are core points, and clusters are the connected sets of core points.
+    Other points join the cluster of their nearest core point if it is within eps,
+    where the core points are found from a grid of cells of width eps over the first
+    grid_dimensions features. By default eps is estimated from the distances to the
+    min_samples'th neighbour."""
+
+    def __init__(
+        self,
+        n_clusters,
+        eps=None,
+        min_samples=5,
+        max_fit_size=1000,
+        grid_dimensions=3,
+        seed=0,
+    ):
+        self.n_clusters = n_clusters
+        self.eps = eps
+        self.min_samples = min_samples
+        self.max_fit_size = max_fit_size
+        self.grid_dimensions = grid_dimensions
+        self.seed = seed
+        self.core_points = []
+        self.core_labels = []
+        self.grid = {}
+
+    def get_cell(self, point):
+        return tuple(floor(x / self.eps) for x in point[0 : self.grid_dimensions])
+
+    def fit(self, points):
+        if len(points) > self.max_fit_size:
+            points = random.Random(self.seed).sample(points, self.max_fit_size)
+        distances = [[squared_distance(p, q) for q in points] for p in points]
+        k = min(self.min_samples, len(points) - 1)
+        if self.eps is None:
+            k_distances = sorted(sorted(row)[k] for row in distances)
+            eps2 = k_distances[int(0.75 * (len(k_distances) - 1))]
+            self.eps = sqrt(eps2)
+        eps2 = self.eps * self.eps
+        neighbours = [
+            [j for j, d in enumerate(row) if d <= eps2] for row in distances
+        ]
+        core = [len(n) > k for n in neighbours]
+        labels = [-1] * len(points)
+        n = 0
+        for i in range(len(points)):
+            if core[i] and labels[i] < 0:
+                labels[i] = n
+                stack = [i]
+                while stack:
+                    j = stack.pop()
+                    for m in neighbours[j]:
+                        if core[m] and labels[m] < 0:
+                            labels[m] = n
+                            stack.append(m)
+                n += 1
+        self.core_points = [p for p, c in zip(points, core) if c]
+        self.core_labels = [l for l, c in zip(labels, core) if c]
+        self.grid = {}
+        if self.eps > 0.0:
+            for i, point in enumerate(self.core_points):
+                self.grid.setdefault(self.get_cell(point), []).append(i)
+        return self
+
+    def predict(self, points):
+        return [self.predict_point(point) for point in points]
+
+    def predict_point(self, point):
+        """Label of the first core point within eps, searching the cell of the point
+        first, as any core point within eps is equally valid"""
+        if len(self.grid) == 0:
+            return -1
+        eps2 = self.eps * self.eps
+        cell = self.get_cell(point)
+        for offset in product((0, -1, 1), repeat=len(cell)):
+            key = tuple(c + o for c, o in zip(cell, offset))
+            for i in self.grid.get(key, []):
+                if squared_distance(point, self.core_points[i]) <= eps2:
+                    return self.core_labels[i]
+        return -1
+
+
+class GaussianMixtureClustering:
+    """Gaussian mixture with diagonal covariances, fitted by expectation maximisation
+    starting from a k-means solution. Each iteration costs O(n * k * d) in pure Python,
+    so the mixture is fitted to at most max_fit_size points"""
+
+    def __init__(
+        self, n_clusters, iterations=20, tolerance=1.0e-4, max_fit_size=2000, seed=0
+    ):
+        self.n_clusters = n_clusters
+        self.iterations = iterations
+        self.tolerance = tolerance
+        self.max_fit_size = max_fit_size
+        self.seed = seed
+        self.weights = []
+        self.means = []
+        self.variances = []
+
+    def log_likelihoods(self, point):
+        values = []
+        for w, means, variances in zip(self.weights, self.means, self.variances):
+            v = log(w)
+            for x, m, s2 in zip(point, means, variances):
+                v -= 0.5 * (log(2.0 * pi * s2) + (x - m) * (x - m) / s2)
+            values.append(v)
+        return values
+
+    def fit(self, points):
+        if len(points) > self.max_fit_size:
+            points = random.Random(self.seed).sample(points, self.max_fit_size)
+        kmeans = KMeansClustering(self.n_clusters, seed=self.seed).fit(points)
+        k = len(kmeans.centres)
+        n = float(len(points))
+        d = len(points[0])
+        self.means = kmeans.centres
+        self.variances = [[1.0] * d for _ in range(k)]
+        self.weights = [1.0 / k] * k
+        previous = None
+        for _ in range(self.iterations):
+            # Expectation: responsibilities of each component for each point
+            total = 0.0
+            responsibilities = []
+            for point in points:
+                values = self.log_likelihoods(point)
+                vmax = max(values)
+                r = [exp(v - vmax) for v in values]
+                s = sum(r)
+                total += vmax + log(s)
+                responsibilities.append([x / s for x in r])
+            # Maximisation: weights, means and variances of each component
+            for i in range(k):
+                ri = [r[i] for r in responsibilities]
+                ni = sum(ri) + 1.0e-10
+                self.weights[i] = max(ni / n, 1.0e-10)
+                means = [
+                    sum(r * p[j] for r, p in zip(ri, points)) / ni for j in range(d)
+                ]
+                self.variances[i] = [
+                    sum(r * (p[j] - means[j]) ** 2 for r, p in zip(ri, points)) / ni
+                    + 1.0e-6
+                    for j in range(d)
+                ]
+                self.means[i] = means
+            if previous is not None and abs(total - previous) <= self.tolerance * n:
+                break
+            previous = total
+        return self
+
+    def predict(self, points):
+        labels = []
+        for point in points:
+            values = self.log_likelihoods(point)
+            labels.append(values.index(max(values)))
+        return labels
+
+
+cluster_methods = OrderedDict(
+    [
+        ("kmeans", ("Mini-Batch K-Means", KMeansClustering)),
+        ("dbscan", ("DBSCAN", DBSCANClustering)),
+        ("gmm", ("Gaussian Mixture", GaussianMixtureClustering)),
+    ]
+)
+
+
+def fit_worker(args):
+    model, points = args
+    return model.fit(points)
+
+
+def predict_worker(args):
+    model, points = args
+    return model.predict(points)
+
+
+def predict(model, points, executor, n_proc=1, chunk_size=10000):
+    if n_proc > 1 and len(points) > chunk_size:
+        chunks = [
+            (model, points[i : i + chunk_size])
+            for i in range(0, len(points), chunk_size)
+        ]
+        labels = []
+        for chunk_labels in executor.map(predict_worker, chunks):
+            labels += chunk_labels
+        return labels
+    return model.predict(points)
+
+
+def calculate_clusters(
+    method, points, n_clusters, max_sample_size=10000, n_proc=1, seed=0
+):
+    """Cluster the feature vectors in points with the named method, returning a label
+    for each point. At most n_clusters clusters are returned, numbered from largest
+    to smallest, and the points of any smaller clusters are labelled -1. The model is
+    fitted in a worker process, and the points are labelled in parallel chunks"""
+    if len(points) == 0:
+        return []
+    points = standardise(points)
+    if len(points) > max_sample_size:
+        sample = random.Random(seed).sample(points, max_sample_size)
+    else:
+        sample = points
+    n = min(n_clusters, len(set(tuple(p) for p in sample)))
+    model = cluster_methods[method][1](n, seed=seed)
+    with ProcessPoolExecutor(max_workers=max(n_proc, 1)) as executor:
+        model = executor.submit(fit_worker, (model, sample)).result()
+        labels = predict(model, points, executor, n_proc=n_proc)
+    sizes = {}
+    for label in labels:
+        if label >= 0:
+            sizes[label] = sizes.get(label, 0) + 1
+    order = sorted(sizes, key=lambda label: (-sizes[label], label))
+    relabel = {label: i if i < n_clusters else -1 for i, label in enumerate(order)}
+    relabel[-1] = -1
+    return [relabel[label] for label in labels]
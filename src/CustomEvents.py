@@ -1,285 +1,349 @@
 import os
 import re
 import sys
+import heapq
+from itertools import groupby
 from tempfile import mkstemp
 from shutil import move
 from os import remove, close
 from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+
+from src.ResultsHandler import get_process_to_event_map, process_name_regex
+
+# Partial totals merged at a time, when summing cumulative counts over processes
+max_merged_files = 64
+
+
+def read_intervals(filename):
+    """Generator of (time, OrderedDict of stack: count) for each time interval of a
+    stacks file, read one interval at a time"""
+    t = None
+    stacks = OrderedDict()
+    with open(filename, "r") as infile:
+        for line in infile:
+            s = line.strip()
+            if s.startswith("t="):
+                if t is not None:
+                    yield t, stacks
+                t = s.partition("=")[2]
+                stacks = OrderedDict()
+            else:
+                s, _, count = s.rpartition(" ")
+                if s:
+                    stacks[s] = int(count)
+    if t is not None:
+        yield t, stacks
+
+
+def merge_intervals(intervals1, intervals2):
+    """Merge two streams of time ordered intervals, as a stream of (time, stacks),
+    where stacks is an OrderedDict of stack: [count1, count2]"""
+    next1 = next(intervals1, None)
+    next2 = next(intervals2, None)
+    while next1 is not None or next2 is not None:
+        if next2 is None or (next1 is not None and float(next1[0]) < float(next2[0])):
+            t, stacks1 = next1
+            stacks2 = {}
+            next1 = next(intervals1, None)
+        elif next1 is None or float(next2[0]) < float(next1[0]):
+            t, stacks2 = next2
+            stacks1 = {}
+            next2 = next(intervals2, None)
+        else:
+            t, stacks1 = next1
+            stacks2 = next2[1]
+            next1 = next(intervals1, None)
+            next2 = next(intervals2, None)
+        stacks = OrderedDict((s, [count, 0]) for s, count in stacks1.items())
+        for s, count in stacks2.items():
+            if s in stacks:
+                stacks[s][1] = count
+            else:
+                stacks[s] = [0, count]
+        yield t, stacks
 
-from src.ResultsHandler import get_job_name, get_process_to_event_map
 
+def sum_intervals(intervals1, intervals2, scale1, scale2):
+    """Stream of (time, OrderedDict of stack: count) for the scaled sum of two streams
+    of time ordered intervals"""
+    for t, stacks in merge_intervals(intervals1, intervals2):
+        yield t, OrderedDict(
+            (s, scale1 * counts[0] + scale2 * counts[1]) for s, counts in stacks.items()
+        )
 
-def sort_by_time(data):
-    """# For regular time intervals, but possibly with different start/end ranges"""
-    times = []
-    sorted_data = OrderedDict()
-    for t in data:
-        times.append(float(t))
-    times.sort()
-    for time in times:
-        t = "{:.2f}".format(time)
-        stacks = data[t]
-        sorted_data[t] = stacks
-    return sorted_data
 
+def read_event_sum_intervals(event_files, events, raw_event_counters):
+    """Stream of intervals for the sum of events, adding one event at a time"""
+    intervals = read_intervals(event_files[events[0]])
+    for n in range(1, len(events)):
+        event1 = "-plus-".join(events[:n])
+        scale1, scale2, _ = get_composite_event_scales(
+            event1, events[n], raw_event_counters
+        )
+        intervals = sum_intervals(
+            intervals, read_intervals(event_files[events[n]]), scale1, scale2
+        )
+    return intervals
 
-def create_composite_event_stack(stack_data, results_files):
-    """Create combined stack from two separate stacks, representing sum or ratio"""
-    raw_event = stack_data.event
-    for results_file in results_files:
-        filenames = ["", ""]
-        full_filename = os.path.join(stack_data.path, results_file)
-        job = get_job_name(results_file)
-        found = get_process_to_event_map(
-            stack_data.path, results_file
-        )  # get all events for each process
-        all_events = []
-        for name in found:
-            all_events += found[name]
-        if (
-            raw_event not in all_events
-        ):  # exit if composite event already exists for this job
-            event1, event2 = split_raw_event(raw_event, stack_data.cpu_definition)
-            if (
-                event1 not in all_events or event2 not in all_events
-            ):  # skip if job does not contain both events
-                continue
-            for name in found:
-                counter1 = get_composite_event_counter(
-                    event1, stack_data.event_counters[job]
-                )
-                if is_clock_event(event1) or is_clock_event(event2):
-                    if is_clock_event(event1):  # unit of ratio is seconds per event
-                        scale2 = counter1  # multiply event2 event period by event1 frequency (Hz)
-                    else:
-                        scale2 = 1  # events
-                    if is_clock_event(event2):  # unit of ratio is events per second
-                        scale1 = counter1  # multiply event1 event period by event2 frequency (Hz)
-                    else:
-                        scale1 = 1
-                    counter = 1
-                else:
-                    counter = counter1  # Both counters equal
-                    scale1 = 1
-                    scale2 = 1
-                data = OrderedDict()
-                filenames[0] = name + "_" + event1
-                filenames[1] = name + "_" + event2
-                file0 = os.path.join(stack_data.path, filenames[0])
-                file1 = os.path.join(stack_data.path, filenames[1])
-                if os.path.isfile(file0) and os.path.isfile(file1):
-                    with open(file0, "r") as infile:
-                        t = ""
-                        for stack in infile:
-                            s = stack.strip()
-                            if re.match("t=", s):
-                                t = s.partition("=")[2]
-                                data[t] = OrderedDict()
-                            else:
-                                s, _, count = s.rpartition(" ")
-                                if s:
-                                    data[t][s] = [int(count), 0]
-                    file1 = os.path.join(stack_data.path, filenames[1])
-                    with open(file1, "r") as infile:
-                        for stack in infile:
-                            s = stack.strip()
-                            if re.match("t=", s):
-                                t = s.partition("=")[2]
-                                if t not in data:
-                                    data[t] = OrderedDict()
-                            else:
-                                s, _, count = s.rpartition(" ")
-                                if s:
-                                    if s in data[t]:
-                                        data[t][s][1] = int(count)
-                                    else:
-                                        data[t][s] = [0, int(count)]
-                    ordered_data = sort_by_time(data)
-                    custom_event_ratio = bool(re.match(".*-divide-.*", raw_event))
-                    if custom_event_ratio:
-                        out_file = filenames[0] + "-divide-" + event2
-                    else:  # sum
-                        out_file = filenames[0] + "-plus-" + event2
-                    path_to_out_file = os.path.join(stack_data.path, out_file)
-                    f = open(path_to_out_file, "wb")
-                    for t in ordered_data:
-                        time = "t=" + t + "\n"
-                        f.write(time.encode())
-                        for stack in ordered_data[t]:
-                            if custom_event_ratio:
-                                combined_stack = "{} {} {}\n".format(
-                                    stack,
-                                    scale1 * ordered_data[t][stack][0],
-                                    scale2 * ordered_data[t][stack][1],
-                                )
-                                f.write(combined_stack.encode())
-                            else:  # sum
-                                combined_stack = "{} {}\n".format(
-                                    stack,
-                                    scale1 * ordered_data[t][stack][0]
-                                    + scale2 * ordered_data[t][stack][1],
-                                )
-                                f.write(combined_stack.encode())
-                    f.close()
-                    f_results = open(full_filename, "a")
-                    event_counter_description = (
-                        "event_counter-" + raw_event + ":run-0:" + str(counter)
-                    )
-                    f_results.write(event_counter_description + "\n")
-                    f_results.write(out_file + "\n")
-                    f_results.close()
+
+def read_composite_event_lines(raw_event, event_files, raw_event_counters):
+    """Generator of the stack lines of a composite event, evaluated one time interval at
+    a time from the stacks files of the events it is made of. Each side of a ratio can
+    be a sum of events, i.e. (a + b) / (c + d)"""
+    numerator, denominator = split_composite_event(raw_event)
+    if denominator:
+        scale1, scale2, _ = get_composite_event_scales(
+            "-plus-".join(numerator), "-plus-".join(denominator), raw_event_counters
+        )
+        for t, stacks in merge_intervals(
+            read_event_sum_intervals(event_files, numerator, raw_event_counters),
+            read_event_sum_intervals(event_files, denominator, raw_event_counters),
+        ):
+            yield "t=" + "{:.2f}".format(float(t))
+            for stack, counts in stacks.items():
+                yield "{} {} {}".format(stack, scale1 * counts[0], scale2 * counts[1])
+    else:  # sum
+        for t, stacks in read_event_sum_intervals(
+            event_files, numerator, raw_event_counters
+        ):
+            yield "t=" + "{:.2f}".format(float(t))
+            for stack, count in stacks.items():
+                yield "{} {}".format(stack, count)
+
+
+def get_counts_line(stack, counts, event_type):
+    line = stack + " " + str(counts[0])
+    if event_type == "custom_event_ratio":
+        line += " " + str(counts[1])
+    return line + "\n"
+
+
+def get_stack_counts(line, event_type):
+    """Stack and [primary, secondary] counts of a line of a stacks file"""
+    stack = line.strip()
+    secondary = 0
+    if event_type == "custom_event_ratio":
+        stack, _, secondary = stack.rpartition(" ")
+    stack, _, primary = stack.rpartition(" ")
+    return stack, [int(primary), int(secondary)]
+
+
+def read_count_intervals(filename, event_type):
+    """Generator of (time, OrderedDict of stack: [primary, secondary]) for each time
+    interval of a file of cumulative counts"""
+    t = None
+    stacks = OrderedDict()
+    with open(filename, "r") as infile:
+        for line in infile:
+            if line[0:2] == "t=":
+                if t is not None:
+                    yield t, stacks
+                t = line.strip().partition("=")[2]
+                stacks = OrderedDict()
+            elif t is not None:
+                stack, counts = get_stack_counts(line, event_type)
+                if stack:
+                    stacks[stack] = counts
+    if t is not None:
+        yield t, stacks
+
+
+def add_counts(totals, stack, counts):
+    if stack in totals:
+        totals[stack][0] += counts[0]
+        totals[stack][1] += counts[1]
+    else:
+        totals[stack] = list(counts)
+
+
+def write_thread_totals(new_file, lines, thread_counts, event_type):
+    """Write the lines of an interval of a process file, with the thread totals after
+    the time"""
+    if lines:
+        new_file.write(lines[0].encode())
+    for pid in thread_counts:
+        for stack, counts in thread_counts[pid].items():
+            new_file.write(get_counts_line(stack, counts, event_type).encode())
+    for line in lines[1:]:
+        new_file.write(line.encode())
+
+
+def write_process_totals(partial_file, t, process_counts, event_type):
+    partial_file.write(("t=" + t + "\n").encode())
+    for stack, counts in process_counts.items():
+        partial_file.write(get_counts_line(stack, counts, event_type).encode())
+
+
+def cumulative_count_worker(args):
+    """Sum the stacks of a process file over threads, and over the process, one time
+    interval at a time. The thread totals are merged into the process file, and the
+    process totals are written to a temporary file, to be summed over processes"""
+    filename, event_type, output_process_totals, output_job_totals = args
+    write_process_file = output_process_totals
+    new_file = None
+    partial_file = None
+    if output_process_totals:
+        fh, abs_path = mkstemp()
+        close(fh)
+        new_file = open(abs_path, "wb")
+    if output_job_totals:
+        fh, partial_filename = mkstemp()
+        close(fh)
+        partial_file = open(partial_filename, "wb")
+    t = None
+    lines = []
+    thread_counts = OrderedDict()
+    process_counts = OrderedDict()
+    with open(filename, "r") as infile:
+        for line in infile:
+            if line[0:2] == "t=":
+                if new_file:
+                    write_thread_totals(new_file, lines, thread_counts, event_type)
+                if partial_file and t is not None:
+                    write_process_totals(partial_file, t, process_counts, event_type)
+                t = line.strip().partition("=")[2]
+                lines = []
+                thread_counts = OrderedDict()
+                process_counts = OrderedDict()
+            else:
+                match = process_name_regex.match(line)
+                if match and t is not None:
+                    pid = match.group(2)
+                    tid = match.group(3)
+                    if tid == "all":  # Skip event if cumulative data already exists
+                        write_process_file = False
+                    stack, counts = get_stack_counts(line, event_type)
+                    if stack:
+                        rest = stack[match.end() :]
+                        thread_stack = match.group(1) + pid + "/all" + rest
+                        process_stack = match.group(1) + "all/all" + rest
+                        if pid not in thread_counts:
+                            thread_counts[pid] = OrderedDict()
+                        add_counts(thread_counts[pid], thread_stack, counts)
+                        add_counts(process_counts, process_stack, counts)
+            if new_file:
+                lines.append(line)
+    if new_file:
+        write_thread_totals(new_file, lines, thread_counts, event_type)
+        new_file.close()
+        if write_process_file:
+            remove(filename)
+            move(abs_path, filename)
+        else:
+            remove(abs_path)
+    if partial_file:
+        if t is not None:
+            write_process_totals(partial_file, t, process_counts, event_type)
+        partial_file.close()
+        return partial_filename
+    return None
+
+
+def merge_count_files_worker(args):
+    """Sum files of cumulative counts, one time interval at a time"""
+    filenames, out_file, event_type = args
+    intervals = heapq.merge(
+        *[read_count_intervals(filename, event_type) for filename in filenames],
+        key=lambda interval: float(interval[0])
+    )
+    with open(out_file, "wb") as f:
+        for t, group in groupby(intervals, key=lambda interval: interval[0]):
+            process_counts = OrderedDict()
+            for _, stacks in group:
+                for stack, counts in stacks.items():
+                    add_counts(process_counts, stack, counts)
+            write_process_totals(f, t, process_counts, event_type)
+    for filename in filenames:
+        remove(filename)
+
+
+def merge_count_files(partial_files, out_file, event_type, pool=None):
+    """Sum partial totals into out_file, merging at most max_merged_files at a time"""
+    while len(partial_files) > max_merged_files:
+        arg_list = []
+        merged_files = []
+        for n in range(0, len(partial_files), max_merged_files):
+            fh, merged_file = mkstemp()
+            close(fh)
+            arg_list.append(
+                (partial_files[n : n + max_merged_files], merged_file, event_type)
+            )
+            merged_files.append(merged_file)
+        if pool:
+            list(pool.map(merge_count_files_worker, arg_list))
+        else:
+            list(map(merge_count_files_worker, arg_list))
+        partial_files = merged_files
+    merge_count_files_worker((partial_files, out_file, event_type))
 
 
 def create_cumulative_count_stack(
-    local_data, results_files, output_job_totals=True, output_process_totals=True
+    local_data,
+    results_files,
+    output_job_totals=True,
+    output_process_totals=True,
+    n_proc=1,
 ):
-    """Create cumulative stack by summing stacks over threads or processes"""
+    """Create cumulative stack by summing stacks over threads or processes. Each
+    process is summed in parallel, one time interval at a time, and the job totals
+    merged from the process totals"""
     for results_file in results_files:
         found = get_process_to_event_map(local_data, results_file)
-        process_id_regex = re.compile("((all|[0-9]+)/(all|[0-9]+))")
-        events = []
+        all_events = []
         for name in found:
-            events += found[name]
-        all_events = {event for event in events}  # Remove duplicates
+            for event in found[name]:
+                if event not in all_events:  # Remove duplicates
+                    all_events.append(event)
+        arg_list = []
+        task_events = []
+        out_files = OrderedDict()
         for found_event in all_events:
             event_type = get_event_type(found_event)
-            process_counts = OrderedDict()
             for name in found:
                 if name.rpartition("_")[2] == "procall":
                     continue
-                for raw_event in found[name]:
-                    if raw_event == found_event:
-                        thread_counts = OrderedDict()
-                        filename = name + "_" + raw_event
-                        file = os.path.join(local_data, filename)
-                        if os.path.isfile(file):
-                            write_process_totals = True
-                            with open(file, "r") as infile:
-                                for line in infile:
-                                    stack = line.strip()
-                                    if line[0:2] == "t=":
-                                        t = stack.partition("=")[2]
-                                        if t not in thread_counts:
-                                            thread_counts[t] = OrderedDict()
-                                        if t not in process_counts:
-                                            process_counts[t] = OrderedDict()
-                                    else:
-                                        match = re.search(process_id_regex, line)
-                                        if match:
-                                            pid = match.group(2)
-                                            tid = match.group(3)
-                                            if (
-                                                tid == "all"
-                                            ):  # Skip event if cumulative data already exists
-                                                write_process_totals = False
-                                            if pid not in thread_counts[t]:
-                                                thread_counts[t][pid] = OrderedDict()
-                                            stack = line.strip()
-                                            if event_type == "custom_event_ratio":
-                                                stack, _, secondary = stack.rpartition(
-                                                    " "
-                                                )
-                                            stack, _, primary = stack.rpartition(" ")
-                                            if stack:
-                                                thread_stack = re.sub(
-                                                    "/" + tid, "/all", stack
-                                                )
-                                                process_stack = re.sub(
-                                                    pid + "/", "all/", thread_stack
-                                                )
-                                                if (
-                                                    process_stack
-                                                    not in process_counts[t]
-                                                ):
-                                                    process_counts[t][process_stack] = [
-                                                        0,
-                                                        0,
-                                                    ]
-                                                if (
-                                                    thread_stack
-                                                    not in thread_counts[t][pid]
-                                                ):
-                                                    thread_counts[t][pid][
-                                                        thread_stack
-                                                    ] = [0, 0]
-                                                thread_counts[t][pid][thread_stack][
-                                                    0
-                                                ] += int(primary)
-                                                process_counts[t][process_stack][
-                                                    0
-                                                ] += int(primary)
-                                                if event_type == "custom_event_ratio":
-                                                    thread_counts[t][pid][thread_stack][
-                                                        1
-                                                    ] += int(secondary)
-                                                    process_counts[t][process_stack][
-                                                        1
-                                                    ] += int(secondary)
-                            # Merge thread cumulative data into existing process file
-                            if output_process_totals and write_process_totals:
-                                fh, abs_path = mkstemp()
-                                with open(abs_path, "wb") as new_file:
-                                    with open(file, "r") as result:
-                                        for line in result:
-                                            if line[0:2] == "t=":
-                                                new_file.write(line.encode())
-                                                t = line.strip().partition("=")[2]
-                                                if t in thread_counts:
-                                                    for pid in thread_counts[t]:
-                                                        for stack in thread_counts[t][
-                                                            pid
-                                                        ]:
-                                                            primary = str(
-                                                                thread_counts[t][pid][
-                                                                    stack
-                                                                ][0]
-                                                            )
-                                                            new_line = (
-                                                                stack + " " + primary
-                                                            )
-                                                            if (
-                                                                event_type
-                                                                == "custom_event_ratio"
-                                                            ):
-                                                                secondary = str(
-                                                                    thread_counts[t][
-                                                                        pid
-                                                                    ][stack][1]
-                                                                )
-                                                                new_line += (
-                                                                    " " + secondary
-                                                                )
-                                                            new_line += "\n"
-                                                            new_file.write(
-                                                                new_line.encode()
-                                                            )
-                                            else:
-                                                new_file.write(line.encode())
-                                close(fh)
-                                remove(file)
-                                move(abs_path, file)
+                if found_event in found[name]:
+                    filename = name + "_" + found_event
+                    file = os.path.join(local_data, filename)
+                    if os.path.isfile(file):
+                        arg_list.append(
+                            (file, event_type, output_process_totals, output_job_totals)
+                        )
+                        task_events.append(found_event)
+                        out_file = re.sub("proc[0-9]+_", "procall_", filename)
+                        out_files[found_event] = out_file
+        run_parallel = n_proc > 1 and len(arg_list) > 1
+        pool = None
+        if run_parallel:
+            pool = ProcessPoolExecutor(min(n_proc, len(arg_list)))
+        # Shut the pool down even if a worker fails, so that no processes are left
+        try:
+            if pool:
+                partial_files = list(pool.map(cumulative_count_worker, arg_list))
+            else:
+                partial_files = list(map(cumulative_count_worker, arg_list))
             if output_job_totals:
-                out_file = re.sub("proc[0-9]+_", "procall_", filename)
-                file = os.path.join(local_data, out_file)
-                f = open(
-                    file, "wb"
-                )  # Write Process cumulative data to new process file
-                for t in process_counts:
-                    time = "t=" + t + "\n"
-                    f.write(time.encode())
-                    for stack in process_counts[t]:
-                        primary = str(process_counts[t][stack][0])
-                        new_line = stack + " " + primary
-                        if event_type == "custom_event_ratio":
-                            secondary = str(process_counts[t][stack][1])
-                            new_line += " " + secondary
-                        new_line += "\n"
-                        f.write(new_line.encode())
-                f.close()
-                full_filename = os.path.join(local_data, results_file)
-                f_results = open(full_filename, "a")
-                f_results.write(out_file + "\n")
-                f_results.close()
+                for found_event, out_file in out_files.items():
+                    event_partial_files = [
+                        partial_file
+                        for partial_file, event in zip(partial_files, task_events)
+                        if event == found_event
+                    ]
+                    # Write Process cumulative data to new process file
+                    merge_count_files(
+                        event_partial_files,
+                        os.path.join(local_data, out_file),
+                        get_event_type(found_event),
+                        pool,
+                    )
+                    full_filename = os.path.join(local_data, results_file)
+                    f_results = open(full_filename, "a")
+                    f_results.write(out_file + "\n")
+                    f_results.close()
+        finally:
+            if pool:
+                pool.shutdown()
 
 
 derived_events = {
@@ -298,15 +362,6 @@ def get_derived_events():
     return [event for event in derived_event_map]
 
 
-def create_custom_event_stack(stack_data, results_files, raw_event):
-    """Create stacks for composite event"""
-    if raw_event == "job-cumulative-counts" or raw_event == "process-cumulative-counts":
-        return
-    elif is_composite_event(raw_event):
-        create_composite_event_stack(stack_data, results_files)
-    return
-
-
 def is_derived_event(raw_event):
     """Check if event is derived from another event (sum over threads/processes)"""
     return raw_event in derived_events
@@ -402,6 +457,48 @@ def get_composite_event_counter(raw_event, raw_event_counters):
     return min_event_counter
 
 
+def split_composite_event(raw_event):
+    """Split composite event into the lists of events summed in the numerator and in
+    the denominator, which is empty for a sum"""
+    r1, _, r2 = raw_event.partition("-divide-")
+    numerator = re.split("-plus-", r1)
+    denominator = re.split("-plus-", r2) if r2 != "" else []
+    return numerator, denominator
+
+
+def get_composite_event_scales(event1, event2, raw_event_counters):
+    """Scales for the counts of event1 and event2, and the event counter, of the sum or
+    ratio of event1 and event2"""
+    counter1 = get_composite_event_counter(event1, raw_event_counters)
+    if is_clock_event(event1) or is_clock_event(event2):
+        if is_clock_event(event1):  # unit of ratio is seconds per event
+            scale2 = counter1  # multiply event2 event period by event1 frequency (Hz)
+        else:
+            scale2 = 1  # events
+        if is_clock_event(event2):  # unit of ratio is events per second
+            scale1 = counter1  # multiply event1 event period by event2 frequency (Hz)
+        else:
+            scale1 = 1
+        counter = 1
+    else:
+        counter = counter1  # Both counters equal
+        scale1 = 1
+        scale2 = 1
+    return scale1, scale2, counter
+
+
+def get_virtual_event_counter(raw_event, raw_event_counters):
+    """Event counter of a composite event, evaluated from its events"""
+    numerator, denominator = split_composite_event(raw_event)
+    if denominator:
+        event1 = "-plus-".join(numerator)
+        event2 = "-plus-".join(denominator)
+    else:
+        event1 = "-plus-".join(numerator[:-1])
+        event2 = numerator[-1]
+    return get_composite_event_scales(event1, event2, raw_event_counters)[2]
+
+
 def make_custom_event(cpu_definition, event_type, event1, event2=None):
     event_map = cpu_definition.get_active_event_map(event_to_raw_event=True)
     units = cpu_definition.get_active_event_units()
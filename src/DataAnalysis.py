@@ -1,6 +1,12 @@
 import re
 import sys
-from math import log10, atan, pi
+from array import array
+from collections import OrderedDict
+from math import atan, pi
+
+from src.FeatureMatrix import FeatureMatrix
+from src.ClusterMethods import calculate_clusters
+from src.EventCorrelation import correlation_matrix, fit_threads, rank_residuals
 
 
 class ClusterAnalysis:
@@ -70,6 +76,29 @@ class ClusterAnalysis:
                 elif j == len(bins) - 1:
                     self.cluster_labels.append(j)
 
+    def calculate_clusters(self, method, features, event1, event2, n, n_proc=1):
+        """Cluster the feature vectors with one of the methods of ClusterMethods,
+        and name each cluster by its size and mean (event1, event2)"""
+        self.cluster_labels = calculate_clusters(method, features, n, n_proc=n_proc)
+        self.nclusters = n
+        sizes = [0] * n
+        sums1 = [0.0] * n
+        sums2 = [0.0] * n
+        for x, i in zip(self.blob, self.cluster_labels):
+            if i >= 0:
+                sizes[i] += 1
+                sums1[i] += x[0]
+                sums2[i] += x[1]
+        self.group_names = []
+        for i in range(n):
+            if sizes[i] > 0:
+                self.group_names.append(
+                    f"{sizes[i]} functions: ({event1}) = {sums1[i] / sizes[i]:.3g}, "
+                    f"({event2}) = {sums2[i] / sizes[i]:.3g}"
+                )
+            else:
+                self.group_names.append("0 functions")
+
     def get_cluster_labels(self):
         return self.cluster_labels
 
@@ -80,36 +109,67 @@ class ClusterAnalysis:
 class ClusterFlameGraph:
     def __init__(self):
         self.stack_map = {}
-        self.cluster_data = {}
+        self.cluster_data = FeatureMatrix([])
         self.cluster_labels = {}
         self.cluster_map = {}
+        self.cluster_rows = []
 
-    def add_data(self, cluster_data, cluster_labels, cluster_map):
+    def add_data(self, cluster_data, cluster_labels, cluster_map, cluster_rows):
         self.cluster_data = cluster_data
         self.cluster_labels = cluster_labels
         self.cluster_map = cluster_map
+        self.cluster_rows = cluster_rows
 
     def get_flamegraph_colour_map(self, colours):
         colour_map = {}
-        for job in self.cluster_data:
-            for pid in self.cluster_data[job]:
-                for tid in self.cluster_data[job][pid]:
-                    for s in self.cluster_data[job][pid][tid]:
-                        ci = self.cluster_map[job][pid][tid][s]
+        for job in self.cluster_map:
+            for pid in self.cluster_map[job]:
+                for tid in self.cluster_map[job][pid]:
+                    for node, ci in self.cluster_map[job][pid][tid].items():
                         i = self.cluster_labels[ci]
                         if i >= 0:
                             k = i % len(colours)
                             v = colours[k]
                         else:
                             v = "rgb(224,224,224)"
-                        node = s.rpartition(";")[2]
-                        node += "[[cluster" + str(i) + "]]"
-                        colour_map[node] = v
+                        colour_map[node + "[[cluster" + str(i) + "]]"] = v
         return colour_map
 
+    def get_row_suffixes(
+        self,
+        clusters,
+        append_cluster_labels,
+        event1=None,
+        event2=None,
+        xlower=None,
+        xupper=None,
+        ylower=None,
+        yupper=None,
+    ):
+        """Suffix to append to the stacks of each row of the cluster data, or None
+        for rows which are not in one of the clusters, or are outside the bounds"""
+        suffixes = [None] * self.cluster_data.get_num_rows()
+        clusters = set(clusters)
+        for ci, row in enumerate(self.cluster_rows):
+            i = self.cluster_labels[ci]
+            if i in clusters:
+                if append_cluster_labels:
+                    suffixes[row] = "[[cluster" + str(i) + "]]"
+                else:
+                    suffixes[row] = ""
+        if xlower:
+            in_bounds = set(
+                self.cluster_data.select(event1, event2, xlower, xupper, ylower, yupper)
+            )
+            for row in range(len(suffixes)):
+                if row not in in_bounds:
+                    suffixes[row] = None
+        return suffixes
+
     def make_stack_map(
         self,
         all_stack_data,
+        stack_rows,
         clusters,
         append_cluster_labels,
         event1=None,
@@ -119,51 +179,40 @@ class ClusterFlameGraph:
         ylower=None,
         yupper=None,
     ):
+        """Map the stacks of each selected process id, whose node is in one of the
+        clusters, to the stack with the cluster label appended. stack_rows holds the
+        stacks of each process id, and the row of the cluster data for each stack, or
+        -1 if the node of the stack is not in the cluster data."""
         self.stack_map = {}
+        suffixes = self.get_row_suffixes(
+            clusters,
+            append_cluster_labels,
+            event1=event1,
+            event2=event2,
+            xlower=xlower,
+            xupper=xupper,
+            ylower=ylower,
+            yupper=yupper,
+        )
         for stack_name in all_stack_data:
             self.stack_map[stack_name] = {}
             stack_data = all_stack_data[stack_name]
             ids = stack_data.get_selected_process_ids()
             for process_id in ids:
-                job = process_id.job
-                pid = process_id.pid
-                tid = process_id.tid
-                label = process_id.label
-                event_type = process_id.event_type
-                if event_type == "original":
-                    counts = stack_data.get_original_event_stack_data(process_id)
-                    for stack in counts:
-                        s = re.sub("(([\-0-9]+)/([0-9]+))", "", stack)
-                        s = re.sub(label + ";", "", s)
-                        node = s.rpartition(";")[2]
-                        if node in self.cluster_map[job][pid][tid]:
-                            ci = self.cluster_map[job][pid][tid][node]
-                            i = self.cluster_labels[ci]
-                            if i in clusters:
-                                if xlower:
-                                    count1 = self.cluster_data[job][pid][tid][node][
-                                        event1
-                                    ]
-                                    count2 = self.cluster_data[job][pid][tid][node][
-                                        event2
-                                    ]
-                                    if (
-                                        count1 < ylower
-                                        or count1 > yupper
-                                        or count2 < xlower
-                                        or count2 > xupper
-                                    ):
-                                        continue
-                                if append_cluster_labels:
-                                    new_stack = stack + "[[cluster" + str(i) + "]]"
-                                    self.stack_map[stack_name][stack] = new_stack
-                                else:
-                                    self.stack_map[stack_name][stack] = stack
+                if process_id.event_type == "original":
+                    if process_id.label in stack_rows.get(stack_name, {}):
+                        stacks, rows = stack_rows[stack_name][process_id.label]
+                        self.stack_map[stack_name].update(
+                            (stack, stack + suffixes[row])
+                            for stack, row in zip(stacks, rows)
+                            if row >= 0 and suffixes[row] is not None
+                        )
             stack_data.set_stack_map(self.stack_map[stack_name])
 
 
 class GeneralAnalysis:
-    def __init__(self):
+    def __init__(self, n_proc=1):
+        self.n_proc = n_proc
         self.cluster_analysis = ClusterAnalysis()
         self.cluster_flamegraph = ClusterFlameGraph()
         self.nevents = 0
@@ -171,17 +220,22 @@ class GeneralAnalysis:
         self.events = []
         self.cluster_events = {}
         self.min_base_sample_size = 1
-        self.data = {}
-        self.base_case_offsets = {}
-        self.counter = {}
         self.event_index = {}
-        self.cluster_data = {}
+        self.raw_data = FeatureMatrix([])
+        self.stack_rows = {}
+        self.cluster_data = FeatureMatrix([])
+        self.cluster_rows = []
         self.cluster_map = {}
-        self.base_case_offset = {}
         self.cluster_filter = []
-        self.ncols = 0
-        self.nrows = 0
         self.initialised = False
+        # Keys of the inputs to each stage of the analysis, so that a stage is only
+        # repeated when its inputs have changed
+        self.raw_data_key = None
+        self.cluster_data_key = None
+        self.cluster_key = None
+        self.stack_map_key = None
+        self.correlation_analysis = OrderedDict()
+        self.max_cached_correlation_analysis = 8
 
     def reset_stack_maps(self):
         for stack_data in self.all_stack_data.values():
@@ -189,6 +243,8 @@ class GeneralAnalysis:
 
     def set_events(self, cluster_events):
         self.cluster_events = cluster_events
+        self.events = []
+        self.event_index = {}
         for e in self.cluster_events["All"]:
             label = e
             self.event_index[label] = len(self.event_index)
@@ -207,150 +263,120 @@ class GeneralAnalysis:
         if stack_data.process not in processes:
             self.all_stack_data[process] = stack_data
 
-    def apply_log_scale(self):
-        for job in self.cluster_data:
-            for pid in self.cluster_data[job]:
-                for tid in self.cluster_data[job][pid]:
-                    for node in self.cluster_data[job][pid][tid]:
-                        for e in self.cluster_data[job][pid][tid][node]:
-                            x = self.cluster_data[job][pid][tid][node][e]
-                            if x > 0.0:
-                                self.cluster_data[job][pid][tid][node][e] = log10(x)
-
-    def add_offset(self, reference_process):
-        stack_data = self.all_stack_data[reference_process]
-        base_case_id = stack_data.get_base_case_id()
-        job = base_case_id.job
-        pid = base_case_id.pid
-        tid = base_case_id.tid
-        self.base_case_offset = {}
-        for node in self.cluster_data[job][pid][tid]:
-            if node not in self.base_case_offset:
-                self.base_case_offset[node] = {
-                    e: 0.0 for e in self.cluster_data[job][pid][tid][node]
-                }
-            for e in self.cluster_data[job][pid][tid][node]:
-                self.base_case_offset[node][e] = self.cluster_data[job][pid][tid][node][
-                    e
-                ]
-        for job in self.cluster_data:
-            for pid in self.cluster_data[job]:
-                for tid in self.cluster_data[job][pid]:
-                    for node in self.cluster_data[job][pid][tid]:
-                        if node in self.base_case_offset:
-                            for e in self.cluster_data[job][pid][tid][node]:
-                                offset = self.base_case_offset[node][e]
-                                self.cluster_data[job][pid][tid][node][e] -= offset
-
-    def make_data(self, reference_process, centred=False, log_scale=False):
-        self.data = {}
-        self.reset_stack_maps()
-        for stack_data in self.all_stack_data.values():
+    def get_raw_data_key(self):
+        """Events, time range, text filter and selected ids of the stack data"""
+        key = [
+            tuple(self.cluster_events["All"]),
+            tuple(tuple(r) for r in self.cluster_events["Ratios"]),
+        ]
+        for stack_name, stack_data in self.all_stack_data.items():
+            key.append(
+                (
+                    stack_name,
+                    id(stack_data),
+                    stack_data.start,
+                    stack_data.stop,
+                    stack_data.text_filter,
+                    tuple(p.label for p in stack_data.get_selected_process_ids()),
+                )
+            )
+        return tuple(key)
+
+    def read_raw_data(self):
+        """Sum the event counts of each node, and record the stacks of each process id
+        with the row of the node of each stack, for make_stack_map"""
+        self.raw_data = FeatureMatrix(self.cluster_events["All"])
+        self.stack_rows = {}
+        leaf_nodes = {}
+        for stack_name, stack_data in self.all_stack_data.items():
+            self.stack_rows[stack_name] = {}
             ids = stack_data.get_selected_process_ids()
             for process_id in ids:
-                task_id = process_id.task_id
-                job = process_id.job
-                pid = process_id.pid
-                tid = process_id.tid
-                label = process_id.label
                 raw_event = process_id.raw_event
                 if raw_event in self.cluster_events["All"]:
-                    if job not in self.data:
-                        self.data[job] = {}
-                        self.counter[job] = {}
-                    if pid not in self.data[job]:
-                        self.data[job][pid] = {}
-                        self.counter[job][pid] = {}
-                    if tid not in self.data[job][pid]:
-                        self.data[job][pid][tid] = {}
-                        self.counter[job][pid][tid] = {}
-                    self.counter[job][pid][tid] = stack_data.tasks[
-                        task_id
-                    ].event_counter
                     counts = stack_data.get_original_event_stack_data(process_id)
-                    for stack in counts:
-                        s = re.sub("(([\-0-9]+)/([0-9]+))", "", stack)
-                        s = re.sub(label + ";", "", s)
-                        if s not in self.data[job][pid][tid]:
-                            self.data[job][pid][tid][s] = {
-                                e: 0.0 for e in self.cluster_events["All"]
-                            }
-                        self.data[job][pid][tid][s][raw_event] += counts[stack]
-
-        self.ncols = len(self.cluster_events["Ratios"])
-        self.nrows = 0
-        self.cluster_data = {}
-        for job in self.data:
-            if job not in self.cluster_data:
-                self.cluster_data[job] = {}
-            for pid in self.data[job]:
-                if pid not in self.cluster_data[job]:
-                    self.cluster_data[job][pid] = {}
-                for tid in self.data[job][pid]:
-                    if tid not in self.cluster_data[job][pid]:
-                        self.cluster_data[job][pid][tid] = {}
-                    for s in self.data[job][pid][tid]:
-                        node = s.rpartition(";")[2]
-                        if node not in self.cluster_data[job][pid][tid]:
-                            self.cluster_data[job][pid][tid][node] = {
-                                e: 0.0 for e in self.cluster_events["All"]
-                            }
-                        for e in self.cluster_events["All"]:
-                            v = self.data[job][pid][tid][s][e]
-                            self.cluster_data[job][pid][tid][node][e] += float(v)
-                            self.nrows += 1
-        if len(self.cluster_events["Ratios"]) > 0:
-            for job in self.cluster_data:
-                for pid in self.cluster_data[job]:
-                    for tid in self.cluster_data[job][pid]:
-                        for node in self.cluster_data[job][pid][tid]:
-                            for r in self.cluster_events["Ratios"]:
-                                e1 = r[0]
-                                e2 = r[1]
-                                r1 = self.cluster_data[job][pid][tid][node][e1]
-                                r2 = self.cluster_data[job][pid][tid][node][e2]
-                                v = 0.0
-                                if r2 > 0.0:
-                                    v = r1 / r2
-                                e = e1 + "-divide-" + e2
-                                self.cluster_data[job][pid][tid][node][e] = v
-                                self.nrows += 1
+                    column = self.raw_data.column(raw_event)
+                    stacks = list(counts)
+                    rows = array("l")
+                    for stack in stacks:
+                        leaf = stack.rpartition(";")[2]
+                        if leaf not in leaf_nodes:
+                            leaf_nodes[leaf] = re.sub("(([\-0-9]+)/([0-9]+))", "", leaf)
+                        row = self.raw_data.get_row(
+                            process_id.job, process_id.pid, process_id.tid, leaf_nodes[leaf]
+                        )
+                        column[row] += float(counts[stack])
+                        rows.append(row)
+                    self.stack_rows[stack_name][process_id.label] = (stacks, rows)
+        for r in self.cluster_events["Ratios"]:
+            e1 = r[0]
+            e2 = r[1]
+            self.raw_data.add_ratio(e1, e2, e1 + "-divide-" + e2)
+
+    def make_data(self, reference_process, centred=False, log_scale=False):
+        self.reset_stack_maps()
+        raw_data_key = self.get_raw_data_key()
+        if raw_data_key != self.raw_data_key:
+            self.read_raw_data()
+            self.raw_data_key = raw_data_key
+        base_case_id = None
+        base_case = None
+        if centred:
+            base_case_id = self.all_stack_data[reference_process].get_base_case_id()
+            base_case = base_case_id.label
+        cluster_data_key = (raw_data_key, log_scale, base_case)
+        if cluster_data_key == self.cluster_data_key:
+            return
+        self.cluster_data = self.raw_data.copy()
         if log_scale:
-            self.apply_log_scale()
+            self.cluster_data.apply_log_scale()
         if centred:
-            self.add_offset(reference_process)
+            self.cluster_data.subtract_reference(
+                base_case_id.job, base_case_id.pid, base_case_id.tid
+            )
+        self.cluster_data_key = cluster_data_key
 
     def setup_cluster_analysis(
         self, event1, event2, xlower=None, xupper=None, ylower=None, yupper=None
     ):
-        n = 0
         self.cluster_map = {}
-        self.cluster_analysis.blob = []
-        for job in self.cluster_data:
-            if job not in self.cluster_map:
-                self.cluster_map[job] = {}
-            for pid in self.cluster_data[job]:
-                if pid not in self.cluster_map[job]:
-                    self.cluster_map[job][pid] = {}
-                for tid in self.cluster_data[job][pid]:
-                    if tid not in self.cluster_map[job][pid]:
-                        self.cluster_map[job][pid][tid] = {}
-                    for node in self.cluster_data[job][pid][tid]:
-                        count1 = self.cluster_data[job][pid][tid][node][event1]
-                        count2 = self.cluster_data[job][pid][tid][node][event2]
-                        if xlower:
-                            if (
-                                count1 < ylower
-                                or count1 > yupper
-                                or count2 < xlower
-                                or count2 > xupper
-                            ):
-                                continue
-                        if node not in self.cluster_map[job][pid][tid]:
-                            self.cluster_map[job][pid][tid][node] = n
-                        x = [count1, count2]
-                        self.cluster_analysis.blob.append(x)
-                        n += 1
+        self.cluster_rows = self.cluster_data.select(
+            event1, event2, xlower, xupper, ylower, yupper
+        )
+        column1 = self.cluster_data.column(event1)
+        column2 = self.cluster_data.column(event2)
+        self.cluster_analysis.blob = [
+            [column1[row], column2[row]] for row in self.cluster_rows
+        ]
+        for job, pid, tid in self.cluster_data.threads:
+            self.cluster_map.setdefault(job, {}).setdefault(pid, {})[tid] = {}
+        for n, row in enumerate(self.cluster_rows):
+            job, pid, tid = self.cluster_data.get_thread(row)
+            self.cluster_map[job][pid][tid][self.cluster_data.nodes[row]] = n
+
+    def get_cluster_stack_rows(self):
+        """stack_rows, with the rows of the raw data mapped to the rows of the cluster
+        data by (job, pid, tid, node). The raw data is re-read when the stack data
+        changes, e.g. with a new text filter, but the cluster labels are for the rows
+        of the cluster data they were calculated from"""
+        if self.raw_data.row_index is self.cluster_data.row_index:
+            return self.stack_rows
+        cluster_rows = array(
+            "l",
+            [
+                self.cluster_data.get_rows(*self.raw_data.get_thread(row)).get(node, -1)
+                for row, node in enumerate(self.raw_data.nodes)
+            ],
+        )
+        stack_rows = {}
+        for stack_name, process_rows in self.stack_rows.items():
+            stack_rows[stack_name] = {}
+            for label, (stacks, rows) in process_rows.items():
+                stack_rows[stack_name][label] = (
+                    stacks,
+                    array("l", [cluster_rows[row] for row in rows]),
+                )
+        return stack_rows
 
     def make_stack_map(
         self,
@@ -363,8 +389,33 @@ class GeneralAnalysis:
         ylower=None,
         yupper=None,
     ):
+        raw_data_key = self.get_raw_data_key()
+        if raw_data_key != self.raw_data_key:
+            # Stack data has been re-read since the clusters were calculated,
+            # e.g. with a new text filter
+            self.read_raw_data()
+            self.raw_data_key = raw_data_key
+        stack_map_key = (
+            raw_data_key,
+            self.cluster_key,
+            tuple(clusters),
+            append_cluster_labels,
+            event1,
+            event2,
+            xlower,
+            xupper,
+            ylower,
+            yupper,
+        )
+        if stack_map_key == self.stack_map_key:
+            for stack_name, stack_data in self.all_stack_data.items():
+                stack_data.set_stack_map(
+                    self.cluster_flamegraph.stack_map.get(stack_name, {})
+                )
+            return
         self.cluster_flamegraph.make_stack_map(
             self.all_stack_data,
+            self.get_cluster_stack_rows(),
             clusters,
             append_cluster_labels,
             event1=event1,
@@ -374,19 +425,77 @@ class GeneralAnalysis:
             ylower=ylower,
             yupper=yupper,
         )
+        self.stack_map_key = stack_map_key
 
-    def group_data(self, n, event1, event2, xlower, xupper, ylower, yupper, group_by_log10):
-        self.setup_cluster_analysis(event1, event2, xlower, xupper, ylower, yupper)
-        if group_by_log10:
-            self.cluster_analysis.calculate_log10_groups(event1, event2, n)
-        else:
-            self.cluster_analysis.calculate_ratio_groups(event1, event2, n)
+    def group_data(
+        self,
+        n,
+        event1,
+        event2,
+        xlower,
+        xupper,
+        ylower,
+        yupper,
+        group_by_log10,
+        method="default",
+    ):
         self.cluster_filter = [i for i in range(0, n)]
+        cluster_key = (
+            self.cluster_data_key,
+            n,
+            event1,
+            event2,
+            xlower,
+            xupper,
+            ylower,
+            yupper,
+            group_by_log10,
+            method,
+        )
+        if cluster_key != self.cluster_key:
+            self.setup_cluster_analysis(event1, event2, xlower, xupper, ylower, yupper)
+            if method != "default":
+                features = [
+                    [column[row] for column in self.cluster_data.columns]
+                    for row in self.cluster_rows
+                ]
+                self.cluster_analysis.calculate_clusters(
+                    method, features, event1, event2, n, n_proc=self.n_proc
+                )
+            elif group_by_log10:
+                self.cluster_analysis.calculate_log10_groups(event1, event2, n)
+            else:
+                self.cluster_analysis.calculate_ratio_groups(event1, event2, n)
+            self.cluster_key = cluster_key
         self.cluster_flamegraph.add_data(
-            self.cluster_data, self.cluster_analysis.cluster_labels, self.cluster_map
+            self.cluster_data,
+            self.cluster_analysis.cluster_labels,
+            self.cluster_map,
+            self.cluster_rows,
         )
         self.initialised = True
 
+    def get_correlation_analysis(self, event1, event2):
+        """Correlation matrix of all events across functions, linear fits of event1
+        against event2 for each thread, and the functions with the largest residuals.
+        Results are cached for each selection of data and pair of events."""
+        key = (self.cluster_data_key, event1, event2)
+        if key in self.correlation_analysis:
+            self.correlation_analysis.move_to_end(key)
+        else:
+            correlations = correlation_matrix(self.cluster_data.columns)
+            fits = fit_threads(self.cluster_data, event2, event1)
+            residuals = rank_residuals(self.cluster_data, event2, event1, fits)
+            self.correlation_analysis[key] = (
+                self.cluster_data.events,
+                correlations,
+                fits,
+                residuals,
+            )
+            if len(self.correlation_analysis) > self.max_cached_correlation_analysis:
+                self.correlation_analysis.popitem(last=False)
+        return self.correlation_analysis[key]
+
     def get_stack_data(self):
         return self.all_stack_data
 
@@ -403,27 +512,23 @@ class GeneralAnalysis:
         return self.cluster_analysis.group_names
 
     def get_cluster_data(self):
-        data = {}
+        return self.cluster_data
+
+    def get_cluster_rows(self, job, pid, tid):
+        """Rows of the cluster data for a thread, as a dictionary of node: row,
+        restricted to the nodes in the selected clusters"""
+        rows = self.cluster_data.get_rows(job, pid, tid)
         if len(self.cluster_filter) < self.get_num_clusters():
-            for job in self.cluster_data:
-                data[job] = {}
-                for pid in self.cluster_data[job]:
-                    data[job][pid] = {}
-                    for tid in self.cluster_data[job][pid]:
-                        data[job][pid][tid] = {}
-                        for node in self.cluster_data[job][pid][tid]:
-                            ci = self.cluster_map[job][pid][tid][node]
-                            i = self.cluster_analysis.cluster_labels[ci]
-                            if i in self.cluster_filter:
-                                if node not in self.data:
-                                    data[job][pid][tid][node] = {}
-                                for e in self.cluster_data[job][pid][tid][node]:
-                                    data[job][pid][tid][node][e] = self.cluster_data[
-                                        job
-                                    ][pid][tid][node][e]
-            return data
-        else:
-            return self.cluster_data
+            cluster_map = self.cluster_map.get(job, {}).get(pid, {}).get(tid, {})
+            cluster_labels = self.cluster_analysis.cluster_labels
+            cluster_filter = set(self.cluster_filter)
+            rows = {
+                node: row
+                for node, row in rows.items()
+                if node in cluster_map
+                and cluster_labels[cluster_map[node]] in cluster_filter
+            }
+        return rows
 
     def get_cluster_events(self):
         return self.cluster_events
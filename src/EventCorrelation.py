@@ -0,0 +1,179 @@
+import heapq
+import random
+import re
+from collections import namedtuple
+from math import sqrt
+
+ThreadFit = namedtuple(
+    "ThreadFit", ["thread", "functions", "slope", "intercept", "r2", "residual_std"]
+)
+
+Residual = namedtuple(
+    "Residual", ["function", "thread", "x", "y", "predicted", "residual", "score"]
+)
+
+
+def correlation_matrix(columns, rows=None, max_rows=100000, seed=0):
+    """Pearson correlation of each pair of columns, over the given rows (all rows by
+    default). Inputs with more than max_rows rows are estimated from a random sample.
+    The correlation is zero for columns with no variance."""
+    if rows is None:
+        rows = range(len(columns[0])) if len(columns) > 0 else []
+    rows = list(rows)
+    if len(rows) > max_rows:
+        rows = random.Random(seed).sample(rows, max_rows)
+    n = float(len(rows))
+    deviations = []
+    norms = []
+    for column in columns:
+        values = [column[row] for row in rows]
+        mean = sum(values) / n if n > 0 else 0.0
+        d = [v - mean for v in values]
+        deviations.append(d)
+        norms.append(sqrt(sum(x * x for x in d)))
+    correlations = [[0.0] * len(columns) for _ in columns]
+    for i in range(len(columns)):
+        for j in range(i, len(columns)):
+            if norms[i] > 0.0 and norms[j] > 0.0:
+                c = sum(a * b for a, b in zip(deviations[i], deviations[j]))
+                c /= norms[i] * norms[j]
+            else:
+                c = 0.0
+            correlations[i][j] = c
+            correlations[j][i] = c
+    return correlations
+
+
+def linear_fit(xs, ys):
+    """Least squares fit of y = intercept + slope * x, returning the slope, intercept,
+    coefficient of determination and standard deviation of the residuals"""
+    n = float(len(xs))
+    if n == 0:
+        return 0.0, 0.0, 0.0, 0.0
+    mx = sum(xs) / n
+    my = sum(ys) / n
+    sxx = sum((x - mx) * (x - mx) for x in xs)
+    syy = sum((y - my) * (y - my) for y in ys)
+    sxy = sum((x - mx) * (y - my) for x, y in zip(xs, ys))
+    slope = sxy / sxx if sxx > 0.0 else 0.0
+    intercept = my - slope * mx
+    ss_res = max(syy - slope * sxy, 0.0)
+    r2 = 1.0 - ss_res / syy if syy > 0.0 else 0.0
+    return slope, intercept, r2, sqrt(ss_res / n)
+
+
+def fit_threads(matrix, event_x, event_y):
+    """Linear fit of event_y against event_x over the functions of each thread"""
+    xs = matrix.column(event_x)
+    ys = matrix.column(event_y)
+    fits = []
+    for thread in matrix.threads:
+        rows = list(matrix.row_index[thread].values())
+        slope, intercept, r2, residual_std = linear_fit(
+            [xs[row] for row in rows], [ys[row] for row in rows]
+        )
+        fits.append(ThreadFit(thread, len(rows), slope, intercept, r2, residual_std))
+    return fits
+
+
+def rank_residuals(matrix, event_x, event_y, fits, max_functions=50):
+    """Functions furthest from the fit of their thread, ranked by the residual in
+    units of the standard deviation of the residuals of the thread"""
+    xs = matrix.column(event_x)
+    ys = matrix.column(event_y)
+    residuals = []
+    for fit in fits:
+        for node, row in matrix.row_index[fit.thread].items():
+            predicted = fit.intercept + fit.slope * xs[row]
+            residual = ys[row] - predicted
+            if fit.residual_std > 0.0:
+                score = residual / fit.residual_std
+            else:
+                score = 0.0
+            residuals.append(
+                Residual(node, fit.thread, xs[row], ys[row], predicted, residual, score)
+            )
+    return heapq.nlargest(
+        max_functions, residuals, key=lambda r: (abs(r.score), abs(r.residual))
+    )
+
+
+def escape(text):
+    text = re.sub("&", "&amp;", text)
+    text = re.sub("<", "&lt;", text)
+    return re.sub(">", "&gt;", text)
+
+
+def format_thread(thread):
+    job, pid, tid = thread
+    return "{}-pid:{}-tid:{}".format(job, pid, tid)
+
+
+def generate_correlation_table(event_names, correlations):
+    """Return raw html table of the correlation matrix, shaded by the correlation"""
+    table_html = ["<table>", "<thead>", "<tr>", "<th></th>"]
+    for name in event_names:
+        table_html.append("<th>" + escape(name) + "</th>")
+    table_html += ["</tr>", "</thead>", "<tbody>"]
+    for name, row in zip(event_names, correlations):
+        table_html.append("<tr>")
+        table_html.append("<th>" + escape(name) + "</th>")
+        for c in row:
+            if c >= 0.0:
+                colour = "rgba(0,0,255,{:.2f})".format(0.5 * c)
+            else:
+                colour = "rgba(255,0,0,{:.2f})".format(-0.5 * c)
+            table_html.append(
+                '<td style="background-color:'
+                + colour
+                + '">'
+                + "{:.2f}".format(c)
+                + "</td>"
+            )
+        table_html.append("</tr>")
+    table_html += ["</tbody>", "</table>"]
+    return "".join(table_html)
+
+
+def generate_regression_table(fits, max_rows=200):
+    """Return raw html table of the linear fit for each thread"""
+    headers = ["Thread", "Functions", "Slope", "Intercept", "R2", "Residual Std."]
+    table_html = ["<table>", "<thead>", "<tr>"]
+    for header in headers:
+        table_html.append("<th>" + header + "</th>")
+    table_html += ["</tr>", "</thead>", "<tbody>"]
+    for fit in fits[0:max_rows]:
+        table_html.append("<tr>")
+        table_html.append("<td>" + escape(format_thread(fit.thread)) + "</td>")
+        table_html.append("<td>" + str(fit.functions) + "</td>")
+        for value in [fit.slope, fit.intercept, fit.r2, fit.residual_std]:
+            table_html.append("<td>" + "{:.4g}".format(value) + "</td>")
+        table_html.append("</tr>")
+    table_html += ["</tbody>", "</table>"]
+    return "".join(table_html)
+
+
+def generate_residuals_table(residuals, x_name, y_name):
+    """Return raw html table of the functions with the largest residuals"""
+    headers = [
+        "Function",
+        "Thread",
+        escape(x_name),
+        escape(y_name),
+        "Predicted " + escape(y_name),
+        "Residual",
+        "Residual / Std.",
+    ]
+    table_html = ["<table>", "<thead>", "<tr>"]
+    for header in headers:
+        table_html.append("<th>" + header + "</th>")
+    table_html += ["</tr>", "</thead>", "<tbody>"]
+    for r in residuals:
+        table_html.append("<tr>")
+        table_html.append("<td>" + escape(r.function) + "</td>")
+        table_html.append("<td>" + escape(format_thread(r.thread)) + "</td>")
+        for value in [r.x, r.y, r.predicted, r.residual, r.score]:
+            table_html.append("<td>" + "{:.4g}".format(value) + "</td>")
+        table_html.append("</tr>")
+    table_html += ["</tbody>", "</table>"]
+    return "".join(table_html)
@@ -0,0 +1,109 @@
+from array import array
+from math import log10
+
+
+class FeatureMatrix:
+    """Event counts for each (job, pid, tid, node), stored as one float column per event.
+
+    Rows are mapped back to their thread and node by the threads, thread_ids and nodes
+    arrays, and looked up from a thread and node with row_index[(job, pid, tid)][node].
+    Log scaling, centring, ratio derivation and filtering operate on whole columns."""
+
+    def __init__(self, events):
+        self.events = []
+        self.event_index = {}
+        self.columns = []
+        self.threads = []
+        self.thread_ids = array("l")
+        self.nodes = []
+        self.row_index = {}
+        for event in events:
+            self.add_column(event)
+
+    def copy(self):
+        matrix = FeatureMatrix([])
+        matrix.events = list(self.events)
+        matrix.event_index = dict(self.event_index)
+        matrix.columns = [array("d", column) for column in self.columns]
+        matrix.threads = self.threads
+        matrix.thread_ids = self.thread_ids
+        matrix.nodes = self.nodes
+        matrix.row_index = self.row_index
+        return matrix
+
+    def get_num_rows(self):
+        return len(self.nodes)
+
+    def add_column(self, event, values=None):
+        if event in self.event_index:
+            column = self.columns[self.event_index[event]]
+        else:
+            self.event_index[event] = len(self.events)
+            self.events.append(event)
+            column = array("d")
+            self.columns.append(column)
+        if values is None:
+            values = [0.0] * self.get_num_rows()
+        column[:] = array("d", values)
+
+    def column(self, event):
+        return self.columns[self.event_index[event]]
+
+    def get_row(self, job, pid, tid, node):
+        """Row for a thread and node, created with zero counts on first use"""
+        thread = (job, pid, tid)
+        if thread not in self.row_index:
+            self.row_index[thread] = {}
+            self.threads.append(thread)
+        rows = self.row_index[thread]
+        if node not in rows:
+            rows[node] = len(self.nodes)
+            self.thread_ids.append(len(self.threads) - 1)
+            self.nodes.append(node)
+            for column in self.columns:
+                column.append(0.0)
+        return rows[node]
+
+    def get_rows(self, job, pid, tid):
+        """Rows of a thread, as a dictionary of node: row"""
+        return self.row_index.get((job, pid, tid), {})
+
+    def get_thread(self, row):
+        return self.threads[self.thread_ids[row]]
+
+    def add_ratio(self, event1, event2, label):
+        """Add column for event1 / event2, which is zero where event2 is zero"""
+        values = [
+            r1 / r2 if r2 > 0.0 else 0.0
+            for r1, r2 in zip(self.column(event1), self.column(event2))
+        ]
+        self.add_column(label, values)
+
+    def apply_log_scale(self):
+        for column in self.columns:
+            column[:] = array("d", [log10(x) if x > 0.0 else x for x in column])
+
+    def subtract_reference(self, job, pid, tid):
+        """Subtract the counts of the reference thread from the rows with the same node"""
+        reference_rows = self.get_rows(job, pid, tid)
+        offset_rows = [reference_rows.get(node) for node in self.nodes]
+        for column in self.columns:
+            offsets = [column[r] if r is not None else 0.0 for r in offset_rows]
+            column[:] = array("d", [x - dx for x, dx in zip(column, offsets)])
+
+    def select(
+        self, event1, event2, xlower=None, xupper=None, ylower=None, yupper=None
+    ):
+        """Rows with event1 in [ylower, yupper] and event2 in [xlower, xupper]"""
+        if not xlower:
+            return array("l", range(self.get_num_rows()))
+        return array(
+            "l",
+            [
+                row
+                for row, (y, x) in enumerate(
+                    zip(self.column(event1), self.column(event2))
+                )
+                if ylower <= y <= yupper and xlower <= x <= xupper
+            ],
+        )
@@ -21,3 +21,6 @@ perf_events = ""
 enabled_modes = {}
 debug = False
 n_proc = 4
+max_jobs = 4
+max_jobs_per_host = 1
+job_queue = None
@@ -4,7 +4,7 @@ import pathlib
 import os
 from pathlib import Path
 from lxml import etree
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
 
 from src.ColourMaps import get_top_ten_colours
 
@@ -87,6 +87,8 @@ class SourceTree:
         self.process_id = process_id
         self.nodes = {}
         self.file_map = defaultdict(set)
+        self.exclusive_values = {}
+        self.inclusive_values = {}
         root_name = "root"
         root_id = node_id = Node.get_node_id(root_name, 0, 0)
         self.root = Node("root", root_id, 0)
@@ -119,25 +121,33 @@ class SourceTree:
                     parent = old_node
         for child in self.root.children:
             self.root.inclusive += child.inclusive
-
-    def get_exclusive_value(self, frame, node=None):
-        node = node if node is not None else self.root
-        exclusive_value = 0
-        if node.frame == frame:
-            exclusive_value += node.exclusive
-        for child in node.children:
-            exclusive_value += self.get_exclusive_value(frame, child)
-        return exclusive_value
-
-    def get_inclusive_value(self, frame, node=None):
-        node = node if node is not None else self.root
-        inclusive_value = 0
-        if node.frame == frame:
-            inclusive_value += node.inclusive
-            return inclusive_value
-        for child in node.children:
-            inclusive_value += self.get_inclusive_value(frame, child)
-        return inclusive_value
+        self.index_frame_values()
+
+    def index_frame_values(self):
+        """Sum the exclusive and inclusive values of all nodes for each frame. For a
+        recursive frame, only the outermost node on each path adds to the inclusive value,
+        as its inclusive value already contains the nodes below it"""
+        self.exclusive_values = defaultdict(int)
+        self.inclusive_values = defaultdict(int)
+        frames_on_path = defaultdict(int)
+        nodes = [(self.root, False)]
+        while nodes:
+            node, visited = nodes.pop()
+            if visited:
+                frames_on_path[node.frame] -= 1
+                continue
+            self.exclusive_values[node.frame] += node.exclusive
+            if frames_on_path[node.frame] == 0:
+                self.inclusive_values[node.frame] += node.inclusive
+            frames_on_path[node.frame] += 1
+            nodes.append((node, True))
+            nodes.extend((child, False) for child in reversed(node.children))
+
+    def get_exclusive_value(self, frame):
+        return self.exclusive_values.get(frame, 0)
+
+    def get_inclusive_value(self, frame):
+        return self.inclusive_values.get(frame, 0)
 
     def get_total_value(self):
         return self.root.inclusive
@@ -231,6 +241,10 @@ class HPCResultsHandler:
 
 
 class HPCExperiment:
+    """Converts an HPCToolkit experiment.xml to collapsed stacks files. The experiment is
+    streamed with iterparse, keeping only the elements on the current call path, so
+    that the size of the experiment is not limited by memory."""
+
     def __init__(self, results_dir, job_id):
         self.results_dir = results_dir
         self.job_id = job_id
@@ -241,130 +255,190 @@ class HPCExperiment:
         self.experiment_file = None
         self.include_loops = True
         self.include_statements = False
-        self.experiment_tree = None
         self.frames = {}
         self.metrics = {}
-        self.results_files = {}
+        self.results_files = []
         self.color_map = {}
         self.header = ""
-        self.metric_info = None
-        self.parser = etree.XMLParser(
-            huge_tree=True
-        )  # Nesting level can be excessively high!
+        self.metric_info = {}
 
     def read_experiment(
         self, experiment_file, include_loops=True, include_statements=False
     ):
+        """Read the header and the metric, procedure and file tables, which come before
+        the call path profile data"""
         self.experiment_file = experiment_file
         self.include_loops = include_loops
         self.include_statements = include_statements
-        self.experiment_tree = etree.parse(experiment_file, parser=self.parser)
-        self.procedure_map = self.get_procedure_names(self.experiment_tree)
-        self.file_map = self.get_file_names(self.experiment_tree)
+        self.header = None
+        self.metric_info = {}
+        self.procedure_map = {}
+        self.file_map = {}
+        tables = {"MetricTable": None, "ProcedureTable": None, "FileTable": None}
+        path = []
+        with open(experiment_file, "rb") as f:
+            for event, elt in etree.iterparse(
+                f, events=("start", "end"), huge_tree=True
+            ):
+                if event == "start":
+                    if elt.tag == "SecCallPathProfileData":
+                        break
+                    if elt.tag == "Header" and self.header is None:
+                        self.header = elt.attrib["n"]
+                    if elt.tag in tables and tables[elt.tag] is None:
+                        tables[elt.tag] = elt
+                    path.append(elt)
+                    continue
+                path.pop()
+                parent = path[-1] if path else None
+                if elt.tag == "Metric" and parent is tables["MetricTable"]:
+                    self.add_metric_info(elt)
+                elif elt.tag == "Procedure" and parent is tables["ProcedureTable"]:
+                    self.procedure_map[elt.attrib["i"]] = elt.attrib["n"]
+                elif elt.tag == "File" and parent is tables["FileTable"]:
+                    self.file_map[elt.attrib["i"]] = elt.attrib["n"]
+                if elt.tag in ("Metric", "Procedure", "File"):
+                    elt.clear()
+
+    def add_metric_info(self, metric_element):
+        period = "1"
+        for elt in metric_element.iter():
+            if "n" in elt.attrib:
+                n = elt.attrib["n"]
+                if n == "period":
+                    period = elt.attrib["v"]
+        n = metric_element.attrib["n"]
+        i = metric_element.attrib["i"]
+        n = re.sub(":", "-", n)  # avoid filename with colons
+        n = re.sub(" ", "-", n)  # avoid filename with spaces
+        match = re.match("[0-9\.]*(.*)\.\[([0-9]+),([0-9]+)\]", n)
+        if match:
+            metric = match.group(1)
+            process = match.group(2)
+            thread = match.group(3)
+        else:
+            metric = n
+            process = "0"
+            thread = "0"
+        self.metric_info[i] = (metric, process, thread, period)
+        self.metric_to_results_map[i] = self.get_results_file_name(metric, process)
 
     def process_experiment(self):
+        self.convert_experiment()
+        self.write_file_map()
+
+    def convert_experiment(self):
+        """Stream the call path profile data, writing the stacks of each metric to the
+        results files as they are found"""
         self.frames = {}
         self.metrics = {}
-        self.results_files = {}
-        self.header = self.find_header()
-        self.metric_info = self.find_metric_info()
+        self.color_map = {}
+        results_files = OrderedDict()
         colors = get_top_ten_colours()
         previous_stack_trace = {}
         current_stack_trace = {}
-        self.color_map = {}
         current_count = {}
         current_stack = [""]
-        walk_experiment = self.experiment_tree.getiterator()
-        for elt in walk_experiment:
-            node_level = self.get_node_level(elt)
-            if node_level < len(current_stack):
-                n = len(current_stack) - node_level
-                del current_stack[-n:]
-            if elt.tag == "PF" or elt.tag == "Pr":
-                name = elt.attrib["n"]
-                p_name = self.procedure_map[name]
-                if p_name == "":
+        path = []  # (element, node level, procedure name) for each open element
+        with open(self.experiment_file, "rb") as f:
+            for event, elt in etree.iterparse(
+                f, events=("start", "end"), huge_tree=True
+            ):
+                if event == "end":
+                    # Elements below the current call path are no longer needed
+                    path.pop()
+                    elt.clear()
+                    if path:
+                        del path[-1][0][:-1]
                     continue
-                if node_level == len(current_stack):
-                    current_stack[-1] = p_name
-                else:
-                    current_stack.append(p_name)
-                frame = current_stack[-1]
-                frame = re.sub(" ", "", frame)
-                if frame not in self.frames:
-                    self.frames[frame] = self.unwind_frame_details(elt, self.file_map)
-            elif self.include_statements and elt.tag == "C":
-                line = elt.attrib["l"]
-                unique_id = "Call@" + str(line) + "@" + current_stack[-1]
-                current_stack.append(unique_id)
-                frame = current_stack[-1]
-                frame = re.sub(" ", "", frame)
-                if frame not in self.frames:
-                    self.frames[frame] = self.unwind_frame_details(elt, self.file_map)
-            elif self.include_loops and elt.tag == "L":
-                line = elt.attrib["l"]
-                p_name = self.get_procedure_name(elt, self.procedure_map)
-                unique_id = "Loop@" + str(line) + "@" + p_name
-                self.color_map[unique_id] = colors[8]
-                if node_level == len(current_stack):
-                    current_stack[-1] = unique_id
-                else:
-                    current_stack.append(unique_id)
-                frame = current_stack[-1]
-                frame = re.sub(" ", "", frame)
-                if frame not in self.frames:
-                    self.frames[frame] = self.unwind_frame_details(elt, self.file_map)
-            elif self.include_statements and elt.tag == "S":
-                line = elt.attrib["l"]
-                p_name = self.get_procedure_name(elt, self.procedure_map)
-                unique_id = "Line@" + str(line) + "@" + p_name
-                self.color_map[unique_id] = colors[0]
-                if node_level == len(current_stack):
-                    current_stack[-1] = unique_id
-                else:
+                node_level, p_name = self.get_node_info(elt, path)
+                path.append((elt, node_level, p_name))
+                if node_level < len(current_stack):
+                    n = len(current_stack) - node_level
+                    del current_stack[-n:]
+                if elt.tag == "PF" or elt.tag == "Pr":
+                    if p_name == "":
+                        continue
+                    if node_level == len(current_stack):
+                        current_stack[-1] = p_name
+                    else:
+                        current_stack.append(p_name)
+                    frame = current_stack[-1]
+                    frame = re.sub(" ", "", frame)
+                    if frame not in self.frames:
+                        self.frames[frame] = self.unwind_frame_details(path)
+                elif self.include_statements and elt.tag == "C":
+                    line = elt.attrib["l"]
+                    unique_id = "Call@" + str(line) + "@" + current_stack[-1]
                     current_stack.append(unique_id)
-                frame = current_stack[-1]
-                frame = re.sub(" ", "", frame)
-                if frame not in self.frames:
-                    self.frames[frame] = self.unwind_frame_details(elt, self.file_map)
-            elif elt.tag == "M":
-                n = elt.attrib["n"]
-                if n in self.metric_info:
-                    stack_trace = ";".join(current_stack[1:])
-                    stack_trace = re.sub(" ", "", stack_trace)
-                    metric_info = self.metric_info[n]
-                    metric = metric_info[0]
-                    process = metric_info[1]
-                    thread = metric_info[2]
-                    period = metric_info[3]
-                    unique_id = (metric, process, thread)
-                    if unique_id not in current_count:
-                        current_count[unique_id] = 0
-                        previous_stack_trace[unique_id] = stack_trace
-                    current_stack_trace[unique_id] = stack_trace
-                    if (
-                        current_count[unique_id] > 0
-                        and current_stack_trace[unique_id]
-                        != previous_stack_trace[unique_id]
-                    ):
-                        if metric not in self.metrics:
-                            self.metrics[metric] = period
-                        out = "{}-{}/{};{} {}\n".format(
-                            self.header,
-                            process,
-                            thread,
-                            previous_stack_trace[unique_id],
-                            str(current_count[unique_id]),
-                        )
-                        filename = self.get_results_file_name(metric, process)
-                        if filename not in self.results_files:
-                            self.results_files[filename] = open(filename, "wb")
-                            self.results_files[filename].write("t=0.00\n".encode())
-                        self.results_files[filename].write(out.encode())
-                        current_count[unique_id] = 0
-                        previous_stack_trace[unique_id] = current_stack_trace[unique_id]
-                    total = int(round(float(elt.attrib["v"])))
-                    current_count[unique_id] += total
+                    frame = current_stack[-1]
+                    frame = re.sub(" ", "", frame)
+                    if frame not in self.frames:
+                        self.frames[frame] = self.unwind_frame_details(path)
+                elif self.include_loops and elt.tag == "L":
+                    line = elt.attrib["l"]
+                    unique_id = "Loop@" + str(line) + "@" + p_name
+                    self.color_map[unique_id] = colors[8]
+                    if node_level == len(current_stack):
+                        current_stack[-1] = unique_id
+                    else:
+                        current_stack.append(unique_id)
+                    frame = current_stack[-1]
+                    frame = re.sub(" ", "", frame)
+                    if frame not in self.frames:
+                        self.frames[frame] = self.unwind_frame_details(path)
+                elif self.include_statements and elt.tag == "S":
+                    line = elt.attrib["l"]
+                    unique_id = "Line@" + str(line) + "@" + p_name
+                    self.color_map[unique_id] = colors[0]
+                    if node_level == len(current_stack):
+                        current_stack[-1] = unique_id
+                    else:
+                        current_stack.append(unique_id)
+                    frame = current_stack[-1]
+                    frame = re.sub(" ", "", frame)
+                    if frame not in self.frames:
+                        self.frames[frame] = self.unwind_frame_details(path)
+                elif elt.tag == "M":
+                    n = elt.attrib["n"]
+                    if n in self.metric_info:
+                        stack_trace = ";".join(current_stack[1:])
+                        stack_trace = re.sub(" ", "", stack_trace)
+                        metric_info = self.metric_info[n]
+                        metric = metric_info[0]
+                        process = metric_info[1]
+                        thread = metric_info[2]
+                        period = metric_info[3]
+                        unique_id = (metric, process, thread)
+                        if unique_id not in current_count:
+                            current_count[unique_id] = 0
+                            previous_stack_trace[unique_id] = stack_trace
+                        current_stack_trace[unique_id] = stack_trace
+                        if (
+                            current_count[unique_id] > 0
+                            and current_stack_trace[unique_id]
+                            != previous_stack_trace[unique_id]
+                        ):
+                            if metric not in self.metrics:
+                                self.metrics[metric] = period
+                            out = "{}-{}/{};{} {}\n".format(
+                                self.header,
+                                process,
+                                thread,
+                                previous_stack_trace[unique_id],
+                                str(current_count[unique_id]),
+                            )
+                            filename = self.get_results_file_name(metric, process)
+                            if filename not in results_files:
+                                results_files[filename] = open(filename, "wb")
+                                results_files[filename].write("t=0.00\n".encode())
+                            results_files[filename].write(out.encode())
+                            current_count[unique_id] = 0
+                            previous_stack_trace[unique_id] = current_stack_trace[
+                                unique_id
+                            ]
+                        total = int(round(float(elt.attrib["v"])))
+                        current_count[unique_id] += total
         for unique_id in current_stack_trace:
             metric = unique_id[0]
             process = unique_id[1]
@@ -380,13 +454,39 @@ class HPCExperiment:
                 if metric not in self.metrics:
                     self.metrics[metric] = period
                 filename = self.get_results_file_name(metric, process)
-                if filename not in self.results_files:
-                    self.results_files[filename] = open(filename, "wb")
-                    self.results_files[filename].write(out.encode())
-        for filename in self.results_files:
-            self.results_files[filename].write("t=1.00\n".encode())
-            self.results_files[filename].close()
-        self.write_file_map()
+                if filename not in results_files:
+                    results_files[filename] = open(filename, "wb")
+                    results_files[filename].write(out.encode())
+        for filename in results_files:
+            results_files[filename].write("t=1.00\n".encode())
+            results_files[filename].close()
+        self.results_files = list(results_files)
+
+    def get_node_info(self, elt, path):
+        """Node level of an element, counting the frames from SecCallPathProfileData,
+        and the name of the procedure containing it"""
+        if path:
+            _, parent_level, p_name = path[-1]
+        else:
+            parent_level, p_name = sys.maxsize, None
+        if elt.tag == "PF" or elt.tag == "Pr":
+            p_name = self.procedure_map[elt.attrib["n"]]
+        if elt.tag == "SecCallPathProfileData":
+            node_level = 1
+        elif parent_level == sys.maxsize:
+            node_level = sys.maxsize
+        elif (
+            (elt.tag == "PF" or elt.tag == "Pr")
+            and elt.attrib["n"] != ""
+            or self.include_statements
+            and elt.tag in ("C", "S")
+            or self.include_loops
+            and elt.tag == "L"
+        ):
+            node_level = parent_level + 1
+        else:
+            node_level = parent_level
+        return node_level, p_name
 
     def write_file_map(self):
         filename = os.path.join(self.results_dir, self.job_id) + ".frames"
@@ -406,10 +506,6 @@ class HPCExperiment:
     def get_color_map(self):
         return self.color_map
 
-    def find_header(self):
-        root = self.experiment_tree.getroot()
-        return root.find(".//Header").attrib["n"]
-
     def get_header(self):
         return self.header
 
@@ -431,85 +527,21 @@ class HPCExperiment:
     def get_metrics(self):
         return self.metrics
 
-    def find_metric_info(self):
-        root = self.experiment_tree.getroot()
-        pt = root.find(".//MetricTable")
-        metric_info = {}
-        for f in pt.findall("Metric"):
-            it = f.getiterator()
-            period = "1"
-            for elt in it:
-                if "n" in elt.attrib:
-                    n = elt.attrib["n"]
-                    if n == "period":
-                        period = elt.attrib["v"]
-            n = f.attrib["n"]
-            i = f.attrib["i"]
-            n = re.sub(":", "-", n)  # avoid filename with colons
-            n = re.sub(" ", "-", n)  # avoid filename with spaces
-            match = re.match("[0-9\.]*(.*)\.\[([0-9]+),([0-9]+)\]", n)
-            if match:
-                metric = match.group(1)
-                process = match.group(2)
-                thread = match.group(3)
-                metric_info[i] = (metric, process, thread, period)
-                filename = self.get_results_file_name(metric, process)
-                self.metric_to_results_map[i] = filename
-            else:
-                metric = n
-                process = "0"
-                thread = "0"
-                metric_info[i] = (metric, process, thread, period)
-                filename = self.get_results_file_name(metric, process)
-                self.metric_to_results_map[i] = filename
-        return metric_info
-
-    @staticmethod
-    def get_file_names(experiment_tree):
-        file_map = {}
-        root = experiment_tree.getroot()
-        pt = root.find(".//FileTable")
-        for f in pt.findall("File"):
-            i = f.attrib["i"]
-            n = f.attrib["n"]
-            file_map[i] = n
-        return file_map
-
-    @staticmethod
-    def get_procedure_names(experiment_tree):
-        procedure_map = {}
-        root = experiment_tree.getroot()
-        pt = root.find(".//ProcedureTable")
-        for f in pt.findall("Procedure"):
-            i = f.attrib["i"]
-            n = f.attrib["n"]
-            procedure_map[i] = n
-        return procedure_map
-
-    @staticmethod
-    def get_procedure_name(node, procedure_map):
-        nd = node
-        while nd is not None:
-            if nd.tag == "PF" or nd.tag == "Pr":
-                name = nd.attrib["n"]
-                return procedure_map[name]
-            nd = nd.getparent()
-
     def get_file_info(self, frame):
         return self.frames[frame]
 
-    def unwind_frame_details(self, node, file_map):
-        nd = node
+    def unwind_frame_details(self, path):
+        """File and line of the element at the end of the path"""
         line = None
         file = None
-        while nd is not None:
+        for nd, _, _ in reversed(path):
             if nd.tag == "PF" or nd.tag == "Pr":
                 name = nd.attrib["n"]
                 p_name = self.procedure_map[name]
                 if p_name == "":
                     continue
                 f = nd.attrib["f"]
-                file = file_map[f]
+                file = self.file_map[f]
                 if not line:
                     line = nd.attrib["l"]
             elif self.include_statements and nd.tag == "C":
@@ -517,30 +549,10 @@ class HPCExperiment:
                     line = nd.attrib["l"]
             elif self.include_loops and nd.tag == "L":
                 f = nd.attrib["f"]
-                file = file_map[f]
+                file = self.file_map[f]
                 if not line:
                     line = nd.attrib["l"]
             elif self.include_statements and nd.tag == "S":
                 line = nd.attrib["l"]
             if line and file:
                 return file, line
-            nd = nd.getparent()
-
-    def get_node_level(self, node):
-        d = 1
-        nd = node
-        while nd is not None:
-            if nd.tag == "PF" or nd.tag == "Pr":
-                name = nd.attrib["n"]
-                if nd.attrib["n"] != "":
-                    d += 1
-            elif self.include_statements and nd.tag == "C":
-                d += 1
-            elif self.include_loops and nd.tag == "L":
-                d += 1
-            elif self.include_statements and nd.tag == "S":
-                d += 1
-            if nd.tag == "SecCallPathProfileData":
-                return d
-            nd = nd.getparent()
-        return sys.maxsize
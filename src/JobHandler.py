@@ -7,6 +7,8 @@ import subprocess
 import pathlib
 import socket
 import logging
+import tarfile
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 
 import paramiko
 from paramiko import BadHostKeyException, AuthenticationException, SSHException
@@ -15,11 +17,20 @@ from src.CustomLogging import setup_basic_logger
 from src.Utilities import purge
 import src.GlobalData as GlobalData
 from src.ResultsHandler import (
-    modify_process_ids,
+    get_manifest,
     modify_system_wide_process_ids,
     replace_results_file,
 )
 
+# Number of compressed archives, each pulled over its own sftp channel, used to
+# copy results from a remote host
+n_transfer_channels = 4
+# Shared ssh clients, by (hostname, port, username), with the interval (s) of keepalive
+# messages sent to keep idle connections open
+ssh_clients = {}
+ssh_clients_lock = threading.Lock()
+ssh_keepalive = 30
+
 
 def get_lsf_params(
     lsf_params=None, lib_path=None, preload=None, env_variables=None, bin_path=None
@@ -148,15 +159,18 @@ def get_stack_collapse_command(
     system_wide,
     multiplier,
     trace_event=None,
+    process_id=0,
 ):
     """Return command line for python scrript StackCollapse.py. This is used
     to process the output from running the perf script command, to produce the
-    collapsed stack data"""
+    collapsed stack data, with sequential process and thread ids"""
     command = "python {} --pid --tid --input_file={} --output_file={} --dt={} --multiplier={}".format(
         stack_collapse_script, in_file, out_file, dt, multiplier
     )
     if system_wide:
         command += " --accumulate"  # Include accumulation of sample counts over threads and processes
+    else:
+        command += " --process_id={}".format(process_id)
     if trace_event is not None:
         command += (
             " --trace_event=" + trace_event
@@ -165,6 +179,89 @@ def get_stack_collapse_command(
     return command
 
 
+def get_ssh_address(job_settings):
+    """(hostname, port, username) of the server of job_settings"""
+    hostname = job_settings.server
+    port = 22
+    match = re.match("(.+):([0-9]+)", hostname)
+    if match:
+        hostname = match.group(1)
+        port = int(match.group(2))
+    return hostname, port, job_settings.username
+
+
+def connect_ssh_client(job_settings):
+    """New ssh client, connected to the server of job_settings"""
+    hostname, port, username = get_ssh_address(job_settings)
+    client = paramiko.SSHClient()
+    client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+    try:
+        if len(job_settings.private_key) > 0:
+            key = paramiko.RSAKey.from_private_key_file(job_settings.private_key)
+            client.connect(hostname, port=port, username=username, pkey=key)
+        else:
+            client.connect(
+                hostname, port=port, username=username, password=job_settings.password
+            )
+    except Exception:
+        client.close()
+        raise
+    client.get_transport().set_keepalive(ssh_keepalive)
+    return client
+
+
+def is_active_ssh_client(client):
+    transport = client.get_transport()
+    if transport is None or not transport.is_active():
+        return False
+    try:
+        transport.send_ignore()
+    except (SSHException, socket.error):
+        return False
+    return True
+
+
+def get_ssh_client(job_settings):
+    """Connected ssh client for the server of job_settings, shared between jobs and
+    reused while the connection is active"""
+    address = get_ssh_address(job_settings)
+    with ssh_clients_lock:
+        client = ssh_clients.get(address)
+    if client is not None:
+        if is_active_ssh_client(client):
+            return client
+        with ssh_clients_lock:
+            if ssh_clients.get(address) is client:
+                del ssh_clients[address]
+        client.close()
+    # Connect without holding the lock, so that a slow server does not block the
+    # clients of other servers
+    return add_ssh_client(address, connect_ssh_client(job_settings))
+
+
+def add_ssh_client(address, client):
+    """Share client for address. If another client was connected in the meantime,
+    and is still active, client is closed and the other client is returned"""
+    with ssh_clients_lock:
+        shared_client = ssh_clients.get(address)
+        if shared_client is not None and shared_client is not client:
+            transport = shared_client.get_transport()
+            if transport is not None and transport.is_active():
+                client.close()
+                return shared_client
+            shared_client.close()
+        ssh_clients[address] = client
+        return client
+
+
+def close_ssh_client(job_settings):
+    """Close and remove the shared ssh client for the server of job_settings"""
+    with ssh_clients_lock:
+        client = ssh_clients.pop(get_ssh_address(job_settings), None)
+        if client is not None:
+            client.close()
+
+
 class Job:
     """Object representing a perf job submission"""
 
@@ -222,9 +319,10 @@ class JobHandler:
     threads to allow processing of multiple jobs in the background.
     Job submission can be remote, using ssh, or local"""
 
-    def __init__(self, root_directory, job=None):
+    def __init__(self, root_directory, job=None, job_queue=None):
         self.root_directory = root_directory
         self.job = job
+        self.job_queue = job_queue
         self.stack_collapse_script = "StackCollapse.py"
         log_file = os.path.join(GlobalData.local_data, "scriptwriting.log")
         setup_basic_logger("scriptwriting_logger", log_file, debug=GlobalData.debug)
@@ -238,27 +336,42 @@ class JobHandler:
         purge(local_data, job_settings.job_name + ".done")
         self.scriptwriting_logger.info(u" Write perf script")
         perf_script = self.write_perf_script(local_data)
-        self.scriptwriting_logger.info(u" Setup background threads")
         working_dir = job_settings.working_directory_linux
+        args = (
+            working_dir,
+            self.job.use_ssh,
+            self.job.job_id,
+            local_data,
+            perf_script,
+            self.job.system_wide,
+            self.job.mpi_config_files,
+            job_settings,
+        )
         try:
-            background_thread = threading.Thread(
-                target=self.run_perf_job,
-                args=(
-                    working_dir,
-                    self.job.use_ssh,
-                    self.job.job_id,
-                    local_data,
-                    perf_script,
-                    self.job.system_wide,
-                    self.job.mpi_config_files,
-                    job_settings,
-                ),
-            )
-            background_thread.daemon = True
-            background_thread.start()
+            if self.job_queue:
+                self.scriptwriting_logger.info(u" Queue job")
+                if self.job.use_ssh:
+                    host = get_ssh_address(job_settings)[0]
+                else:
+                    host = "localhost"
+                self.job_queue.submit(self.job.job_id, host, self.run_perf_job, args)
+            else:
+                self.scriptwriting_logger.info(u" Setup background threads")
+                background_thread = threading.Thread(
+                    target=self.run_perf_job, args=args
+                )
+                background_thread.daemon = True
+                background_thread.start()
         except Exception as e:
             raise Exception(str(e))
 
+    def set_job_state(self, job_id, state):
+        """Update the state of a queued job. Returns False if the job has been
+        cancelled"""
+        if self.job_queue is None:
+            return True
+        return self.job_queue.set_state(job_id, state)
+
     def execute_command(self, command, client=None, return_output=False):
         """Execute a command from the command line
 
@@ -292,6 +405,31 @@ class JobHandler:
             if return_output:
                 return stdout
 
+    def execute_commands(self, commands, client=None):
+        """Execute independent commands. Remote commands are run concurrently, each
+        on its own channel of the ssh connection, and local commands in order.
+
+            Args:
+                commands: command lines to run.
+                client: ssh client used to execute remote commands. Defaults to no
+                    client, to run commands locally."""
+        if client is None:
+            for command in commands:
+                self.execute_command(command)
+            return
+        running = []
+        for command in commands:
+            self.scriptwriting_logger.debug(u" Submitted remote command: " + command)
+            running.append((command, client.exec_command(command)))
+        for command, (stdin, stdout, stderr) in running:
+            exit_status = stdout.channel.recv_exit_status()
+            if exit_status > 0:
+                self.scriptwriting_logger.error(
+                    u" Command error: " + "".join(stderr.readlines())
+                )
+            else:
+                self.scriptwriting_logger.info(u" Executed command: " + command)
+
     def get_file(self, remotefile, localfile, stfp=None):
         """Copy a file from remote file to local file.
 
@@ -322,6 +460,85 @@ class JobHandler:
             else:
                 self.scriptwriting_logger.info(u" Copy successful")
 
+    def get_compressed_files(
+        self, working_directory, job_id, files, local_dir, client=None, stfp=None
+    ):
+        """Copy the results files of a job from the working directory to a local
+        directory. The files are compressed into archives in the working directory,
+        which are copied in parallel, over separate sftp channels, and extracted as
+        they are read. Any files missing from the archives are copied one at a time.
+
+            Args:
+                working_directory: absolute path to the directory of the job.
+                job_id: name of the job, with the files listed in job_id.results.
+                files: names of the files to copy.
+                local_dir: path to the directory of the copied files.
+                client: ssh client used to create and open the archives. Defaults
+                    to no client, which creates and opens the archives locally.
+                stfp: sftp client used to copy any missing files."""
+        n_archives = min(n_transfer_channels, len(files))
+        if n_archives == 0:
+            return
+        archives = [
+            working_directory + "/" + job_id + "_results" + str(n) + ".tar.gz"
+            for n in range(n_archives)
+        ]
+        # Archive n holds every n_archives'th file listed in the results file
+        command = (
+            "cd {}; for n in $(seq 0 {}); do "
+            "grep -v -E '^(event_counter|time_interval|cpu_id|system_wide)' {} | "
+            "awk -v n=$n 'NR % {} == n' | tar -czf {}_results$n.tar.gz -T - & "
+            "done; wait"
+        ).format(
+            working_directory,
+            n_archives - 1,
+            job_id + ".results",
+            n_archives,
+            job_id,
+        )
+        self.execute_command(command, client)
+        received = set()
+        with ThreadPoolExecutor(n_archives) as pool:
+            for names in pool.map(
+                lambda archive: self.extract_archive(archive, local_dir, client),
+                archives,
+            ):
+                received.update(names)
+        self.execute_command("rm -f " + " ".join(archives), client)
+        for file in files:
+            if file not in received:
+                remotefile = working_directory + "/" + file
+                self.get_file(remotefile, os.path.join(local_dir, file), stfp)
+
+    def extract_archive(self, archive, local_dir, client=None):
+        """Extract the files of a compressed archive, as it is read, into local_dir.
+        Returns the names of the extracted files"""
+        self.scriptwriting_logger.info(u" Copying: " + archive + " -> " + local_dir)
+        names = []
+        stfp = None
+        try:
+            if client is None:
+                remote = open(archive, "rb")
+            else:
+                stfp = client.open_sftp()
+                remote = stfp.open(archive, "rb")
+                remote.prefetch()
+            with remote, tarfile.open(fileobj=remote, mode="r|gz") as tar:
+                for member in tar:
+                    if member.isfile():
+                        name = os.path.basename(member.name)
+                        with open(os.path.join(local_dir, name), "wb") as f:
+                            shutil.copyfileobj(tar.extractfile(member), f)
+                        names.append(name)
+        except Exception as e:
+            self.scriptwriting_logger.error(u"" + str(e))
+        else:
+            self.scriptwriting_logger.info(u" Copy successful")
+        finally:
+            if stfp:
+                stfp.close()
+        return names
+
     def put_file(self, localfile, remotefile, stfp=None):
         """Copy a file from local file tot remote file.
 
@@ -366,35 +583,13 @@ class JobHandler:
 
     def check_perf_event_paranoid(self, job_settings):
         if job_settings.use_ssh:
-            client = paramiko.SSHClient()
-            client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
             try:
-                hostname = job_settings.server
-                port = 22
-                match = re.match("(.+):([0-9]+)", hostname)
-                if match:
-                    hostname = match.group(1)
-                    port = int(match.group(2))
-                if len(job_settings.private_key) > 0:
-                    key = paramiko.RSAKey.from_private_key_file(
-                        job_settings.private_key
-                    )
-                    client.connect(
-                        hostname, port=port, username=job_settings.username, pkey=key
-                    )
-                else:
-                    client.connect(
-                        hostname,
-                        port=port,
-                        username=job_settings.username,
-                        password=job_settings.password,
-                    )
+                client = get_ssh_client(job_settings)
                 perf_event_paranoid_out = self.execute_command(
                     "cat /proc/sys/kernel/perf_event_paranoid",
                     client=client,
                     return_output=True,
                 )
-                client.close()
                 perf_event_paranoid = perf_event_paranoid_out.read().decode("utf-8")
                 match = re.match("[-0-9]+", perf_event_paranoid)
                 if match:
@@ -407,7 +602,7 @@ class JobHandler:
                 SSHException,
                 socket.error,
             ) as e:
-                client.close()
+                close_ssh_client(job_settings)
                 return str(e)
         else:
             perf_event_paranoid_out = self.execute_command(
@@ -417,60 +612,23 @@ class JobHandler:
 
     @staticmethod
     def check_connection(job_settings):
-        client = paramiko.SSHClient()
-        client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        # Always authenticate, rather than reuse a shared client, so that the
+        # settings being checked are used
         try:
-            hostname = job_settings.server
-            port = 22
-            match = re.match("(.+):([0-9]+)", hostname)
-            if match:
-                hostname = match.group(1)
-                port = int(match.group(2))
-            if len(job_settings.private_key) > 0:
-                key = paramiko.RSAKey.from_private_key_file(job_settings.private_key)
-                client.connect(
-                    hostname, port=port, username=job_settings.username, pkey=key
-                )
-            else:
-                client.connect(
-                    hostname,
-                    port=port,
-                    username=job_settings.username,
-                    password=job_settings.password,
-                )
-            client.close()
-            return ""
+            client = connect_ssh_client(job_settings)
         except (
             BadHostKeyException,
             AuthenticationException,
             SSHException,
             socket.error,
         ) as e:
-            client.close()
             return str(e)
+        add_ssh_client(get_ssh_address(job_settings), client)
+        return ""
 
     def get_failed_paths(self, job, job_settings):
         if job.use_ssh:
-            client = paramiko.SSHClient()
-            client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-            hostname = job_settings.server
-            port = 22
-            match = re.match("(.+):([0-9]+)", hostname)
-            if match:
-                hostname = match.group(1)
-                port = int(match.group(2))
-            if len(job_settings.private_key) > 0:
-                key = paramiko.RSAKey.from_private_key_file(job_settings.private_key)
-                client.connect(
-                    hostname, port=port, username=job_settings.username, pkey=key
-                )
-            else:
-                client.connect(
-                    hostname,
-                    port=port,
-                    username=job_settings.username,
-                    password=job_settings.password,
-                )
+            client = get_ssh_client(job_settings)
             stfp = client.open_sftp()
         else:
             client = None
@@ -487,7 +645,6 @@ class JobHandler:
                     failed_paths.append(path)
         if job.use_ssh:
             stfp.close()
-            client.close()
         return failed_paths
 
     def run_perf_job(
@@ -501,55 +658,47 @@ class JobHandler:
         mpi_config_files,
         job_settings=None,
     ):
+        if not self.set_job_state(job_id, "running"):
+            return
         if use_ssh:
-            self.scriptwriting_logger.info(u" Open ssh connection")
-            client = paramiko.SSHClient()
-            client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-            hostname = job_settings.server
-            port = 22
-            match = re.match("(.+):([0-9]+)", hostname)
-            if match:
-                hostname = match.group(1)
-                port = int(match.group(2))
-            if len(job_settings.private_key) > 0:
-                key = paramiko.RSAKey.from_private_key_file(job_settings.private_key)
-                client.connect(
-                    hostname, port=port, username=job_settings.username, pkey=key
-                )
-            else:
-                client.connect(
-                    hostname,
-                    port=port,
-                    username=job_settings.username,
-                    password=job_settings.password,
-                )
+            self.scriptwriting_logger.info(u" Get ssh connection")
+            client = get_ssh_client(job_settings)
             self.scriptwriting_logger.info(u" Open stfp connection")
             stfp = client.open_sftp()
         else:
             client = None
             stfp = None
         root_directory = self.root_directory
+        stack_collapse_file = working_directory + "/" + self.stack_collapse_script
+        remotefile = working_directory + "/" + perf_script
         localfile = os.path.join(
             root_directory, "src" + os.sep + self.stack_collapse_script
         )
-        remotefile = working_directory + "/" + self.stack_collapse_script
-        self.execute_command("rm -f {}".format(remotefile), client)
-        self.put_file(localfile, remotefile, stfp)
-        self.execute_command("chmod 500 {}".format(remotefile), client)
+        copies = [(localfile, stack_collapse_file)]
         for mpi_config_file in mpi_config_files:
             localfile = os.path.join(
                 root_directory, local_data + os.sep + mpi_config_file
             )
-            remotefile = working_directory + "/" + mpi_config_file
-            self.execute_command("rm -f {}".format(remotefile), client)
-            self.put_file(localfile, remotefile, stfp)
+            copies.append((localfile, working_directory + "/" + mpi_config_file))
         localfile = os.path.join(root_directory, local_data + os.sep + perf_script)
-        remotefile = working_directory + "/" + perf_script
-        self.execute_command("rm -f {}".format(remotefile), client)
-        self.put_file(localfile, remotefile, stfp)
-        self.execute_command("chmod 500 {}".format(remotefile), client)
+        copies.append((localfile, remotefile))
+        # Independent commands are run concurrently
+        self.execute_commands(["rm -f {}".format(copy[1]) for copy in copies], client)
+        for localfile, copy_remotefile in copies:
+            self.put_file(localfile, copy_remotefile, stfp)
+        self.execute_commands(
+            [
+                "chmod 500 {}".format(stack_collapse_file),
+                "chmod 500 {}".format(remotefile),
+            ],
+            client,
+        )
         self.execute_command(remotefile, client)
         self.execute_command("rm -f {}".format(remotefile), client)
+        if not self.set_job_state(job_id, "transferring"):
+            if use_ssh:
+                stfp.close()
+            return
         remotefile = working_directory + "/" + job_id + ".results"
         localfile = os.path.join(
             root_directory, local_data + os.sep + job_id + ".results"
@@ -558,6 +707,7 @@ class JobHandler:
         results_file = os.path.join(
             root_directory, local_data + os.sep + job_id + ".results"
         )
+        collapsed_files = []
         with open(results_file, "r") as results:
             for line in results:
                 if not (
@@ -566,46 +716,73 @@ class JobHandler:
                     or re.match("cpu_id", line)
                     or re.match("system_wide", line)
                 ):
-                    collapsed_file = line.strip()
-                    remotefile = working_directory + "/" + collapsed_file
-                    localfile = os.path.join(
-                        root_directory, local_data + os.sep + collapsed_file
-                    )
-                    self.get_file(remotefile, localfile, stfp)
+                    collapsed_files.append(line.strip())
+        if use_ssh:
+            self.get_compressed_files(
+                working_directory,
+                job_id,
+                collapsed_files,
+                os.path.join(root_directory, local_data),
+                client,
+                stfp,
+            )
+        else:
+            for collapsed_file in collapsed_files:
+                remotefile = working_directory + "/" + collapsed_file
+                localfile = os.path.join(
+                    root_directory, local_data + os.sep + collapsed_file
+                )
+                self.get_file(remotefile, localfile, stfp)
         if use_ssh:
             stfp.close()
-            client.close()
             self.scriptwriting_logger.info(u" Close stfp connection")
-            self.scriptwriting_logger.info(u" Close ssh connection")
-
-        with open(results_file, "r") as results:
-            for line in results:
-                if not (
-                    re.match("event_counter", line)
-                    or re.match("time_interval", line)
-                    or re.match("cpu_id", line)
-                    or re.match("system_wide", line)
-                ):
-                    ll = line.strip()
-                    orig_file = local_data + os.sep + ll
-                    if system_wide:
-                        modify_system_wide_process_ids(orig_file)
-                    else:
-                        orig_pid = re.findall("proc([0-9]+)", ll)
-                        try:
-                            modify_process_ids(orig_pid[0], orig_file)
-                        except Exception as e:
-                            raise Exception(
-                                'Error reading results: "' + line.strip() + '"'
-                            )
 
+        if not self.set_job_state(job_id, "processing"):
+            return
+        # Process and thread ids are renumbered by the stack collapse script, and system
+        # wide results are split into separate files for each process
         if system_wide:
+            orig_files = []
+            with open(results_file, "r") as results:
+                for line in results:
+                    if not (
+                        re.match("event_counter", line)
+                        or re.match("time_interval", line)
+                        or re.match("cpu_id", line)
+                        or re.match("system_wide", line)
+                    ):
+                        ll = line.strip()
+                        orig_files.append(local_data + os.sep + ll)
+            self.split_system_wide_results(orig_files)
             replace_results_file(local_data, results_file, job_id)
+        # Index the results, so they are not read again when loaded
+        get_manifest(os.path.dirname(results_file), os.path.basename(results_file))
 
         done_file = local_data + os.sep + job_id + ".done"
         f = io.open(done_file, "wb")
         f.close()
 
+    def split_system_wide_results(self, orig_files):
+        """Split the results for each host into separate files for each core, with
+        the hosts split in parallel"""
+        run_parallel = GlobalData.n_proc > 1 and len(orig_files) > 1
+        if run_parallel:
+            n_workers = min(GlobalData.n_proc, len(orig_files))
+            with ProcessPoolExecutor(n_workers) as pool:
+                n_cores = pool.map(modify_system_wide_process_ids, orig_files)
+                self.log_split_progress(orig_files, n_cores)
+        else:
+            n_cores = map(modify_system_wide_process_ids, orig_files)
+            self.log_split_progress(orig_files, n_cores)
+
+    def log_split_progress(self, orig_files, n_cores):
+        for n, (orig_file, n_core) in enumerate(zip(orig_files, n_cores)):
+            self.scriptwriting_logger.info(
+                u" Split {} into {} files ({}/{})".format(
+                    os.path.basename(orig_file), n_core, n + 1, len(orig_files)
+                )
+            )
+
     def write_perf_script(self, local_data):
         job = self.job
         script_name = job.job_id + "_perf.sh"
@@ -855,6 +1032,7 @@ class JobHandler:
                     job.system_wide,
                     multiplier,
                     trace_event,
+                    pid,
                 )
                 f.write(command.encode())
         command = "wait\n"
@@ -0,0 +1,201 @@
+import os
+import json
+import datetime
+import threading
+from collections import OrderedDict
+
+from src.Utilities import get_datetime, get_datetime_diff
+
+# A job is queued until a worker, and a slot on its host, are free. The remote perf
+# script records and collapses the stacks while the job is running, the results are
+# then transferring, and processing locally, until the job is done, failed or cancelled
+finished_states = ["done", "failed", "cancelled"]
+time_format = "%Y-%m-%d %H:%M:%S"
+
+
+def get_job_duration(job, time_now):
+    """Time since a job started running, or was queued if it has not started"""
+    start_time = job["start_time"] or job["submit_time"]
+    return get_datetime_diff(
+        time_now, datetime.datetime.strptime(start_time, time_format)
+    )
+
+
+class JobQueue:
+    """Queue of perf jobs, with at most max_jobs jobs running at a time, and at most
+    max_jobs_per_host jobs running on each host. Each job runs on a daemon thread, so
+    that running jobs do not stop the server from exiting. The state of each job is
+    saved in the results directory, and listeners are called with each change of
+    state"""
+
+    def __init__(self, local_data, max_jobs=4, max_jobs_per_host=1):
+        self.state_file = os.path.join(local_data, "jobs.json")
+        self.max_jobs = max_jobs
+        self.max_jobs_per_host = max_jobs_per_host
+        self.lock = threading.Lock()
+        self.jobs = OrderedDict()
+        self.tasks = {}
+        self.cancelled = set()
+        self.running = {}
+        self.listeners = []
+        self.read_states()
+
+    def read_states(self):
+        """Read the states of previous jobs. Jobs that were unfinished when the
+        queue was stopped have failed"""
+        if os.path.isfile(self.state_file):
+            with open(self.state_file) as infile:
+                try:
+                    self.jobs = OrderedDict(json.load(infile))
+                except ValueError:
+                    self.jobs = OrderedDict()
+        for job_id, job in self.jobs.items():
+            if job["state"] not in finished_states:
+                job["state"] = "failed"
+                job["error"] = "Interrupted"
+
+    def write_states(self):
+        with open(self.state_file, "w") as outfile:
+            json.dump(list(self.jobs.items()), outfile)
+
+    def add_listener(self, listener):
+        """Call listener(job_id, job) with each change of state of a job"""
+        self.listeners.append(listener)
+
+    def notify(self, job_id, job):
+        for listener in self.listeners:
+            listener(job_id, job)
+
+    def submit(self, job_id, host, function, args):
+        """Queue function(*args) to run job_id on host"""
+        with self.lock:
+            job = self.jobs.get(job_id)
+            if job is not None and job["state"] not in finished_states:
+                raise Exception("Job " + job_id + " is already queued")
+            self.jobs[job_id] = {
+                "state": "queued",
+                "host": host,
+                "submit_time": get_datetime().strftime(time_format),
+                "start_time": "",
+                "end_time": "",
+                "error": "",
+            }
+            self.jobs.move_to_end(job_id)
+            self.tasks[job_id] = (function, args)
+            self.cancelled.discard(job_id)
+            job = dict(self.jobs[job_id])
+            self.write_states()
+        self.notify(job_id, job)
+        self.schedule()
+
+    def schedule(self):
+        """Start queued jobs, in order of submission, while job and host slots are
+        free"""
+        with self.lock:
+            n_running = sum(self.running.values())
+            for job_id, job in self.jobs.items():
+                if n_running >= self.max_jobs:
+                    break
+                if job["state"] != "queued" or job_id not in self.tasks:
+                    continue
+                host = job["host"]
+                if self.running.get(host, 0) >= self.max_jobs_per_host:
+                    continue
+                self.running[host] = self.running.get(host, 0) + 1
+                n_running += 1
+                job["state"] = "running"
+                job["start_time"] = get_datetime().strftime(time_format)
+                thread = threading.Thread(target=self.run, args=(job_id,))
+                thread.daemon = True
+                thread.start()
+            self.write_states()
+
+    def run(self, job_id):
+        function, args = self.tasks[job_id]
+        self.notify(job_id, self.get_job(job_id))
+        try:
+            function(*args)
+        except Exception as e:
+            self.set_state(job_id, "failed", str(e))
+        else:
+            # A job stopped by cancellation is already cancelled, and a job that was
+            # cancelled during its last stage has completed
+            self.set_state(job_id, "done")
+        finally:
+            with self.lock:
+                self.running[self.jobs[job_id]["host"]] -= 1
+            self.schedule()
+
+    def set_state(self, job_id, state, error=""):
+        """Set the state of a job, and notify the listeners if it has changed. If the
+        job has been cancelled, it is cancelled instead of starting the next stage, and
+        False is returned, as the job should be stopped"""
+        with self.lock:
+            job = self.jobs[job_id]
+            cancelled = job_id in self.cancelled and state not in finished_states
+            if cancelled:
+                state = "cancelled"
+            if job["state"] in finished_states or job["state"] == state:
+                return not cancelled
+            job["state"] = state
+            job["error"] = error
+            if state in finished_states:
+                job["end_time"] = get_datetime().strftime(time_format)
+            job = dict(job)
+            self.write_states()
+        self.notify(job_id, job)
+        return not cancelled
+
+    def cancel(self, job_id):
+        """Cancel a job. A queued job is removed from the queue, and a running job is
+        stopped at the end of its current stage. A job in its last stage completes"""
+        with self.lock:
+            if job_id not in self.jobs:
+                return False
+            state = self.jobs[job_id]["state"]
+            if state in finished_states:
+                return False
+            self.cancelled.add(job_id)
+            if state != "queued":
+                return True
+            job = self.jobs[job_id]
+            job["state"] = "cancelled"
+            job["end_time"] = get_datetime().strftime(time_format)
+            job = dict(job)
+            self.write_states()
+        self.notify(job_id, job)
+        return True
+
+    def retry(self, job_id):
+        """Queue a failed or cancelled job again"""
+        with self.lock:
+            if job_id not in self.tasks or self.jobs[job_id]["state"] not in [
+                "failed",
+                "cancelled",
+            ]:
+                return False
+            host = self.jobs[job_id]["host"]
+            function, args = self.tasks[job_id]
+        self.submit(job_id, host, function, args)
+        return True
+
+    def get_job(self, job_id):
+        with self.lock:
+            return dict(self.jobs[job_id])
+
+    def get_jobs(self):
+        """States of all jobs, in order of submission"""
+        with self.lock:
+            return OrderedDict((job_id, dict(job)) for job_id, job in self.jobs.items())
+
+    def get_job_summary(self):
+        """Lines of text with the state of each unfinished job, and how long it has
+        been queued or running"""
+        time_now = get_datetime()
+        summary = []
+        for job_id, job in self.get_jobs().items():
+            if job["state"] in finished_states:
+                continue
+            duration = get_job_duration(job, time_now)
+            summary.append(job_id + " - " + job["state"] + " - " + duration)
+        return summary
@@ -3,6 +3,7 @@ import sys
 from pygal.style import Style
 import operator
 from collections import OrderedDict
+from math import log10
 
 from src.ColourMaps import (
     get_gradient_colours,
@@ -88,9 +89,14 @@ custom_style_scatterplot = Style(
 )
 
 
+# Charts with more values than this are drawn without tooltips
+max_tooltip_values = 10000
+
+
 class ChartWriter:
     def __init__(self):
         self.max_points = 200
+        self.density_bins = 40
         self.significant = 0.05
         self.hotspot_map = {}
 
@@ -272,6 +278,8 @@ class ChartWriter:
         Colours of points are determined from the ratio of event1 / event2"""
         colours = get_top_ten_colours()
         data = analysis_data.get_cluster_data()
+        column1 = data.column(raw_event1)
+        column2 = data.column(raw_event2)
         cluster_labels = analysis_data.get_cluster_labels()
         cluster_map = analysis_data.get_cluster_map()
         nc = analysis_data.get_num_clusters()
@@ -292,46 +300,45 @@ class ChartWriter:
                 pid = process_id.pid
                 tid = process_id.tid
                 job = process_id.job
-                for stack in data[job][pid][tid]:
-                    node = stack.rpartition(";")[2]
-                    if node in data[job][pid][tid]:
-                        yi = data[job][pid][tid][node][raw_event1]
-                        xi = data[job][pid][tid][node][raw_event2]
-                        if xlower:
-                            if xi < xlower or xi > xupper or yi < ylower or yi > yupper:
-                                continue
-                        if abs(xi) > 0.0 and abs(yi) > 0.0:
-                            nzeros += 1
-                        if abs(xi) > 0.0 or abs(yi) > 0.0 or nzeros == 1:
-                            nseries += 1
-                            minx = min(minx, xi)
-                            miny = min(miny, yi)
-                            maxx = max(maxx, xi)
-                            maxy = max(maxy, yi)
-                            if node in cluster_map[job][pid][tid]:
-                                ci = cluster_map[job][pid][tid][node]
-                                i = cluster_labels[ci]
-                                label = "{}-pid:{}-tid:{}: {}".format(
-                                    job, pid, tid, node
+                rows = analysis_data.get_cluster_rows(job, pid, tid)
+                for node, row in rows.items():
+                    yi = column1[row]
+                    xi = column2[row]
+                    if xlower:
+                        if xi < xlower or xi > xupper or yi < ylower or yi > yupper:
+                            continue
+                    if abs(xi) > 0.0 and abs(yi) > 0.0:
+                        nzeros += 1
+                    if abs(xi) > 0.0 or abs(yi) > 0.0 or nzeros == 1:
+                        nseries += 1
+                        minx = min(minx, xi)
+                        miny = min(miny, yi)
+                        maxx = max(maxx, xi)
+                        maxy = max(maxy, yi)
+                        if node in cluster_map[job][pid][tid]:
+                            ci = cluster_map[job][pid][tid][node]
+                            i = cluster_labels[ci]
+                            label = "{}-pid:{}-tid:{}: {}".format(
+                                job, pid, tid, node
+                            )
+                            if i < 0:
+                                plot_data[i].append(
+                                    {
+                                        "value": (xi, yi),
+                                        "label": label,
+                                        "color": "grey",
+                                        "opacity": 0.2,
+                                    }
+                                )
+                            else:
+                                i = i % len(colours)
+                                plot_data[i].append(
+                                    {
+                                        "value": (xi, yi),
+                                        "label": label,
+                                        "color": colours[i],
+                                    }
                                 )
-                                if i < 0:
-                                    plot_data[i].append(
-                                        {
-                                            "value": (xi, yi),
-                                            "label": label,
-                                            "color": "grey",
-                                            "opacity": 0.2,
-                                        }
-                                    )
-                                else:
-                                    i = i % len(colours)
-                                    plot_data[i].append(
-                                        {
-                                            "value": (xi, yi),
-                                            "label": label,
-                                            "color": colours[i],
-                                        }
-                                    )
         plot_data = self.restrict_scatter_multiple(plot_data, minx, maxx, miny, maxy)
         if centred:
             xr = max(abs(minx), abs(maxx))
@@ -403,25 +410,19 @@ class ChartWriter:
                 base_case_id = process_id
         if not base_case_id:
             return self.generate_empty_chart()
-        x_data = stack_data.get_original_event_stack_data(base_case_id)
-        x = {}
-        for stack in x_data:
-            node = stack.rpartition(";")[2]
-            if node not in x:
-                x[node] = 0.0
-            x[node] += x_data[stack]
-        sorted_vals = sorted(x.items(), key=operator.itemgetter(1), reverse=True)
+        hotspots = stack_data.get_ranked_node_values(
+            base_case_id, start - 1, start - 1 + number_to_rank
+        )
         colours = get_top_ten_colours()
         default_color = colours[-1]
         hotspot_colour_map = {}
-        start_index = min(start - 1, len(sorted_vals))
-        end_index = min(start - 1 + number_to_rank, len(sorted_vals))
         n = 0
-        for v in sorted_vals[start_index:end_index]:
-            node = v[0]
+        for node, _ in hotspots:
             hotspot_colour_map[node] = colours[n]
             n += 1
         data = analysis_data.get_cluster_data()
+        column1 = data.column(raw_event1)
+        column2 = data.column(raw_event2)
         plot_data = {i: [] for i in range(0, len(colours))}
         nseries = 0
         nzeros = 0
@@ -439,38 +440,37 @@ class ChartWriter:
                 pid = process_id.pid
                 tid = process_id.tid
                 job = process_id.job
-                for stack in data[job][pid][tid]:
-                    node = stack.rpartition(";")[2]
-                    if node in data[job][pid][tid]:
-                        yi = data[job][pid][tid][node][raw_event1]
-                        xi = data[job][pid][tid][node][raw_event2]
-                        if xlower:
-                            if xi < xlower or xi > xupper or yi < ylower or yi > yupper:
-                                continue
-                        if abs(xi) > 0.0 and abs(yi) > 0.0:
-                            nzeros += 1
-                        if abs(xi) > 0.0 or abs(yi) > 0.0 or nzeros == 1:
-                            nseries += 1
-                            minx = min(minx, xi)
-                            miny = min(miny, yi)
-                            maxx = max(maxx, xi)
-                            maxy = max(maxy, yi)
-                            label = "{}-pid:{}-tid:{}: {}".format(job, pid, tid, node)
-                            if node in hotspot_colour_map:
-                                colour = hotspot_colour_map[node]
-                                i = colours.index(colour) + 1
-                                plot_data[i].append(
-                                    {"value": (xi, yi), "label": label, "color": colour}
-                                )
-                            else:
-                                plot_data[0].append(
-                                    {
-                                        "value": (xi, yi),
-                                        "label": label,
-                                        "color": default_color,
-                                        "opacity": 0.2,
-                                    }
-                                )
+                rows = analysis_data.get_cluster_rows(job, pid, tid)
+                for node, row in rows.items():
+                    yi = column1[row]
+                    xi = column2[row]
+                    if xlower:
+                        if xi < xlower or xi > xupper or yi < ylower or yi > yupper:
+                            continue
+                    if abs(xi) > 0.0 and abs(yi) > 0.0:
+                        nzeros += 1
+                    if abs(xi) > 0.0 or abs(yi) > 0.0 or nzeros == 1:
+                        nseries += 1
+                        minx = min(minx, xi)
+                        miny = min(miny, yi)
+                        maxx = max(maxx, xi)
+                        maxy = max(maxy, yi)
+                        label = "{}-pid:{}-tid:{}: {}".format(job, pid, tid, node)
+                        if node in hotspot_colour_map:
+                            colour = hotspot_colour_map[node]
+                            i = colours.index(colour) + 1
+                            plot_data[i].append(
+                                {"value": (xi, yi), "label": label, "color": colour}
+                            )
+                        else:
+                            plot_data[0].append(
+                                {
+                                    "value": (xi, yi),
+                                    "label": label,
+                                    "color": default_color,
+                                    "opacity": 0.2,
+                                }
+                            )
 
         if len(plot_data[0]) > 0:
             nmax = 20 * self.max_points
@@ -534,79 +534,24 @@ class ChartWriter:
         )
         chart.title = title
         base_case_id = stack_data.get_base_case_id()
-        event_type = stack_data.tasks[base_case_id.task_id].event_type
-        if event_type == "original":
-            x_data = stack_data.get_original_event_stack_data(base_case_id)
-            x = {}
-            for stack in x_data:
-                node = stack.rpartition(";")[2]
-                if node not in x:
-                    x[node] = 0.0
-                x[node] += x_data[stack]
-            sorted_vals = sorted(x.items(), key=operator.itemgetter(1), reverse=True)
-        else:  # type == "custom"
-            x_data, y_data = stack_data.get_custom_event_ratio_stack_data(base_case_id)
-            x = {}
-            for stack in x_data:
-                node = stack.rpartition(";")[2]
-                if node not in x:
-                    x[node] = 0.0
-                x[node] += x_data[stack]
-            y = {}
-            for stack in y_data:
-                node = stack.rpartition(";")[2]
-                if node not in y:
-                    y[node] = 0.0
-                y[node] += y_data[stack]
-            ratios = {s: float(y[s]) / float(x[s]) for s in x if float(x[s]) >= 0.1}
-            sorted_vals = sorted(
-                ratios.items(), key=operator.itemgetter(1), reverse=True
-            )
-        start_index = min(start - 1, len(sorted_vals))
-        end_index = min(start - 1 + number_to_rank, len(sorted_vals))
+        hotspots = stack_data.get_ranked_node_values(
+            base_case_id, start - 1, start - 1 + number_to_rank
+        )
         plot_data = {}
         plot_labels = {}
         n_procs = {}
         ids = stack_data.get_selected_process_ids()
         for process_id in ids:
             label = process_id.label
-            task_id = process_id.task_id
             job = process_id.job
-            chart_type = stack_data.tasks[task_id].event_type
             if job not in plot_data:
                 plot_data[job] = {}
                 plot_labels[job] = {}
                 n_procs[job] = 1
             else:
                 n_procs[job] += 1
-            if chart_type == "original":
-                x_data = stack_data.get_original_event_stack_data(process_id)
-                x = {}
-                for stack in x_data:
-                    node = stack.rpartition(";")[2]
-                    if node not in x:
-                        x[node] = 0.0
-                    x[node] += x_data[stack]
-                vals = x
-            else:  # type == "custom"
-                x_data, y_data = stack_data.get_custom_event_ratio_stack_data(
-                    process_id
-                )
-                x = {}
-                for stack in x_data:
-                    node = stack.rpartition(";")[2]
-                    if node not in x:
-                        x[node] = 0.0
-                    x[node] += x_data[stack]
-                y = {}
-                for stack in y_data:
-                    node = stack.rpartition(";")[2]
-                    if node not in y:
-                        y[node] = 0.0
-                    y[node] += y_data[stack]
-                vals = {s: float(y[s]) / float(x[s]) for s in x if float(x[s]) >= 0.1}
-            for v in sorted_vals[start_index:end_index]:
-                s = v[0]
+            vals = stack_data.get_node_values(process_id)
+            for s, _ in hotspots:
                 if s in vals:
                     y = vals[s]
                     if s not in plot_data[job]:
@@ -633,8 +578,7 @@ class ChartWriter:
         data_min = {job: [] for job in plot_data}
         data_mean = {job: [] for job in plot_data}
         data_max = {job: [] for job in plot_data}
-        for v in sorted_vals[end_index - 1 :: -1]:
-            s = v[0]
+        for s, _ in reversed(hotspots):
             for job in plot_data:
                 mean = float(plot_data[job][s]["mean"] / float(n_procs[job]))
                 for dummy_job in plot_data:
@@ -661,12 +605,13 @@ class ChartWriter:
                         data_max[job].append({"value": 0.0})
                         data_mean[job].append({"value": 0.0})
                         data_min[job].append({"value": 0.0})
-            if s == sorted_vals[start_index][0]:
-                break
         for job in plot_data:
             chart.add(job + ": min", data_min[job])
             chart.add(job + ": mean", data_mean[job])
             chart.add(job + ": max", data_max[job])
+        chart.tooltips = (
+            sum(3 * len(data_min[job]) for job in plot_data) <= max_tooltip_values
+        )
         data_min = []
         data_mean = []
         data_max = []
@@ -678,9 +623,9 @@ class ChartWriter:
             height=500,
             value_formatter=lambda val: format_number(val),
             show_legend=False,
+            tooltips=False,
         )
-        for v in sorted_vals[start_index:end_index]:
-            s = v[0]
+        for s, _ in hotspots:
             for job in plot_data:
                 x_labels.append(job + ": " + s)
                 mean = float(plot_data[job][s]["mean"] / float(n_procs[job]))
@@ -830,35 +775,9 @@ class ChartWriter:
         chart.title = title
         ids = stack_data.get_selected_process_ids()
         base_case_id = stack_data.get_base_case_id()
-        if base_case_id.event_type == "original":
-            x_data = stack_data.get_original_event_stack_data(base_case_id)
-            x = {}
-            for stack in x_data:
-                node = stack.rpartition(";")[2]
-                if node not in x:
-                    x[node] = 0.0
-                x[node] += x_data[stack]
-            sorted_vals = sorted(x.items(), key=operator.itemgetter(1), reverse=True)
-        else:  # custom event ratio
-            x_data, y_data = stack_data.get_custom_event_ratio_stack_data(base_case_id)
-            x = {}
-            for stack in x_data:
-                node = stack.rpartition(";")[2]
-                if node not in x:
-                    x[node] = 0.0
-                x[node] += x_data[stack]
-            y = {}
-            for stack in y_data:
-                node = stack.rpartition(";")[2]
-                if node not in y:
-                    y[node] = 0.0
-                y[node] += y_data[stack]
-            ratios = {s: float(y[s]) / float(x[s]) for s in x if float(x[s]) >= 0.1}
-            sorted_vals = sorted(
-                ratios.items(), key=operator.itemgetter(1), reverse=True
-            )
-        start_index = min(start - 1, len(sorted_vals))
-        end_index = min(start - 1 + number_to_rank, len(sorted_vals))
+        hotspots = stack_data.get_ranked_node_values(
+            base_case_id, start - 1, start - 1 + number_to_rank
+        )
         plot_data = OrderedDict()
         x_labels = []
         n_events = 0
@@ -877,41 +796,8 @@ class ChartWriter:
                         n_events += 1
                         x_labels.append(label)
                         other = totals[task_id][pid][tid]
-                        if event_type == "original":
-                            x_data = stack_data.get_original_event_stack_data(
-                                process_id
-                            )
-                            x = {}
-                            for stack in x_data:
-                                node = stack.rpartition(";")[2]
-                                if node not in x:
-                                    x[node] = 0.0
-                                x[node] += x_data[stack]
-                            vals = x
-                        else:  # custom event ratio
-                            (
-                                x_data,
-                                y_data,
-                            ) = stack_data.get_custom_event_ratio_stack_data(process_id)
-                            x = {}
-                            for stack in x_data:
-                                node = stack.rpartition(";")[2]
-                                if node not in x:
-                                    x[node] = 0.0
-                                x[node] += x_data[stack]
-                            y = {}
-                            for stack in y_data:
-                                node = stack.rpartition(";")[2]
-                                if node not in y:
-                                    y[node] = 0.0
-                                y[node] += y_data[stack]
-                            vals = {
-                                s: float(y[s]) / float(x[s])
-                                for s in x
-                                if float(x[s]) >= 0.1
-                            }
-                        for v in sorted_vals[start_index:end_index]:
-                            s = v[0]
+                        vals = stack_data.get_node_values(process_id)
+                        for s, _ in hotspots:
                             if s in vals:
                                 y = vals[s]
                                 if s not in plot_data:
@@ -933,8 +819,7 @@ class ChartWriter:
                 colours = get_top_ten_colours()
                 self.hotspot_map = {"other": colours[0]}
             n = 0
-            for v in sorted_vals[start_index:end_index]:
-                s = v[0]
+            for s, _ in hotspots:
                 if write_colourmap:
                     self.hotspot_map[s] = colours[n]
                 n += 1
@@ -989,35 +874,9 @@ class ChartWriter:
         if not base_case_id:
             return self.generate_empty_chart()
 
-        if base_case_id.event_type == "original":
-            x_data = stack_data.get_original_event_stack_data(base_case_id)
-            x = {}
-            for stack in x_data:
-                node = stack.rpartition(";")[2]
-                if node not in x:
-                    x[node] = 0.0
-                x[node] += x_data[stack]
-            sorted_vals = sorted(x.items(), key=operator.itemgetter(1), reverse=True)
-        else:  # custom event ratio
-            x_data, y_data = stack_data.get_custom_event_ratio_stack_data(base_case_id)
-            x = {}
-            for stack in x_data:
-                node = stack.rpartition(";")[2]
-                if node not in x:
-                    x[node] = 0.0
-                x[node] += x_data[stack]
-            y = {}
-            for stack in y_data:
-                node = stack.rpartition(";")[2]
-                if node not in y:
-                    y[node] = 0.0
-                y[node] += y_data[stack]
-            ratios = {s: float(y[s]) / float(x[s]) for s in x if float(x[s]) >= 0.1}
-            sorted_vals = sorted(
-                ratios.items(), key=operator.itemgetter(1), reverse=True
-            )
-        start_index = min(start - 1, len(sorted_vals))
-        end_index = min(start - 1 + number_to_rank, len(sorted_vals))
+        hotspots = stack_data.get_ranked_node_values(
+            base_case_id, start - 1, start - 1 + number_to_rank
+        )
         plot_data = OrderedDict()
         x_labels = []
         n_events = 0
@@ -1044,46 +903,11 @@ class ChartWriter:
                             n_events += 1
                             x_labels.append(label)
                             other = totals[task_id][pid][tid]
-                            if event_type == "original":
-                                x_data = stack_data.get_original_event_stack_data(
-                                    process_id
-                                )
-                                x = {}
-                                for stack in x_data:
-                                    node = stack.rpartition(";")[2]
-                                    if node not in x:
-                                        x[node] = 0.0
-                                    x[node] += x_data[stack]
-                                vals = x
-                            else:  # custom event ratio
-                                (
-                                    x_data,
-                                    y_data,
-                                ) = stack_data.get_custom_event_ratio_stack_data(
-                                    process_id
-                                )
-                                x = {}
-                                for stack in x_data:
-                                    node = stack.rpartition(";")[2]
-                                    if node not in x:
-                                        x[node] = 0.0
-                                    x[node] += x_data[stack]
-                                y = {}
-                                for stack in y_data:
-                                    node = stack.rpartition(";")[2]
-                                    if node not in y:
-                                        y[node] = 0.0
-                                    y[node] += y_data[stack]
-                                vals = {
-                                    s: float(y[s]) / float(x[s])
-                                    for s in x
-                                    if float(x[s]) >= 0.1
-                                }
+                            vals = stack_data.get_node_values(process_id)
                             if event not in events:
                                 events.append(event)
                             label_to_event_map[label] = event
-                            for v in sorted_vals[start_index:end_index]:
-                                s = v[0]
+                            for s, _ in hotspots:
                                 if s in vals:
                                     y = vals[s]
                                     if s not in plot_data:
@@ -1117,8 +941,7 @@ class ChartWriter:
                 colours = get_top_ten_colours()
                 self.hotspot_map = {"other": colours[0]}
             n = 0
-            for v in sorted_vals[start_index:end_index]:
-                s = v[0]
+            for s, _ in hotspots:
                 if write_colourmap:
                     self.hotspot_map[s] = colours[n]
                 n += 1
@@ -1141,6 +964,10 @@ class ChartWriter:
                 )
             chart.add("other", data)
             chart.x_labels = event_ordered_x_labels
+            chart.tooltips = (
+                len(event_ordered_plot_data) * len(event_ordered_x_labels)
+                <= max_tooltip_values
+            )
             return chart
         else:
             return self.generate_empty_chart()
@@ -1443,32 +1270,41 @@ class ChartWriter:
         return plot_data
 
     def restrict_scatter(self, plot_data, xmin, xmax, ymin, ymax, nmax):
-        """Restrict number of points viewed in scatter plots"""
-        if len(plot_data) > nmax:
-            reduced_data = []
-            for point in plot_data:
-                reduced_data.append(point)
-            n = 1
-            while len(reduced_data) > nmax:
-                xy_grid = {}
-                data = []
-                x_delta = n * (xmax - xmin) / float(self.max_points)
-                y_delta = n * (ymax - ymin) / float(self.max_points)
-                for point in plot_data:
-                    values = point["value"]
-                    xi = values[0]
-                    yi = values[1]
-                    xi_grid = int(xi / x_delta)
-                    yi_grid = int(yi / y_delta)
-                    grid_id = "x=" + str(xi_grid) + ":y=" + str(yi_grid)
-                    if grid_id not in xy_grid:
-                        xy_grid[grid_id] = 1
-                        data.append(point)
-                reduced_data = data
-                n += 1
-            return reduced_data
-        else:
+        """Restrict number of points viewed in scatter plots, by binning the points on a
+        density_bins x density_bins grid. The points in each cell are replaced by a single
+        point at their mean, sized by the number of points, while points which are alone
+        in their cell are outliers, and are shown individually."""
+        if len(plot_data) <= nmax:
             return plot_data
+        nbins = self.density_bins
+        x_delta = (xmax - xmin) / float(nbins)
+        y_delta = (ymax - ymin) / float(nbins)
+        cells = OrderedDict()
+        for point in plot_data:
+            xi, yi = point["value"]
+            ix = int((xi - xmin) / x_delta) if x_delta > 0.0 else 0
+            iy = int((yi - ymin) / y_delta) if y_delta > 0.0 else 0
+            key = (min(max(ix, 0), nbins - 1), min(max(iy, 0), nbins - 1))
+            if key in cells:
+                cell = cells[key]
+                cell[0] += 1
+                cell[1] += xi
+                cell[2] += yi
+            else:
+                cells[key] = [1, xi, yi, point]
+        reduced_data = []
+        for count, x_sum, y_sum, point in cells.values():
+            if count == 1:
+                reduced_data.append(point)
+            else:
+                binned_point = dict(point)
+                binned_point["value"] = (x_sum / count, y_sum / count)
+                binned_point["label"] = "{} points, including {}".format(
+                    count, point.get("label", "")
+                )
+                binned_point["node"] = {"r": 3.0 + 3.0 * log10(count)}
+                reduced_data.append(binned_point)
+        return reduced_data
 
     def get_flamegraph_colour_map(self):
         return self.hotspot_map
@@ -1,5 +1,6 @@
 import os
 import re
+import json
 from collections import OrderedDict
 from tempfile import mkstemp
 from shutil import move
@@ -7,6 +8,18 @@ from os import remove, close
 
 from src.Utilities import natural_sort
 
+# Process name exe-pid/tid at the start of stack, trace and secondary event lines
+process_name_regex = re.compile(
+    "^((?:secondary-event;)?[^;]*-)(all|[?]|[0-9]+)/(all|[0-9]+)(?=[; :])"
+)
+# Lines buffered for each core, and files kept open, when splitting system wide results
+max_buffered_lines = 1000
+max_open_split_files = 64
+# Manifests of results files, with the format version, and modification time and
+# size of the results file they were read from
+manifest_version = 1
+manifest_cache = {}
+
 
 def is_setting(line):
     is_setting = (
@@ -22,93 +35,60 @@ def is_results_file(line):
     return not is_setting(line)
 
 
-def modify_process_ids(orig_pid, orig_file):
-    # Replace process and thread ids with sets of sequential ids, starting from zero
-    threads = {}
-    process_id_regex = re.compile("((all|[0-9]+)/(all|[0-9]+))")
-    with open(orig_file, "r") as result:
-        for line in result:
-            match = re.search(process_id_regex, line)
-            if match:
-                tid = match.group(3)
-                if tid not in threads:
-                    threads[tid] = tid
-    sorted_threads = OrderedDict(natural_sort(threads.items(), key=lambda th: th[1]))
-    tids = OrderedDict()
-    n = 0
-    for t in sorted_threads:
-        if t == "all":
-            tids[t] = t
+def write_split_lines(new_file, lines, handles, opened):
+    """Append buffered lines to one of the split files, keeping at most
+    max_open_split_files open"""
+    if new_file in handles:
+        handles.move_to_end(new_file)
+    else:
+        if len(handles) >= max_open_split_files:
+            handles.popitem(last=False)[1].close()
+        if new_file in opened:
+            handles[new_file] = open(new_file, "ab")
         else:
-            tids[t] = str(n)
-            n += 1
-    fh, abs_path = mkstemp()
-    with open(abs_path, "wb") as new_file:  # Output file is binary
-        with open(orig_file, "r") as result:  # Input file is text
-            for line in result:
-                match = re.search(process_id_regex, line)
-                if match:
-                    pid = match.group(2)
-                    tid = match.group(3)
-                    line = re.sub("/" + tid, "/" + tids[tid], line)
-                    line = re.sub(pid + "/", orig_pid + "/", line)
-                    new_file.write(line.encode())
-                else:
-                    new_file.write(line.encode())
-    close(fh)
-    remove(orig_file)
-    move(abs_path, orig_file)
+            handles[new_file] = open(new_file, "wb")
+            opened.add(new_file)
+    handles[new_file].write("".join(lines).encode())
+    del lines[:]
 
 
 def modify_system_wide_process_ids(orig_file):
-    # Replace process and thread ids with sets of sequential ids, starting from zero
-    # split data files for each host into separate files for each physical core
-    threads = []
+    # Split data files for each host into separate files for each physical core. Thread
+    # ids have already been made sequential by the stack collapse script
     host = re.findall("host(\d+)_", orig_file)[0][0]
-    process_id_regex = re.compile("((all|[0-9]+)/(all|[0-9]+))")
-    with open(orig_file, "r") as result:
-        for line in result:
-            match = re.search(process_id_regex, line)
-            if match:
-                tid = match.group(3)
-                if tid not in threads:
-                    threads.append(tid)
-    sorted_threads = natural_sort(threads)
-    tids = OrderedDict()
-    n = 0
-    for t in sorted_threads:
-        if t == "all":
-            tids[t] = t
-        else:
-            tids[t] = str(n)
-            n += 1
-    fs = {}
+    buffers = OrderedDict()
+    handles = OrderedDict()
+    opened = set()
+    new_files = {}
     last_time = ""
     start_time = ""
     with open(orig_file, "r") as result:
         for line in result:
-            match = re.search(process_id_regex, line)
+            match = process_name_regex.match(line)
             if match:
                 pid = match.group(2)
-                tid = match.group(3)
-                line = re.sub("/" + tid, "/" + tids[tid], line)
-                new_file = re.sub(
-                    "host" + host, "host" + host + "_proc" + pid, orig_file
-                )
-                if new_file not in fs:
-                    fs[new_file] = open(new_file, "wb")
-                    fs[new_file].write(start_time.encode())
-                    fs[new_file].write(last_time.encode())
-                fs[new_file].write(line.encode())
+                if pid not in new_files:
+                    new_files[pid] = re.sub(
+                        "host" + host, "host" + host + "_proc" + pid, orig_file
+                    )
+                    buffers[pid] = [start_time, last_time]
+                buffers[pid].append(line)
+                if len(buffers[pid]) >= max_buffered_lines:
+                    write_split_lines(new_files[pid], buffers[pid], handles, opened)
             elif line[0:2] == "t=":
                 last_time = line
-                for f in fs:
-                    fs[f].write(line.encode())
-            elif re.match("start-time", line):
+                for pid, lines in buffers.items():
+                    lines.append(line)
+                    if len(lines) >= max_buffered_lines:
+                        write_split_lines(new_files[pid], lines, handles, opened)
+            elif line.startswith("start-time"):
                 start_time = line
-    for f in fs:
-        fs[f].close()
+    for pid in buffers:
+        write_split_lines(new_files[pid], buffers[pid], handles, opened)
+    for f in handles:
+        handles[f].close()
     remove(orig_file)
+    return len(new_files)
 
 
 def get_run_duration(stack_file):
@@ -149,17 +129,89 @@ def replace_results_file(local_data, results_file, job_id):
     move(abs_path, results_file)
 
 
+def read_results_file(path, result_file):
+    """Read the run settings of a results file, and the process, event, run duration
+    and size of each collapsed stacks file listed in it"""
+    full_filename = os.path.join(path, result_file)
+    manifest = {
+        "event_counters": [],
+        "time_interval": None,
+        "cpu_id": None,
+        "system_wide": False,
+        "files": [],
+    }
+    with open(full_filename) as infile:
+        for line in infile:
+            if re.match("event_counter", line):
+                # i.e. event_counter-cycles:run-1:100
+                match = re.match("event_counter-(.*):run-([0-9]+):([0-9]+)", line)
+                manifest["event_counters"].append(
+                    [match.group(1), match.group(2), int(match.group(3))]
+                )
+            elif re.match("time_interval", line):
+                manifest["time_interval"] = float(line.partition(":")[2])
+            elif re.match("cpu_id", line):
+                manifest["cpu_id"] = line.strip().partition(":")[2]
+            elif re.match("system_wide", line):
+                manifest["system_wide"] = True
+            elif line.strip():
+                match = re.match("(.*proc(all|[0-9]+))_(.*)", line.strip())
+                stack_file = os.path.join(path, line.strip())
+                duration = None
+                size = None
+                if os.path.isfile(stack_file):
+                    size = os.path.getsize(stack_file)
+                    if size > 0:
+                        duration = get_run_duration(stack_file)
+                manifest["files"].append(
+                    {
+                        "name": line.strip(),
+                        "process": match.group(1),
+                        "event": match.group(3),
+                        "duration": duration,
+                        "size": size,
+                    }
+                )
+    return manifest
+
+
+def get_manifest(path, result_file):
+    """Manifest of a results file, read from the json file written alongside it, or
+    created from the results file if missing or out of date"""
+    full_filename = os.path.join(path, result_file)
+    manifest_file = full_filename + ".json"
+    stat = os.stat(full_filename)
+    version = [manifest_version, stat.st_mtime, stat.st_size]
+    if full_filename in manifest_cache:
+        manifest = manifest_cache[full_filename]
+        if manifest["version"] == version:
+            return manifest
+    manifest = None
+    if os.path.isfile(manifest_file):
+        with open(manifest_file) as infile:
+            try:
+                manifest = json.load(infile)
+            except ValueError:
+                manifest = None
+    if manifest is None or manifest.get("version") != version:
+        manifest = read_results_file(path, result_file)
+        manifest["version"] = version
+        try:
+            with open(manifest_file, "w") as outfile:
+                json.dump(manifest, outfile)
+        except (IOError, OSError):  # Results directory may be read only
+            pass
+    manifest_cache[full_filename] = manifest
+    return manifest
+
+
 def get_events(path, results_files):  # Read events from results files
     events = []
     for result_file in results_files:
-        full_filename = os.path.join(path, result_file)
-        with open(full_filename) as infile:
-            for line in infile:
-                if is_results_file(line):
-                    match = re.match("(.*proc(all|[0-9]+))_(.*)", line.strip())
-                    event = match.group(3)
-                    if event not in events:
-                        events.append(event)
+        for stack_file in get_manifest(path, result_file)["files"]:
+            event = stack_file["event"]
+            if event not in events:
+                events.append(event)
     events = natural_sort(events)
     return events
 
@@ -167,14 +219,10 @@ def get_events(path, results_files):  # Read events from results files
 def get_processes(path, results_files):  # Read processes from results files
     processes = []
     for result_file in results_files:
-        full_filename = os.path.join(path, result_file)
-        with open(full_filename) as infile:
-            for line in infile:
-                if is_results_file(line):
-                    match = re.match("(.*proc(all|[0-9]+))_(.*)", line.strip())
-                    name = match.group(1)
-                    if name not in processes:
-                        processes.append(name)
+        for stack_file in get_manifest(path, result_file)["files"]:
+            name = stack_file["process"]
+            if name not in processes:
+                processes.append(name)
     processes = natural_sort(processes)
     return processes
 
@@ -182,19 +230,15 @@ def get_processes(path, results_files):  # Read processes from results files
 def get_process_to_event_map(path, results_file):
     """Get a process to event map, from a single results file"""
     found = {}
-    full_filename = os.path.join(path, results_file)
-    with open(full_filename) as infile:
-        for line in infile:
-            if is_results_file(line):
-                match = re.match("(.*proc(all|[0-9]+))_(.*)", line.strip())
-                name = match.group(1)
-                event = match.group(3)
-                if re.search("trace", event):  # skip trace events
-                    continue
-                if name in found:
-                    found[name].append(event)
-                else:
-                    found[name] = [event]
+    for stack_file in get_manifest(path, results_file)["files"]:
+        name = stack_file["process"]
+        event = stack_file["event"]
+        if re.search("trace", event):  # skip trace events
+            continue
+        if name in found:
+            found[name].append(event)
+        else:
+            found[name] = [event]
     return found
 
 
@@ -212,16 +256,11 @@ def get_trace_jobs(path, results_files):
     """Retrun jobs that contain trace profiles"""
     found = []
     for result_file in results_files:
-        full_filename = os.path.join(path, result_file)
         job_name = result_file.partition(".results")[0]
-        with open(full_filename) as infile:
-            for line in infile:
-                if is_results_file(line):
-                    match = re.match("(.*proc(all|[0-9]+))_(.*)", line.strip())
-                    event = match.group(3)
-                    if re.search("trace", event):
-                        found.append(job_name)
-                        break
+        for stack_file in get_manifest(path, result_file)["files"]:
+            if re.search("trace", stack_file["event"]):
+                found.append(job_name)
+                break
     return found
 
 
@@ -232,18 +271,12 @@ def get_job_name(result_file):
 def get_event_counters(path, results_files):
     event_counters = {}
     for result_file in results_files:
-        full_filename = os.path.join(path, result_file)
         job = get_job_name(result_file)
         if job not in event_counters:
             event_counters[job] = {}
-        with open(full_filename) as infile:
-            for line in infile:
-                if re.match("event_counter", line):
-                    # i.e. event_counter-cycles:run-1:100
-                    match = re.match("event_counter-(.*):run-[0-9]+:([0-9]+)", line)
-                    raw_event = match.group(1)
-                    event_counter = match.group(2)
-                    event_counters[job][raw_event] = int(event_counter)
+        manifest = get_manifest(path, result_file)
+        for raw_event, run_number, event_counter in manifest["event_counters"]:
+            event_counters[job][raw_event] = event_counter
     return event_counters
 
 
@@ -253,7 +286,6 @@ def get_run_summary(path, results_files):
     event_counters = {}
     run_parameters = {}
     for result_file in results_files:
-        full_filename = os.path.join(path, result_file)
         job = get_job_name(result_file)
         if job not in run_durations:
             run_durations[job] = {}
@@ -261,45 +293,37 @@ def get_run_summary(path, results_files):
             event_counters[job] = {}
             run_parameters[job] = {}
             run_parameters[job]["system_wide"] = False
-        with open(full_filename) as infile:
-            for line in infile:
-                if re.match("event_counter", line):
-                    # event-counter-cycles:run-1:100
-                    event_string, run_string, event_counter = line.split(":")
-                    raw_event = event_string.partition("-")[2]
-                    run_number = run_string.partition("-")[2]
-                    run_numbers[job][raw_event] = run_number
-                    event_counters[job][raw_event] = int(event_counter)
-                elif re.match("time_interval", line):
-                    run_parameters[job]["time_interval"] = float(line.partition(":")[2])
-                elif re.match("cpu_id", line):
-                    run_parameters[job]["cpu_id"] = line.strip().partition(":")[2]
-                elif re.match("system_wide", line):
-                    run_parameters[job]["system_wide"] = True
+        manifest = get_manifest(path, result_file)
+        for raw_event, run_number, event_counter in manifest["event_counters"]:
+            run_numbers[job][raw_event] = run_number
+            event_counters[job][raw_event] = event_counter
+        if manifest["time_interval"] is not None:
+            run_parameters[job]["time_interval"] = manifest["time_interval"]
+        if manifest["cpu_id"] is not None:
+            run_parameters[job]["cpu_id"] = manifest["cpu_id"]
+        if manifest["system_wide"]:
+            run_parameters[job]["system_wide"] = True
+        for stack_file in manifest["files"]:
+            raw_event = stack_file["event"]
+            if raw_event in run_numbers[job]:
+                run_number = str(run_numbers[job][raw_event])
+                t = stack_file["duration"]
+                if t is None:  # missing or empty stacks file
+                    continue
+                if run_number not in run_durations[job]:
+                    run_durations[job][run_number] = t
                 else:
-                    match = re.match("(.*proc(all|[0-9]+))_(.*)", line.strip())
-                    raw_event = match.group(3)
-                    if raw_event in run_numbers[job]:
-                        run_number = str(run_numbers[job][raw_event])
-                        filename = path + os.sep + line.strip()
-                        t = get_run_duration(filename)
-                        if run_number not in run_durations[job]:
-                            run_durations[job][run_number] = t
-                        else:
-                            run_durations[job][run_number] = max(
-                                run_durations[job][run_number], t
-                            )
+                    run_durations[job][run_number] = max(
+                        run_durations[job][run_number], t
+                    )
     return event_counters, run_numbers, run_durations, run_parameters
 
 
 def get_cpu(path, results_files):
     for result_file in results_files:
-        full_filename = os.path.join(path, result_file)
-        with open(full_filename) as infile:
-            for line in infile:
-                if re.match("cpu_id", line):
-                    cpu = line.strip().partition(":")[2]
-                    return cpu
+        cpu = get_manifest(path, result_file)["cpu_id"]
+        if cpu is not None:
+            return cpu
 
 
 def get_results_info(path, results_files):
@@ -310,22 +334,18 @@ def get_results_info(path, results_files):
     jobs = []
     raw_events = []
     for result_file in results_files:
-        full_filename = os.path.join(path, result_file)
         job = result_file.rpartition(".results")[0]
         jobs.append(job)
         processes[job] = []
-        with open(full_filename) as infile:
-            for line in infile:
-                if is_results_file(line):
-                    match = re.match("(.*proc(all|[0-9]+))_(.*)", line.strip())
-                    job_process = match.group(1)
-                    event = match.group(3)
-                    process = re.sub(job + "_", "", job_process)
-                    job = job.partition("_proc")[0]
-                    if process not in processes[job]:
-                        processes[job].append(process)
-                    if event not in raw_events:
-                        raw_events.append(event)
+        for stack_file in get_manifest(path, result_file)["files"]:
+            job_process = stack_file["process"]
+            event = stack_file["event"]
+            process = re.sub(job + "_", "", job_process)
+            job = job.partition("_proc")[0]
+            if process not in processes[job]:
+                processes[job].append(process)
+            if event not in raw_events:
+                raw_events.append(event)
         processes[job] = natural_sort(processes[job])
     jobs = natural_sort(jobs)
     for job in jobs:
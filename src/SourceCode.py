@@ -1,23 +1,57 @@
 import os
+from collections import OrderedDict, namedtuple
 
 from src.Utilities import round_sig
 
+# Source files are cached, by path and modification time, as the html of their lines
+SourceFile = namedtuple("SourceFile", ["lines", "max_len"])
+max_cached_source_files = 16
+source_file_cache = OrderedDict()
+# Lines of the source table around the focus line, and read at a time when scrolled
+source_window = 200
+
+
+def read_source_file(file):
+    """Source file, with each line escaped and padded as a table cell"""
+    mtime = os.path.getmtime(file)
+    if file in source_file_cache and source_file_cache[file][0] == mtime:
+        source_file_cache.move_to_end(file)
+        return source_file_cache[file][1]
+    with open(file) as f:
+        lines = f.readlines()
+    max_len = 1
+    for line in lines:
+        max_len = max(max_len, len(line))
+    cells = []
+    for line in lines:
+        src = (
+            line.rstrip().replace("&", "&amp;").replace("<", "&lt").replace(">", "&gt")
+        )
+        cells.append("<td><pre>" + src.ljust(max_len) + "</pre></td>")
+    source_file = SourceFile(cells, max_len)
+    source_file_cache[file] = (mtime, source_file)
+    if len(source_file_cache) > max_cached_source_files:
+        source_file_cache.popitem(last=False)
+    return source_file
+
 
 def get_lines(frame, hpc_results):
+    """Source file and focus line of frame"""
+    no_data = {
+        "lines": SourceFile(["<td><pre>" + "No Data" + "</pre></td>"], 7),
+        "focus": 0,
+    }
     frames = hpc_results.get_frames()
     if frame in frames:
         info = frames[frame]
         file = os.path.join(hpc_results.results_dir, info[0])
         line_num = int(info[1])
-        text = {"lines": [], "focus": line_num}
         if os.path.isfile(file):
-            with open(file) as f:
-                for line in f.readlines():
-                    text["lines"].append(line)
+            text = {"lines": read_source_file(file), "focus": line_num}
         else:
-            text = {"lines": ["No Data"], "focus": 0}
+            text = no_data
     else:
-        text = {"lines": ["No Data"], "focus": 0}
+        text = no_data
     return text
 
 
@@ -55,6 +89,33 @@ def get_percentage(count, total):
         return 0.0
 
 
+def get_count_strings(inc_val, exc_val, total, event_type):
+    inc = str(inc_val)
+    exc = str(exc_val)
+    if event_type == "original":
+        pc_inc = str(round_sig(get_percentage(inc_val, total), 4))
+        pc_exc = str(round_sig(get_percentage(exc_val, total), 4))
+    else:
+        pc_inc = "-"
+        pc_exc = "-"
+    inc_str = "{} ({}%)".format(inc, pc_inc)
+    exc_str = "{} ({}%)".format(exc, pc_exc)
+    return inc_str, exc_str
+
+
+def get_source_row(line_num, cell, inc_str, exc_str, focus):
+    if line_num == focus:
+        row_html = ['<tr bgcolor="grey">']
+    else:
+        row_html = ['<tr bgcolor="white">']
+    row_html.append("<td>" + inc_str.ljust(20) + "</td>")
+    row_html.append("<td>" + exc_str.ljust(20) + "</td>")
+    row_html.append("<td>" + str(line_num).ljust(5) + ": " + "</td>")
+    row_html.append(cell)
+    row_html.append("</tr>")
+    return row_html
+
+
 def generate_empty_table():
     table_html = ["<table>", "<thead>", "<tr>"]
     table_html += [
@@ -83,18 +144,62 @@ def generate_empty_table():
     return table, "0", info
 
 
-def generate_source_code_table(stacks_data, process_id, frame, hpc_results):
+def generate_source_code_rows(
+    stacks_data, process_id, frame, hpc_results, start, stop
+):
+    """Rows of the source table for lines start to stop, and the range of lines
+    found in the file"""
     source_lines = get_lines(frame, hpc_results)
-    frames = hpc_results.get_frames()
     inclusive_counts, exclusive_counts = get_file_analysis(
         stacks_data, process_id, frame, hpc_results
     )
     total = hpc_results.get_total_value(stacks_data, process_id)
+    cells = source_lines["lines"].lines
+    start = max(start, 1)
+    stop = min(stop, len(cells))
+    table_html = []
+    for line_num in range(start, stop + 1):
+        if inclusive_counts and line_num in inclusive_counts:
+            inc_str, exc_str = get_count_strings(
+                inclusive_counts[line_num],
+                exclusive_counts[line_num],
+                total,
+                process_id.event_type,
+            )
+        else:
+            inc_str = "-"
+            exc_str = "-"
+        table_html += get_source_row(
+            line_num, cells[line_num - 1], inc_str, exc_str, source_lines["focus"]
+        )
+    return "".join(table_html), start, stop
+
+
+def generate_source_code_table(stacks_data, process_id, frame, hpc_results):
+    """Source table for the lines around the focus line of frame. Lines outside the
+    window are read with generate_source_code_rows, when scrolled to"""
+    source_lines = get_lines(frame, hpc_results)
+    frames = hpc_results.get_frames()
+    focus = source_lines["focus"]
     file = ""
     if frame in frames:
         info = frames[frame]
         file = os.path.join(hpc_results.results_dir, info[0])
-    table_html = ["<table>", "<thead>", "<tr>"]
+    rows, start, stop = generate_source_code_rows(
+        stacks_data,
+        process_id,
+        frame,
+        hpc_results,
+        focus - source_window,
+        focus + source_window,
+    )
+    table_html = [
+        '<table data-start="{}" data-stop="{}" data-length="{}">'.format(
+            start, stop, len(source_lines["lines"].lines)
+        ),
+        "<thead>",
+        "<tr>",
+    ]
     table_html += [
         "<th>Inclusive</th>",
         "<th>Exclusive</th>",
@@ -103,51 +208,19 @@ def generate_source_code_table(stacks_data, process_id, frame, hpc_results):
     ]
     table_html.append("</tr>")
     table_html.append("</thead>")
-    max_len = 1
-    for line in source_lines["lines"]:
-        max_len = max(max_len, len(line))
-    line_num = 0
-    for line in source_lines["lines"]:
-        line_num += 1
-        if inclusive_counts and line_num in inclusive_counts:
-            inc = str(inclusive_counts[line_num])
-            exc = str(exclusive_counts[line_num])
-            if process_id.event_type == "original":
-                pc_inc = str(
-                    round_sig(get_percentage(inclusive_counts[line_num], total), 4)
-                )
-                pc_exc = str(
-                    round_sig(get_percentage(exclusive_counts[line_num], total), 4)
-                )
-            else:
-                pc_inc = "-"
-                pc_exc = "-"
-            inc_str = "{} ({}%)".format(inc, pc_inc)
-            exc_str = "{} ({}%)".format(exc, pc_exc)
-        else:
-            inc_str = "-"
-            exc_str = "-"
-        if line_num == source_lines["focus"]:
-            table_html.append('<tr bgcolor="grey">')
-        else:
-            table_html.append('<tr bgcolor="white">')
-        table_html.append("<td>" + inc_str.ljust(20) + "</td>")
-        table_html.append("<td>" + exc_str.ljust(20) + "</td>")
-        table_html.append("<td>" + str(line_num).ljust(5) + ": " + "</td>")
-        src = (
-            line.rstrip().replace("&", "&amp;").replace("<", "&lt").replace(">", "&gt")
-        )
-        table_html.append("<td><pre>" + src.ljust(max_len) + "</pre></td>")
-        table_html.append("</tr>")
+    table_html.append(rows)
     table_html.append("</table>")
     table = "".join(table_html)
-    return table, source_lines["focus"]
+    # Row of the focus line in the table, after the header row
+    return table, focus - start + 1
 
 
 def generate_source_code_info(stacks_data, process_id, frame, hpc_results):
     source_lines = get_lines(frame, hpc_results)
     frames = hpc_results.get_frames()
     total = hpc_results.get_total_value(stacks_data, process_id)
+    focus = source_lines["focus"]
+    cells = source_lines["lines"].lines
     file = ""
     if frame in frames:
         info = frames[frame]
@@ -161,40 +234,19 @@ def generate_source_code_info(stacks_data, process_id, frame, hpc_results):
     ]
     table_html.append("</tr>")
     table_html.append("</thead>")
-    max_len = 1
-    for line in source_lines["lines"]:
-        max_len = max(max_len, len(line))
-    line_num = 0
-    for line in source_lines["lines"]:
-        line_num += 1
-        if line_num == source_lines["focus"]:
+    for line_num in range(max(focus - 5, 1), min(focus + 250, len(cells)) + 1):
+        if line_num == focus:
             inc_val = hpc_results.get_inclusive_value(stacks_data, process_id, frame)
             exc_val = hpc_results.get_exclusive_value(stacks_data, process_id, frame)
-            inc = str(inc_val)
-            exc = str(exc_val)
-            if process_id.event_type == "original":
-                pc_inc = str(round_sig(get_percentage(inc_val, total), 4))
-                pc_exc = str(round_sig(get_percentage(exc_val, total), 4))
-            else:
-                pc_inc = "-"
-                pc_exc = "-"
-            inc_str = "{} ({}%)".format(inc, pc_inc)
-            exc_str = "{} ({}%)".format(exc, pc_exc)
-            table_html.append('<tr bgcolor="grey">')
-        elif -5 <= line_num - source_lines["focus"] <= 250:
-            table_html.append('<tr bgcolor="white">')
+            inc_str, exc_str = get_count_strings(
+                inc_val, exc_val, total, process_id.event_type
+            )
+        else:
             inc_str = "-"
             exc_str = "-"
-        else:
-            continue
-        table_html.append("<td>" + inc_str.ljust(20) + "</td>")
-        table_html.append("<td>" + exc_str.ljust(20) + "</td>")
-        table_html.append("<td>" + str(line_num).ljust(5) + ": " + "</td>")
-        src = (
-            line.rstrip().replace("&", "&amp;").replace("<", "&lt").replace(">", "&gt")
+        table_html += get_source_row(
+            line_num, cells[line_num - 1], inc_str, exc_str, focus
         )
-        table_html.append("<td><pre>" + src.ljust(max_len) + "</pre></td>")
-        table_html.append("</tr>")
     table_html.append("</table>")
     table = "".join(table_html)
     return table
@@ -2,6 +2,7 @@
 
 from collections import defaultdict, Set
 import argparse
+import os
 import re
 
 
@@ -13,6 +14,7 @@ accumulate = False
 trace_event = ""
 output_file = ""
 multiplier = 1
+process_id = ""
 order = defaultdict(list)
 collapsed = defaultdict(dict)
 previous_stacks = defaultdict(lambda: "")
@@ -20,10 +22,15 @@ samples = defaultdict(lambda: "")
 event_sample = defaultdict(lambda: "")
 trace_buffer = []
 files = set()
+threads = defaultdict(set)
 stack = []
 time = 0.0
 previous_time = 0.0
 start_time = -1.0
+# Process name exe-pid/tid at the start of stack, trace and secondary event lines
+header_regex = re.compile(
+    "^((?:secondary-event;)?[^;]*-)(all|[?]|[0-9]+)/(all|[0-9]+)(?=[; :])"
+)
 
 
 def remember_stack(primary_event, stack, count):
@@ -105,6 +112,38 @@ def dump_stacks():
     order = defaultdict(list)
 
 
+def natural_key(text):
+    return [int(c) if c.isdigit() else c for c in re.split("([0-9]+)", text)]
+
+
+def get_thread_ids(filename):
+    # Map thread ids to sequential ids, starting from zero
+    tids = {"all": "all"}
+    n = 0
+    for tid in sorted(threads[filename], key=natural_key):
+        if tid != "all":
+            tids[tid] = str(n)
+            n += 1
+    return tids
+
+
+def renumber_process_ids(filename):
+    # Replace process and thread ids in the process name at the start of each line
+    tids = get_thread_ids(filename)
+    temp_file = filename + ".tmp"
+    with open(filename, "r") as f, open(temp_file, "wb") as new_file:
+        for line in f:
+            match = header_regex.match(line)
+            if match:
+                pid = match.group(2)
+                if process_id != "" and pid != "all":
+                    pid = process_id
+                tid = tids.get(match.group(3), match.group(3))
+                line = match.group(1) + pid + "/" + tid + line[match.end() :]
+            new_file.write(line.encode())
+    os.rename(temp_file, filename)
+
+
 def finalise():
     global telapsed
     for filename in files:
@@ -113,6 +152,8 @@ def finalise():
         l = "t=" + "{:.2f}".format(telapsed)
         f.write(l.encode())
         f.close()
+        if include_tid:
+            renumber_process_ids(filename)
 
 
 def collapse_stacks(input_file):
@@ -220,6 +261,10 @@ def collapse_stacks(input_file):
                 # for system wide mode accumulate sum over physical cpus
                 if accumulate and cid != "":
                     pid = cid
+                if trace_event != "":
+                    threads[output_file + "_trace-" + trace_event].add(tid)
+                else:
+                    threads[output_file + "_" + primary_event].add(tid)
                 if include_tid:
                     pname = match.group(1) + "-" + pid + "/" + tid
                     pname_sum_threads = match.group(1) + "-" + pid + "/all"
@@ -304,6 +349,13 @@ if __name__ == "__main__":
         dest="multiplier",
         help="Integer multiplier for event counts",
     )
+    parser.add_argument(
+        "-process_id",
+        "--process_id",
+        default="",
+        dest="process_id",
+        help="Replace process ids with this id",
+    )
     args = parser.parse_args()
     include_pid = args.include_pid
     include_tid = args.include_tid
@@ -313,4 +365,5 @@ if __name__ == "__main__":
     input_file = args.input_file
     output_file = args.output_file
     multiplier = args.multiplier
+    process_id = args.process_id
     collapse_stacks(input_file)
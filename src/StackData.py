@@ -1,6 +1,9 @@
+import heapq
 import os
 import re
 import sys
+import weakref
+from tempfile import mkstemp
 from concurrent.futures import ProcessPoolExecutor
 from collections import OrderedDict, defaultdict
 from timeit import default_timer as timer
@@ -10,10 +13,16 @@ from src.CustomEvents import (
     event_to_raw_event,
     raw_event_to_event,
     get_event_type,
-    create_custom_event_stack,
     is_composite_event,
+    split_composite_event,
+    get_virtual_event_counter,
+    read_composite_event_lines,
+)
+from src.ResultsHandler import (
+    get_job_name,
+    get_event_counters,
+    get_process_to_event_map,
 )
-from src.ResultsHandler import get_job_name, get_event_counters
 
 
 def get_job(task_or_label):
@@ -71,6 +80,12 @@ def make_label(job, processor, event, pid, tid):
     return label
 
 
+def remove_files(files):
+    for file in files.values():
+        if os.path.isfile(file):
+            os.remove(file)
+
+
 def multi_run_wrapper(args):
     return worker(*args)
 
@@ -111,6 +126,27 @@ class StackDataID:
         self.max_percentage = 0.0
 
 
+class RankedIndex:
+    """Nodes ranked by value, largest first, with ties in insertion order. Entries are
+    only taken from the heap as far down the ranking as has been requested, so paging
+    through the top entries does not sort all of the nodes."""
+
+    def __init__(self, values):
+        self.heap = [(-value, n, node) for n, (node, value) in enumerate(values.items())]
+        heapq.heapify(self.heap)
+        self.ranked = []
+
+    def __len__(self):
+        return len(self.ranked) + len(self.heap)
+
+    def get_range(self, start_index, end_index):
+        """List of (node, value) for ranks [start_index, end_index)"""
+        while len(self.ranked) < end_index and self.heap:
+            value, _, node = heapq.heappop(self.heap)
+            self.ranked.append((node, -value))
+        return self.ranked[start_index:end_index]
+
+
 class ReadStacksTask:
     def __init__(
         self,
@@ -123,9 +159,15 @@ class ReadStacksTask:
         event_type,
         counter,
         time_interval,
+        event_files=None,
+        raw_event_counters=None,
+        compressed_file=None,
     ):
         self.task_id = task_id
         self.filename = filename
+        if compressed_file is None:
+            compressed_file = filename + "_compressed"
+        self.compressed_file = compressed_file
         self.job = job
         self.process_name = process_name
         self.event = event
@@ -133,6 +175,11 @@ class ReadStacksTask:
         self.event_type = event_type
         self.event_counter = counter
         self.time_interval = time_interval
+        # Composite events are not written to file, but evaluated from the stacks
+        # files of their events (event_files) as they are read, and their compressed
+        # stacks are kept in a temporary file
+        self.event_files = event_files
+        self.raw_event_counters = raw_event_counters
         self.work = {}
         self.stacks = {}
         self.X = {}
@@ -140,50 +187,58 @@ class ReadStacksTask:
         self.count = {}
 
     def execute(self, start_time, stop_time):
-        file = self.filename
         event_type = self.event_type
         time = -1.0
         process_id_regex = re.compile("((all|[0-9]+)/(all|[0-9]+))")
-        with open(file) as infile:
+        for line in self.read_lines():
+            line = line.strip()
+            if line[0:2] == "t=":
+                t = line.partition("=")[2]
+                time = float(t)
+                self.update_timelines(event_type, time)
+                if start_time < time <= stop_time:
+                    self.update_stacks(event_type)
+                for pid in self.count:
+                    for tid in self.count[pid]:
+                        self.count[pid][tid] = [0, 0]
+            elif start_time <= time <= stop_time:
+                stack = line
+                if event_type == "custom_event_ratio":
+                    stack, _, secondary = stack.rpartition(" ")
+                stack, _, primary = stack.rpartition(" ")
+                match = re.search(process_id_regex, line)
+                if match:
+                    pid = match.group(2)
+                    tid = match.group(3)
+                    if pid not in self.count:
+                        self.work[pid] = {}
+                        self.count[pid] = {}
+                    if tid not in self.count[pid]:
+                        self.work[pid][tid] = OrderedDict()
+                        self.count[pid][tid] = [0, 0]
+                    if stack:
+                        c0 = int(primary)
+                        if event_type == "custom_event_ratio":
+                            c1 = int(secondary)
+                        else:
+                            c1 = c0
+                        self.count[pid][tid][0] += c0
+                        self.count[pid][tid][1] += c1
+                        if stack in self.work[pid][tid]:
+                            self.work[pid][tid][stack][0] += c0
+                            self.work[pid][tid][stack][1] += c1
+                        else:
+                            self.work[pid][tid][stack] = [c0, c1]
+
+    def read_lines(self):
+        if self.event_files:
+            yield from read_composite_event_lines(
+                self.raw_event, self.event_files, self.raw_event_counters
+            )
+            return
+        with open(self.filename) as infile:
             for line in infile:
-                line = line.strip()
-                if line[0:2] == "t=":
-                    t = line.partition("=")[2]
-                    time = float(t)
-                    self.update_timelines(event_type, time)
-                    if start_time < time <= stop_time:
-                        self.update_stacks(event_type)
-                    for pid in self.count:
-                        for tid in self.count[pid]:
-                            self.count[pid][tid] = [0, 0]
-                elif start_time <= time <= stop_time:
-                    stack = line
-                    if event_type == "custom_event_ratio":
-                        stack, _, secondary = stack.rpartition(" ")
-                    stack, _, primary = stack.rpartition(" ")
-                    match = re.search(process_id_regex, line)
-                    if match:
-                        pid = match.group(2)
-                        tid = match.group(3)
-                        if pid not in self.count:
-                            self.work[pid] = {}
-                            self.count[pid] = {}
-                        if tid not in self.count[pid]:
-                            self.work[pid][tid] = OrderedDict()
-                            self.count[pid][tid] = [0, 0]
-                        if stack:
-                            c0 = int(primary)
-                            if event_type == "custom_event_ratio":
-                                c1 = int(secondary)
-                            else:
-                                c1 = c0
-                            self.count[pid][tid][0] += c0
-                            self.count[pid][tid][1] += c1
-                            if stack in self.work[pid][tid]:
-                                self.work[pid][tid][stack][0] += c0
-                                self.work[pid][tid][stack][1] += c1
-                            else:
-                                self.work[pid][tid][stack] = [c0, c1]
+                yield line
 
     def update_stacks(self, event_type):
         for pid in self.work:
@@ -242,7 +297,7 @@ class ReadStacksTask:
                     self.Y[pid][tid].append(r)
 
     def write_stacks(self):
-        output_file = self.filename + "_compressed"
+        output_file = self.compressed_file
         f = open(output_file, "wb")
         for pid in self.stacks:
             for tid in self.stacks[pid]:
@@ -302,6 +357,9 @@ class StackData:
         self.time_interval = 0.0
         self.cpu = ""
         self.tasks = OrderedDict()
+        # Temporary compressed stacks files of composite events, by task id
+        self.virtual_event_files = {}
+        weakref.finalize(self, remove_files, self.virtual_event_files)
         self.stacks = {}
         self.filtered_stacks = {}
         self.filtered_stacks_x = {}
@@ -312,22 +370,19 @@ class StackData:
         self.work = {}
         self.count = {}
         self.totals = {}
+        self.totals_stack_map = None
+        self.node_values = {}
+        self.ranked_nodes = {}
         self.event_counters = get_event_counters(path, results_files)
         self.collapsed_stacks_filename = "data_stacks_collapsed"
         self.initial_count = 0
         self.event = event
         self.process = process
-        if self.event:  # Check for composite event
-            if is_composite_event(self.event):
-                create_custom_event_stack(self, results_files, self.event)
-                self.event_counters = get_event_counters(
-                    path, results_files
-                )  # Update counters with new custom event
+        self.debug = debug
+        self.n_proc = n_proc
         assert not (event and process)
         self.ordered_ids = []
         self.default_ids = []
-        self.debug = debug
-        self.n_proc = n_proc
         if debug:
             start = timer()
         self.read_data(initialise=True)  # Read all data on the first pass
@@ -418,6 +473,64 @@ class StackData:
                                 counter,
                                 self.time_interval,
                             )
+            self.create_virtual_event_tasks(result_file)
+
+    def create_virtual_event_tasks(self, result_file):
+        """Create tasks for composite events not found in the results file, to be
+        evaluated from the stacks of their events"""
+        if self.event:
+            raw_events = [self.event] if is_composite_event(self.event) else []
+        else:
+            raw_events = [
+                raw_event
+                for raw_event in self.cpu_definition.get_active_raw_events()
+                if is_composite_event(raw_event)
+            ]
+        if len(raw_events) == 0:
+            return
+        job = get_job_name(result_file)
+        units = self.cpu_definition.get_active_event_units()
+        found = get_process_to_event_map(self.path, result_file)
+        for process in found:
+            if self.process and self.process != process:
+                continue
+            process_name = re.sub(job + "_", "", process)
+            for raw_event in raw_events:
+                numerator, denominator = split_composite_event(raw_event)
+                events = numerator + denominator
+                if raw_event in found[process] or not all(
+                    e in found[process] for e in events
+                ):
+                    continue
+                event = raw_event_to_event(raw_event, self.cpu_definition)
+                if units.get(event, "Samples") == "Samples":
+                    counter = get_virtual_event_counter(
+                        raw_event, self.event_counters[job]
+                    )
+                else:
+                    counter = 1
+                task_id = process + "_" + event
+                event_files = {
+                    e: os.path.join(self.path, process + "_" + e) for e in events
+                }
+                if task_id not in self.virtual_event_files:
+                    fh, abs_path = mkstemp(suffix="_compressed")
+                    os.close(fh)
+                    self.virtual_event_files[task_id] = abs_path
+                self.tasks[task_id] = ReadStacksTask(
+                    task_id,
+                    os.path.join(self.path, process + "_" + raw_event),
+                    job,
+                    process_name,
+                    event,
+                    raw_event,
+                    get_event_type(event),
+                    counter,
+                    self.time_interval,
+                    event_files=event_files,
+                    raw_event_counters=self.event_counters[job],
+                    compressed_file=self.virtual_event_files[task_id],
+                )
 
     def data_update_required(self, start, stop):
         if self.start >= 0.0:
@@ -504,6 +617,7 @@ class StackData:
         keyword = re.compile(self.text_filter)
         process_id_regex = re.compile("((all|[0-9]+)/(all|[0-9]+))")
         self.totals = {}
+        self.totals_stack_map = self.stack_map
         self.count = {}
         for task in self.tasks:
             task_id = self.tasks[task].task_id
@@ -514,7 +628,7 @@ class StackData:
             self.count[task_id] = {}
             counter = self.tasks[task_id].event_counter
             event_type = self.tasks[task].event_type
-            input_file = self.tasks[task].filename + "_compressed"
+            input_file = self.tasks[task].compressed_file
             fin = open(input_file, "r")
             for line in fin:
                 k = keyword.search(line)
@@ -586,7 +700,8 @@ class StackData:
         self.selected_ids = ids
 
     def get_totals(self):
-        if self.stack_map:
+        # Totals are only recomputed for a new stack map
+        if self.stack_map and self.stack_map is not self.totals_stack_map:
             self.compute_totals()
         return self.totals
 
@@ -832,6 +947,40 @@ class StackData:
         self.filtered_stacks_x = {}
         self.filtered_stacks_y = {}
         self.filtered_stacks = {}
+        self.node_values = {}
+        self.ranked_nodes = {}
+
+    def get_node_values(self, process_id):
+        """Event count for each function (the last node of the stacks), or the ratio of
+        counts for custom event ratios, where the second count is at least 0.1"""
+        key = (process_id.task_id, process_id.pid, process_id.tid)
+        if key in self.node_values:
+            return self.node_values[key]
+        if self.tasks[process_id.task_id].event_type == "custom_event_ratio":
+            x_data, y_data = self.get_custom_event_ratio_stack_data(process_id)
+            x = defaultdict(float)
+            for stack in x_data:
+                x[stack.rpartition(";")[2]] += x_data[stack]
+            y = defaultdict(float)
+            for stack in y_data:
+                y[stack.rpartition(";")[2]] += y_data[stack]
+            values = {s: float(y[s]) / float(x[s]) for s in x if float(x[s]) >= 0.1}
+        else:
+            x_data = self.get_original_event_stack_data(process_id)
+            values = defaultdict(float)
+            for stack in x_data:
+                values[stack.rpartition(";")[2]] += x_data[stack]
+            values = dict(values)
+        self.node_values[key] = values
+        return values
+
+    def get_ranked_node_values(self, process_id, start_index, end_index):
+        """Ranks [start_index, end_index) of the functions, by get_node_values,
+        as a list of (function, value)"""
+        key = (process_id.task_id, process_id.pid, process_id.tid)
+        if key not in self.ranked_nodes:
+            self.ranked_nodes[key] = RankedIndex(self.get_node_values(process_id))
+        return self.ranked_nodes[key].get_range(start_index, end_index)
 
     def get_custom_event_ratio_stack_data(self, process_id):
         keyword = re.compile(self.text_filter)
@@ -856,7 +1005,7 @@ class StackData:
             for proc_id in ids
             if proc_id.task_id == task_id
         }
-        input_file = self.tasks[task_id].filename + "_compressed"
+        input_file = self.tasks[task_id].compressed_file
         fin = open(input_file, "r")
         for line in fin:
             k = keyword.search(line)
@@ -925,7 +1074,7 @@ class StackData:
             for proc_id in ids
             if proc_id.task_id == task_id
         }
-        input_file = self.tasks[task_id].filename + "_compressed"
+        input_file = self.tasks[task_id].compressed_file
         fin = open(input_file, "r")
         for line in fin:
             k = keyword.search(line)
@@ -989,7 +1138,7 @@ def write_flamegraph_stacks(
                 if proc_id.task_id == task_id
             }
             if len(pids) > 0:
-                input_file = stack_data.tasks[task].filename + "_compressed"
+                input_file = stack_data.tasks[task].compressed_file
                 fin = open(input_file, "r")
                 for line in fin:
                     k = keyword.search(line)
@@ -1038,7 +1187,7 @@ def write_flamegraph_stacks(
                 if proc_id.task_id == task_id
             }
             if len(pids) > 0:
-                input_file = stack_data.tasks[task].filename + "_compressed"
+                input_file = stack_data.tasks[task].compressed_file
                 fin = open(input_file, "r")
                 for line in fin:
                     k = keyword.search(line)
@@ -1093,7 +1242,7 @@ def write_flamegraph_stacks(
             }
             if len(pids) > 0:
                 if event_type == output_event_type:
-                    input_file = stack_data.tasks[task].filename + "_compressed"
+                    input_file = stack_data.tasks[task].compressed_file
                     fin = open(input_file, "r")
                     for line in fin:
                         k = keyword.search(line)
@@ -1131,7 +1280,7 @@ def write_flamegraph_stacks(
                 if proc_id.task_id == task_id
             }
             if len(pids) > 0:
-                input_file = stack_data.tasks[task].filename + "_compressed"
+                input_file = stack_data.tasks[task].compressed_file
                 fin = open(input_file, "r")
                 for line in fin:
                     k = keyword.search(line)
@@ -407,52 +407,25 @@ class TimeLines:
         )
 
     def process_stacks(self):
-        process_id_regex = re.compile("((all|[0-9]+)/(all|[0-9]+))")
-        for line in self.data:
-            line = line.strip()
-            if re.search("secondary-event", line):
-                match = re.search(process_id_regex, line)
-                if match:
-                    pid = match.group(2)
-                    tid = match.group(3)
-                    match2 = re.match("secondary-event;(.*)\s+(.*)\s+(.*)", line)
-                    if match2:
-                        line, _, time = line.rpartition(" ")
-                        event = line.rpartition(" ")[2]
-                        if pid not in self.secondary_events:
-                            self.secondary_events[pid] = OrderedDict()
-                        if tid not in self.secondary_events[pid]:
-                            self.secondary_events[pid][tid] = []
-                        self.secondary_events[pid][tid].append((event, float(time)))
-            elif re.search("sample-rate", line):
-                match = re.search(process_id_regex, line)
-                if match:
-                    pid = match.group(2)
-                    tid = match.group(3)
-                    if pid not in self.sample_rates:
-                        self.sample_rates[pid] = OrderedDict()
-                    if tid not in self.sample_rates[pid]:
-                        self.sample_rates[pid][tid] = []
-                    line, _, rate = line.rpartition(" ")
-                    time = line.rpartition(" ")[2]
-                    self.sample_rates[pid][tid].append((float(time), float(rate)))
-                    self.max_sample_rate = max(self.max_sample_rate, float(rate))
-            else:
-                match = re.search(process_id_regex, line)
-                if match:
-                    pid = match.group(2)
-                    tid = match.group(3)
-                    if pid not in self.timelines:
-                        self.timelines[pid] = OrderedDict()
-                    if tid not in self.timelines[pid]:
-                        self.timelines[pid][tid] = []
-                        self.nlevels += 1
-                    line, _, count = line.rpartition(" ")
-                    line, _, end = line.rpartition(" ")
-                    line, _, start = line.rpartition(" ")
-                    func = line.rpartition(";")[2]
-                    if func:
-                        self.timelines[pid][tid].append((func, start, end, int(count)))
+        for pid in self.data.timelines:
+            self.timelines[pid] = OrderedDict()
+            for tid in self.data.timelines[pid]:
+                self.timelines[pid][tid] = [
+                    timeline
+                    for timeline in self.data.timelines[pid][tid]
+                    if timeline[0]
+                ]
+                self.nlevels += 1
+        for pid in self.data.sample_rates:
+            self.sample_rates[pid] = OrderedDict()
+            for tid in self.data.sample_rates[pid]:
+                self.sample_rates[pid][tid] = self.data.sample_rates[pid][tid]
+                for time, rate in self.sample_rates[pid][tid]:
+                    self.max_sample_rate = max(self.max_sample_rate, rate)
+        for pid in self.data.secondary_events:
+            self.secondary_events[pid] = OrderedDict()
+            for tid in self.data.secondary_events[pid]:
+                self.secondary_events[pid][tid] = self.data.secondary_events[pid][tid]
         self.make_svg()
 
     def make_svg(self):
@@ -0,0 +1,201 @@
+from array import array
+from bisect import bisect_left, bisect_right
+
+# Bucket summaries are stored as parallel arrays of:
+#   best interval, best overlap, first interval, first overlap,
+#   last interval, last overlap, number of samples.
+# Intervals of a thread are disjoint and time ordered, so the only interval which can
+# span two adjacent buckets is the last interval of the left bucket, which allows the
+# dominant interval of any range of buckets to be combined exactly from the summaries.
+EMPTY = -1
+BEST, BEST_LEN, FIRST, FIRST_LEN, LAST, LAST_LEN, SAMPLES = range(7)
+EMPTY_BUCKET = (EMPTY, -1.0, EMPTY, 0.0, EMPTY, 0.0, 0.0)
+
+
+def combine_buckets(a, b):
+    """Combine the summaries of two adjacent buckets, where a precedes b"""
+    if a[BEST] == EMPTY:
+        return b
+    if b[BEST] == EMPTY:
+        return a
+    # Ties are resolved in favour of the earliest interval
+    best, best_len = a[BEST], a[BEST_LEN]
+    if b[BEST_LEN] > best_len:
+        best, best_len = b[BEST], b[BEST_LEN]
+    if a[LAST] == b[FIRST]:
+        joined = a[LAST_LEN] + b[FIRST_LEN]
+        if joined > best_len or (joined == best_len and a[LAST] < best):
+            best, best_len = a[LAST], joined
+    first, first_len = a[FIRST], a[FIRST_LEN]
+    if a[FIRST] == a[LAST] == b[FIRST]:
+        first_len += b[FIRST_LEN]
+    last, last_len = b[LAST], b[LAST_LEN]
+    if b[FIRST] == b[LAST] == a[LAST]:
+        last_len += a[LAST_LEN]
+    return best, best_len, first, first_len, last, last_len, a[SAMPLES] + b[SAMPLES]
+
+
+class PyramidLevel:
+    """Bucket summaries for a regular grid of n buckets of width dt, starting at t = 0"""
+
+    def __init__(self, dt, n):
+        self.dt = dt
+        self.n = n
+        self.columns = [
+            array("l", [EMPTY]) * n,
+            array("d", [-1.0]) * n,
+            array("l", [EMPTY]) * n,
+            array("d", [0.0]) * n,
+            array("l", [EMPTY]) * n,
+            array("d", [0.0]) * n,
+            array("d", [0.0]) * n,
+        ]
+
+    def get(self, i):
+        c = self.columns
+        return c[0][i], c[1][i], c[2][i], c[3][i], c[4][i], c[5][i], c[6][i]
+
+    def coarsen(self):
+        """Level with half the resolution, combining pairs of adjacent buckets"""
+        coarse = PyramidLevel(2.0 * self.dt, self.n // 2)
+        even = zip(*[column[0::2] for column in self.columns])
+        odd = zip(*[column[1::2] for column in self.columns])
+        buckets = [combine_buckets(a, b) for a, b in zip(even, odd)]
+        for j, column in enumerate(coarse.columns):
+            column[:] = array(column.typecode, [bucket[j] for bucket in buckets])
+        return coarse
+
+    def combine(self, i_begin, i_end):
+        """Summary of buckets i_begin to i_end - 1"""
+        bucket = EMPTY_BUCKET
+        for i in range(max(0, i_begin), min(self.n, i_end)):
+            bucket = combine_buckets(bucket, self.get(i))
+        return bucket
+
+
+class ThreadTimeline:
+    """Multi-resolution summary of the dominant trace node over time, for a single thread.
+
+    The intervals are collected when the thread is read, and the levels are built once
+    the end time of the whole trace is known. Level 0 is the coarsest level, with
+    base_intervals buckets spanning [0, t_end]. Each subsequent level doubles the
+    resolution, until the buckets are approximately as fine as the trace intervals,
+    or max_depth levels have been created. Requests for a time window are served by
+    slicing the coarsest level with sufficient resolution, or from the raw intervals
+    when the window is narrower than the finest level can represent."""
+
+    def __init__(self, trace, base_intervals=200, max_depth=10, oversample=4):
+        self.t_end = 0.0
+        self.base_intervals = base_intervals
+        self.max_depth = max_depth
+        self.oversample = oversample
+        self.nodes = []
+        self.starts = array("d")
+        self.ends = array("d")
+        self.sample_times = array("d")
+        self.levels = []
+        for time_slice in trace:
+            for time_slice_interval in time_slice:
+                samples = time_slice_interval["samples"]
+                self.nodes.append(time_slice_interval["stack"].rpartition(";")[2])
+                self.starts.append(samples[0])
+                self.ends.append(samples[-1])
+                self.sample_times.extend(samples)
+
+    def build_levels(self, t_end):
+        """Create the levels of the pyramid, spanning [0, t_end]"""
+        self.t_end = t_end
+        self.levels = []
+        if t_end <= 0.0:
+            return
+        depth = 0
+        n = self.base_intervals
+        while n < len(self.nodes) and depth < self.max_depth:
+            n *= 2
+            depth += 1
+        finest = self.bucket_intervals(0.0, t_end / float(n), n)
+        self.levels = [finest]
+        while self.levels[0].n > self.base_intervals:
+            self.levels.insert(0, self.levels[0].coarsen())
+
+    def bucket_intervals(self, t1, dt, n):
+        """Exact bucket summaries for the n buckets of width dt starting at t1, using the
+        same overlap rules as a direct scan over the trace intervals"""
+        level = PyramidLevel(dt, n)
+        t2 = t1 + n * dt
+        best, best_len, first, first_len, last, last_len, samples = level.columns
+        k_begin = bisect_right(self.ends, t1)
+        k_end = bisect_right(self.starts, t2)
+        for k in range(k_begin, k_end):
+            start = self.starts[k]
+            end = self.ends[k]
+            i_begin = int(max(0.0, start - t1) / dt)
+            i_end = int(min(t2 - t1, end - t1) / dt)
+            for i in range(i_begin, i_end + 1):
+                x1 = max(t1 + i * dt, start)
+                x2 = min(t1 + (i + 1) * dt, end)
+                index = min(i, n - 1)
+                overlap = x2 - x1
+                if last[index] == k:
+                    last_len[index] += overlap
+                    if first[index] == k:
+                        first_len[index] += overlap
+                else:
+                    if first[index] == EMPTY:
+                        first[index] = k
+                        first_len[index] = overlap
+                    last[index] = k
+                    last_len[index] = overlap
+                if overlap > best_len[index]:
+                    best[index] = k
+                    best_len[index] = overlap
+        s_begin = bisect_left(self.sample_times, t1)
+        s_end = bisect_right(self.sample_times, t2)
+        for s in range(s_begin, s_end):
+            samples[min(int((self.sample_times[s] - t1) / dt), n - 1)] += 1.0
+        return level
+
+    def select_level(self, t1, dt):
+        """Coarsest level which is aligned with, or sufficiently finer than, the requested grid"""
+        for level in self.levels:
+            ratio = dt / level.dt
+            offset = t1 / level.dt
+            if (
+                round(ratio) >= 1
+                and abs(ratio - round(ratio)) < 1.0e-6
+                and abs(offset - round(offset)) < 1.0e-6
+            ):
+                return level, True
+            if ratio >= self.oversample:
+                return level, False
+        return None, False
+
+    def get_buckets(self, t1, t2, n):
+        """Return the dominant node and sample rate for each of n buckets spanning [t1, t2]"""
+        dt = (t2 - t1) / float(n)
+        level, aligned = self.select_level(t1, dt)
+        if level is None:
+            level = self.bucket_intervals(t1, dt, n)
+            buckets = [(level.get(i), dt) for i in range(n)]
+        else:
+            buckets = []
+            for i in range(n):
+                i_begin = int(round((t1 + i * dt) / level.dt))
+                i_end = int(round((t1 + (i + 1) * dt) / level.dt))
+                if aligned:
+                    width = dt
+                else:
+                    width = (min(i_end, level.n) - max(i_begin, 0)) * level.dt
+                buckets.append((level.combine(i_begin, i_end), width))
+        nodes = []
+        rates = []
+        for bucket, width in buckets:
+            if bucket[BEST] == EMPTY:
+                nodes.append("no_samples")
+            else:
+                nodes.append(self.nodes[bucket[BEST]])
+            if width > 0.0:
+                rates.append(bucket[SAMPLES] * dt / width)
+            else:
+                rates.append(0.0)
+        return nodes, rates
@@ -1,14 +1,19 @@
 import re
 import os
 import sys
-from collections import OrderedDict
+from collections import OrderedDict, namedtuple
 from concurrent.futures import ProcessPoolExecutor
 from timeit import default_timer as timer
 import operator
+from array import array
 
 from src.ResultsHandler import get_job_name, get_event_counters
 from src.CustomEvents import raw_event_to_event
 from src.Utilities import natural_sort, is_float
+from src.TimelinePyramid import ThreadTimeline
+from src.CallStatistics import compute_call_statistics
+
+TimelineData = namedtuple("TimelineData", ["timelines", "sample_rates", "secondary_events"])
 
 
 def get_job(task_or_label):
@@ -37,6 +42,62 @@ def get_tid(task_or_label):
     return tid
 
 
+def index_trace_threads(filename):
+    """Byte ranges of the runs of consecutive lines of each thread in a trace file"""
+    process_id_regex = re.compile(b"((all|[0-9]+)/(all|[0-9]+))")
+    threads = OrderedDict()
+    thread_id = None
+    run_start = 0
+    offset = 0
+    with open(filename, "rb") as infile:
+        for line in infile:
+            match = process_id_regex.search(line)
+            line_thread_id = match.group(1) if match else None
+            if line_thread_id != thread_id:
+                if thread_id is not None:
+                    threads[thread_id].extend((run_start, offset))
+                thread_id = line_thread_id
+                run_start = offset
+                if thread_id is not None and thread_id not in threads:
+                    threads[thread_id] = array("q")
+            offset += len(line)
+    if thread_id is not None:
+        threads[thread_id].extend((run_start, offset))
+    return threads
+
+
+def split_trace_threads(threads, n_shards):
+    """Assign whole threads to at most n_shards shards of similar size, and merge the
+    byte ranges of each shard in file order"""
+    shard_threads = [[] for _ in range(n_shards)]
+    shard_sizes = [0] * n_shards
+    thread_sizes = {
+        thread_id: sum(ranges[1::2]) - sum(ranges[0::2])
+        for thread_id, ranges in threads.items()
+    }
+    for thread_id in sorted(threads, key=lambda t: thread_sizes[t], reverse=True):
+        shard = shard_sizes.index(min(shard_sizes))
+        shard_threads[shard].append(thread_id)
+        shard_sizes[shard] += thread_sizes[thread_id]
+    shard_ranges = []
+    for thread_ids in shard_threads:
+        if not thread_ids:
+            continue
+        runs = []
+        for thread_id in thread_ids:
+            ranges = threads[thread_id]
+            runs += zip(ranges[0::2], ranges[1::2])
+        runs.sort()
+        ranges = array("q")
+        for start, end in runs:
+            if ranges and ranges[-1] == start:
+                ranges[-1] = end
+            else:
+                ranges.extend((start, end))
+        shard_ranges.append(ranges)
+    return shard_ranges
+
+
 def worker(task):
     task.execute()
     return {
@@ -45,9 +106,18 @@ def worker(task):
         "trace_data": task.trace_data,
         "secondary_event_samples": task.secondary_event_samples,
         "time_norm": task.time_norm,
+        "timelines": task.timelines,
+        "node_totals": task.node_totals,
+        "augmented_nodes": task.augmented_nodes,
     }
 
 
+def timeline_worker(args):
+    timeline, t_end = args
+    timeline.build_levels(t_end)
+    return timeline
+
+
 class TraceDataID:
     """Metadata for collapsed stacks trace data for a specific job, event, process, and thread."""
 
@@ -91,6 +161,8 @@ class ReadTraceTask:
         counter,
         time_scale,
         sample_weight,
+        timeline_intervals=200,
+        ranges=None,
     ):
         self.task_id = task_id
         self.filename = filename
@@ -102,6 +174,8 @@ class ReadTraceTask:
         self.event_counter = counter
         self.time_scale = time_scale
         self.sample_weight = sample_weight
+        self.timeline_intervals = timeline_intervals
+        self.ranges = ranges
         self.trace_data = {}
         self.start_time = -1.0
         self.totals = {}
@@ -109,89 +183,144 @@ class ReadTraceTask:
         self.sample_rates = {}
         self.secondary_event_samples = {}
         self.ordered_nodes = []
+        self.node_totals = {}
+        self.augmented_nodes = {}
         self.time_norm = 0.0
         self.previous_stacks = {}
         self.previous_context = {}
         self.call_counts = {}
 
+    def split(self, n_shards):
+        """Split the task into shards, which each read the byte ranges of a subset of
+        the threads in the file. The file is indexed once, so that each shard only
+        reads its own threads"""
+        threads = index_trace_threads(self.filename)
+        return [
+            ReadTraceTask(
+                self.task_id,
+                self.filename,
+                self.job,
+                self.process_name,
+                self.event,
+                self.raw_event,
+                self.event_type,
+                self.event_counter,
+                self.time_scale,
+                self.sample_weight,
+                timeline_intervals=self.timeline_intervals,
+                ranges=ranges,
+            )
+            for ranges in split_trace_threads(threads, n_shards)
+        ]
+
+    def read_lines(self):
+        """Lines of the trace file, or of the byte ranges of the shard"""
+        if self.ranges is None:
+            with open(self.filename) as infile:
+                for line in infile:
+                    yield line
+            return
+        with open(self.filename, "rb") as infile:
+            for i in range(0, len(self.ranges), 2):
+                infile.seek(self.ranges[i])
+                offset = self.ranges[i]
+                while offset < self.ranges[i + 1]:
+                    line = infile.readline()
+                    offset += len(line)
+                    yield line.decode()
+
     def execute(self):
-        last_sample = 0.0
         previous_exit_times = {}
-        file = self.filename
         process_id_regex = re.compile("((all|[0-9]+)/(all|[0-9]+))")
-        with open(file) as infile:
-            for line in infile:
-                line = line.strip()
-                match = re.search(process_id_regex, line)
-                if match:
-                    pid = match.group(2)
-                    tid = match.group(3)
-                    match2 = re.match("secondary-event;([^:]+):(.*):\s*(.*)", line)
-                    if match2:
-                        event = match2.group(2)
-                        samples = match2.group(3)
-                        samples = samples.split(" ")
-                        if pid not in self.secondary_event_samples:
-                            self.secondary_event_samples[pid] = {}
-                        if tid not in self.secondary_event_samples[pid]:
-                            self.secondary_event_samples[pid][tid] = {}
-                        if event not in self.secondary_event_samples[pid][tid]:
-                            self.secondary_event_samples[pid][tid][event] = []
-                        for sample in samples:
-                            self.secondary_event_samples[pid][tid][event].append(
-                                float(sample)
-                            )
-                        continue
-                    this_id = pid + "-" + tid
-                    stack = line
-                    data = stack.split(" ")
-                    samples = [float(x) for x in data[1:] if is_float(x)]
-                    n = len(data)
-                    m = len(samples)
-                    stack = " ".join(data[0 : n - m])
-                    frames = stack.split(";")
-                    if len(frames) == 1:
-                        frames.append("-")  # No context information
-                    this_context = this_id + frames[1]
-                    if this_context not in self.previous_context:
-                        self.previous_context[this_context] = ""
-                        self.call_counts[this_context] = {}
-                    previous_stack = self.previous_context[this_context]
-                    self.unwind_stacks(this_context, frames, previous_stack)
-                    self.previous_context[this_context] = stack
-                    new_stack = frames[0:2]
-                    for i in range(2, len(frames)):
-                        new_stack.append(
-                            frames[i]
-                            + "_[[call_"
-                            + str(self.call_counts[this_context][frames[i]])
-                            + "]]"
+        for line in self.read_lines():
+            line = line.strip()
+            match = process_id_regex.search(line)
+            if match:
+                pid = match.group(2)
+                tid = match.group(3)
+                match2 = re.match("secondary-event;([^:]+):(.*):\s*(.*)", line)
+                if match2:
+                    event = match2.group(2)
+                    samples = match2.group(3)
+                    samples = samples.split(" ")
+                    if pid not in self.secondary_event_samples:
+                        self.secondary_event_samples[pid] = {}
+                    if tid not in self.secondary_event_samples[pid]:
+                        self.secondary_event_samples[pid][tid] = {}
+                    if event not in self.secondary_event_samples[pid][tid]:
+                        self.secondary_event_samples[pid][tid][event] = []
+                    for sample in samples:
+                        self.secondary_event_samples[pid][tid][event].append(
+                            float(sample)
                         )
-                    stack = ";".join(new_stack)
-                    entry_time = samples[0]
-                    exit_time = samples[-1]
-                    if pid not in self.trace_data:
-                        self.trace_data[pid] = {}
-                        self.totals[pid] = {}
-                        previous_exit_times[pid] = {}
-                    if tid not in self.trace_data[pid]:
-                        self.trace_data[pid][tid] = []
-                        self.trace_data[pid][tid].append([])
-                        self.totals[pid][tid] = 0.0
-                        previous_exit_times[pid][tid] = last_sample
-                    time_index = int(entry_time)
-                    last_time = len(self.trace_data[pid][tid]) - 1
-                    if time_index > last_time:
-                        for t in range(last_time + 1, time_index + 1):
-                            self.trace_data[pid][tid].append([])
-                    trace = {"stack": stack, "samples": samples}
-                    self.trace_data[pid][tid][time_index].append(trace)
-                    self.totals[pid][tid] += self.time_scale * (
-                        exit_time - previous_exit_times[pid][tid]
+                    continue
+                this_id = pid + "-" + tid
+                stack = line
+                data = stack.split(" ")
+                samples = [float(x) for x in data[1:] if is_float(x)]
+                n = len(data)
+                m = len(samples)
+                stack = " ".join(data[0 : n - m])
+                frames = stack.split(";")
+                if len(frames) == 1:
+                    frames.append("-")  # No context information
+                node = sys.intern(frames[-1])  # Leaf node, without the call tag
+                this_context = this_id + frames[1]
+                if this_context not in self.previous_context:
+                    self.previous_context[this_context] = ""
+                    self.call_counts[this_context] = {}
+                previous_stack = self.previous_context[this_context]
+                self.unwind_stacks(this_context, frames, previous_stack)
+                self.previous_context[this_context] = stack
+                new_stack = frames[0:2]
+                for i in range(2, len(frames)):
+                    new_stack.append(
+                        frames[i]
+                        + "_[[call_"
+                        + str(self.call_counts[this_context][frames[i]])
+                        + "]]"
                     )
-                    last_sample = exit_time
-                    previous_exit_times[pid][tid] = exit_time
-                    self.time_norm = max(self.time_norm, exit_time)
+                stack = ";".join(new_stack)
+                entry_time = samples[0]
+                exit_time = samples[-1]
+                if pid not in self.trace_data:
+                    self.trace_data[pid] = {}
+                    self.totals[pid] = {}
+                    self.node_totals[pid] = {}
+                    previous_exit_times[pid] = {}
+                if tid not in self.trace_data[pid]:
+                    self.trace_data[pid][tid] = []
+                    self.trace_data[pid][tid].append([])
+                    self.totals[pid][tid] = 0.0
+                    self.node_totals[pid][tid] = {}
+                    previous_exit_times[pid][tid] = entry_time
+                time_index = int(entry_time)
+                last_time = len(self.trace_data[pid][tid]) - 1
+                if time_index > last_time:
+                    for t in range(last_time + 1, time_index + 1):
+                        self.trace_data[pid][tid].append([])
+                trace = {"stack": stack, "node": node, "samples": samples}
+                self.trace_data[pid][tid][time_index].append(trace)
+                self.totals[pid][tid] += self.time_scale * (
+                    exit_time - previous_exit_times[pid][tid]
+                )
+                node_totals = self.node_totals[pid][tid]
+                if node not in node_totals:
+                    node_totals[node] = 0.0
+                node_totals[node] += self.time_scale * (
+                    exit_time - max(previous_exit_times[pid][tid], entry_time)
+                )
+                if node not in self.augmented_nodes:
+                    self.augmented_nodes[node] = set()
+                self.augmented_nodes[node].add(new_stack[-1])
+                previous_exit_times[pid][tid] = exit_time
+                self.time_norm = max(self.time_norm, exit_time)
+        for pid in self.trace_data:
+            self.timelines[pid] = {}
+            for tid in self.trace_data[pid]:
+                self.timelines[pid][tid] = ThreadTimeline(
+                    self.trace_data[pid][tid], base_intervals=self.timeline_intervals
+                )
 
     def unwind_stacks(self, this_context, frames, previous_stack):
         test_stack = ""
@@ -229,6 +358,7 @@ class TraceData:
         self.job = data_id
         self.time_interval = 0.0
         self.timeline_intervals = 200
+        self.min_shard_size = 1000000
         self.time_scale = 1000000.0
         self.cpu = ""
         self.n_proc = n_proc
@@ -250,6 +380,11 @@ class TraceData:
         self.secondary_event_samples = {}
         self.sample_rates = {}
         self.trace_data = {}
+        self.timeline_pyramids = {}
+        self.node_totals = {}
+        self.augmented_nodes = {}
+        self.call_statistics = OrderedDict()
+        self.max_cached_call_statistics = 16
         self.ordered_nodes = {}
 
         self.debug = debug
@@ -307,8 +442,22 @@ class TraceData:
                                 counter,
                                 self.time_scale,
                                 self.sample_weight,
+                                timeline_intervals=self.timeline_intervals,
                             )
 
+    def create_read_tasks(self):
+        """Split large trace files by thread, so that the pool is kept busy when there
+        are fewer trace files than processors"""
+        read_tasks = []
+        n_shards = max(1, self.n_proc // max(1, len(self.tasks)))
+        for task_id in self.tasks:
+            task = self.tasks[task_id]
+            if n_shards > 1 and os.path.getsize(task.filename) > self.min_shard_size:
+                read_tasks += task.split(n_shards)
+            else:
+                read_tasks.append(task)
+        return read_tasks
+
     def read_data(
         self,
         start=-0.0000001,
@@ -322,33 +471,45 @@ class TraceData:
         if initialise:
             self.time_norm = 0.0
             self.create_tasks()
-            run_parallel = self.n_proc > 1 and len(self.tasks) > 1
+            read_tasks = self.create_read_tasks()
+            run_parallel = self.n_proc > 1 and len(read_tasks) > 1
             if run_parallel:
-                pool = ProcessPoolExecutor(min(self.n_proc, len(self.tasks)))
-                arg_list = []
-                for task in self.tasks:
-                    new_task = self.tasks[task]
-                    arg_list.append((new_task))
-                finished_tasks = list(pool.map(worker, arg_list))
+                with ProcessPoolExecutor(min(self.n_proc, len(read_tasks))) as pool:
+                    finished_tasks = list(pool.map(worker, read_tasks))
             else:
-                finished_tasks = []
-                for task in self.tasks:
-                    new_task = self.tasks[task]
-                    finished_tasks.append(worker(new_task))
-            task_num = 0
+                finished_tasks = [worker(read_task) for read_task in read_tasks]
             for task_id in self.tasks:
-                finished_task = finished_tasks[task_num]
-                self.totals[task_id] = finished_task["totals"]
+                self.totals[task_id] = {}
+                self.trace_data[task_id] = {}
+                self.secondary_event_samples[task_id] = {}
+                self.timeline_pyramids[task_id] = {}
+                self.node_totals[task_id] = {}
+            for read_task, finished_task in zip(read_tasks, finished_tasks):
+                # Shards of a task hold disjoint threads, so can simply be merged
+                task_id = read_task.task_id
                 self.start_times[task_id] = finished_task["start_time"]
-                self.trace_data[task_id] = finished_task["trace_data"]
-                self.secondary_event_samples[task_id] = finished_task[
-                    "secondary_event_samples"
-                ]
+                for results, key in [
+                    (self.totals, "totals"),
+                    (self.trace_data, "trace_data"),
+                    (self.secondary_event_samples, "secondary_event_samples"),
+                    (self.timeline_pyramids, "timelines"),
+                    (self.node_totals, "node_totals"),
+                ]:
+                    for pid in finished_task[key]:
+                        if pid not in results[task_id]:
+                            results[task_id][pid] = {}
+                        results[task_id][pid].update(finished_task[key][pid])
+                for node in finished_task["augmented_nodes"]:
+                    if node not in self.augmented_nodes:
+                        self.augmented_nodes[node] = set()
+                    self.augmented_nodes[node].update(
+                        finished_task["augmented_nodes"][node]
+                    )
                 self.time_norm = max(self.time_norm, finished_task["time_norm"])
-                task_num += 1
             self.initial_count = self.totals
             self.set_process_ids()
             self.calculate_thread_percentages()
+            self.build_timeline_pyramids()
         self.selected_ids = selected_ids
         if initialise:
             self.compute_hotspots()
@@ -432,6 +593,24 @@ class TraceData:
                     100.0 * float(process_id.count1) / float(max_count[2])
                 )
 
+    def build_timeline_pyramids(self):
+        timelines = []
+        for task_id in self.timeline_pyramids:
+            for pid in self.timeline_pyramids[task_id]:
+                for tid in self.timeline_pyramids[task_id][pid]:
+                    timelines.append((task_id, pid, tid))
+        arg_list = [
+            (self.timeline_pyramids[task_id][pid][tid], self.time_norm)
+            for task_id, pid, tid in timelines
+        ]
+        if self.n_proc > 1 and len(arg_list) > 1:
+            with ProcessPoolExecutor(min(self.n_proc, len(arg_list))) as pool:
+                finished_timelines = list(pool.map(timeline_worker, arg_list))
+        else:
+            finished_timelines = [timeline_worker(args) for args in arg_list]
+        for (task_id, pid, tid), timeline in zip(timelines, finished_timelines):
+            self.timeline_pyramids[task_id][pid][tid] = timeline
+
     def generate_timelines(self, t1=-0.0000001, t2=sys.maxsize):
         if t1 >= 0.0 and t2 < sys.maxsize:
             dt = (t2 - t1) / float(self.timeline_intervals)
@@ -444,34 +623,27 @@ class TraceData:
             self.timeline_end = self.time_norm
             self.timeline_dt = dt
         self.timelines = {}
-        for task_id in self.trace_data:
-            self.timelines[task_id] = {}
-            for pid in self.trace_data[task_id]:
-                if pid not in self.timelines[task_id]:
-                    self.timelines[task_id][pid] = {}
-                for tid in self.trace_data[task_id][pid]:
-                    if tid not in self.timelines[task_id][pid]:
-                        self.timelines[task_id][pid][tid] = [
-                            "no_samples"
-                        ] * self.timeline_intervals
-                    max_node = [-1.0] * self.timeline_intervals
-                    for time_slice in self.trace_data[task_id][pid][tid]:
-                        for time_slice_interval in time_slice:
-                            trace = time_slice_interval["stack"]
-                            start = time_slice_interval["samples"][0]
-                            end = time_slice_interval["samples"][-1]
-                            if end > t1 and start <= t2:
-                                i_begin = int(max(0, start - t1) / dt)
-                                i_end = int(min(t2 - t1, end - t1) / dt)
-                                for i in range(i_begin, i_end + 1):
-                                    x1 = max(t1 + i * dt, start)
-                                    x2 = min(t1 + (i + 1) * dt, end)
-                                    index = min(i, self.timeline_intervals - 1)
-                                    if x2 - x1 > max_node[index]:
-                                        max_node[index] = x2 - x1
-                                        node = trace.rpartition(";")[2]
-                                        self.timelines[task_id][pid][tid][index] = node
-        self.generate_sample_rates(t1, t2)
+        self.sample_rates = {}
+        for process_id in self.get_selected_process_ids():
+            task_id = process_id.task_id
+            pid = process_id.pid
+            tid = process_id.tid
+            if task_id not in self.timelines:
+                self.timelines[task_id] = {}
+                self.sample_rates[task_id] = {}
+            if pid not in self.timelines[task_id]:
+                self.timelines[task_id][pid] = {}
+                self.sample_rates[task_id][pid] = {}
+            pyramid = self.timeline_pyramids[task_id][pid][tid]
+            if dt > 0.0:
+                nodes, rates = pyramid.get_buckets(
+                    self.timeline_start, self.timeline_end, self.timeline_intervals
+                )
+            else:
+                nodes = ["no_samples"] * self.timeline_intervals
+                rates = [0.0] * self.timeline_intervals
+            self.timelines[task_id][pid][tid] = nodes
+            self.sample_rates[task_id][pid][tid] = rates
         self.generate_secondary_events(t1, t2)
 
     def get_next_call(self, t1, t2, pid, tid, function_name, n, forwards=True):
@@ -521,34 +693,6 @@ class TraceData:
             f_out = function_name
         return f_out, t1_out, t2_out
 
-    def generate_sample_rates(self, t1=-0.0000001, t2=sys.maxsize):
-        dt = self.timeline_dt
-        self.sample_rates = {}
-        for task_id in self.trace_data:
-            self.sample_rates[task_id] = {}
-            for pid in self.trace_data[task_id]:
-                if pid not in self.sample_rates[task_id]:
-                    self.sample_rates[task_id][pid] = {}
-                for tid in self.trace_data[task_id][pid]:
-                    if tid not in self.sample_rates[task_id][pid]:
-                        self.sample_rates[task_id][pid][tid] = [
-                            0.0
-                        ] * self.timeline_intervals
-                    for time_slice in self.trace_data[task_id][pid][tid]:
-                        for data in time_slice:
-                            for time in data["samples"]:
-                                if t1 <= time <= t2:
-                                    index = min(
-                                        int((time - t1) / dt),
-                                        self.timeline_intervals - 1,
-                                    )
-                                    self.sample_rates[task_id][pid][tid][index] += 1.0
-        for task_id in self.sample_rates:
-            for pid in self.sample_rates[task_id]:
-                for tid in self.sample_rates[task_id][pid]:
-                    for sample_rate in self.sample_rates[task_id][pid][tid]:
-                        sample_rate /= dt
-
     def generate_secondary_events(self, t1=-0.0000001, t2=sys.maxsize):
         if t1 <= 0.0 and t2 == sys.maxsize:
             self.secondary_events = self.secondary_event_samples
@@ -574,29 +718,38 @@ class TraceData:
                                     ].append(time)
 
     def compute_hotspots(self):
+        """Rank nodes by the sum of the per-thread totals accumulated whilst reading the trace"""
         nodes = OrderedDict()
-        last_sample = 0
         for task_id in self.tasks:
-            sample_weight = self.tasks[task_id].sample_weight
-            for pid in self.trace_data[task_id]:
-                for tid in self.trace_data[task_id][pid]:
-                    for time_slice in self.trace_data[task_id][pid][tid]:
-                        for time_slice_interval in time_slice:
-                            trace = time_slice_interval["stack"]
-                            start = time_slice_interval["samples"][0]
-                            end = time_slice_interval["samples"][-1]
-                            augmented_node = trace.rpartition(";")[2]
-                            node = re.sub("_\[\[call_[0-9]+\]\]", "", augmented_node)
-                            if node not in nodes:
-                                nodes[node] = 0.0
-                            nodes[node] += self.time_scale * (
-                                end - max(last_sample, start)
-                            )
-                            last_sample = end
+            for pid in natural_sort(self.node_totals[task_id].keys()):
+                for tid in natural_sort(self.node_totals[task_id][pid].keys()):
+                    node_totals = self.node_totals[task_id][pid][tid]
+                    for node in node_totals:
+                        if node not in nodes:
+                            nodes[node] = 0.0
+                        nodes[node] += node_totals[node]
         self.ordered_nodes = sorted(
             nodes.items(), key=operator.itemgetter(1), reverse=True
         )
 
+    def get_call_statistics(self, t1=-0.0000001, t2=sys.maxsize):
+        """Call statistics for the selected threads, cached for each time window"""
+        ids = self.get_selected_process_ids()
+        key = (t1, t2, tuple(process_id.label for process_id in ids))
+        if key in self.call_statistics:
+            self.call_statistics.move_to_end(key)
+        else:
+            threads = [
+                self.trace_data[process_id.task_id][process_id.pid][process_id.tid]
+                for process_id in ids
+            ]
+            self.call_statistics[key] = compute_call_statistics(
+                threads, t1, t2, self.time_scale
+            )
+            if len(self.call_statistics) > self.max_cached_call_statistics:
+                self.call_statistics.popitem(last=False)
+        return self.call_statistics[key]
+
     def get_flamegraph_process_ids(self):
         return self.flamegraph_process_ids
 
@@ -690,6 +843,13 @@ class TraceData:
     def create_augmented_hotspots(self, t1, t2):
         hotspots = self.get_hotspots()
         augmented_hotspots = {}
+        if t1 <= 0.0 and t2 >= self.time_norm:
+            # Use the call tagged nodes collected whilst reading the trace
+            for node in hotspots:
+                for augmented_node in self.augmented_nodes.get(node, []):
+                    augmented_hotspots[augmented_node] = hotspots[node]
+            self.set_hotspots(augmented_hotspots, augmented=True)
+            return
         ids = self.get_all_process_ids()
         for task_id in self.tasks:
             pids = [
@@ -707,16 +867,16 @@ class TraceData:
                             start = time_slice_interval["samples"][0]
                             end = time_slice_interval["samples"][-1]
                             if end > t1 and start <= t2:
-                                augmented_node = trace.rpartition(";")[2]
-                                node = re.sub(
-                                    "_\[\[call_[0-9]+\]\]", "", augmented_node
-                                )
+                                node = time_slice_interval["node"]
                                 if node in hotspots:
+                                    augmented_node = trace.rpartition(";")[2]
                                     augmented_hotspots[augmented_node] = hotspots[node]
         self.set_hotspots(augmented_hotspots, augmented=True)
 
 
-def write_flamegraph_stacks(stack_data, flamegraph_type, t1=-0.0000001, t2=sys.maxsize):
+def write_flamegraph_stacks(
+    stack_data, flamegraph_type, t1=-0.0000001, t2=sys.maxsize, imagewidth=1200, xpad=10
+):
     output_file = os.path.join(stack_data.path, stack_data.collapsed_stacks_filename)
     time_scale = stack_data.time_scale
     ids = stack_data.get_flamegraph_process_ids()
@@ -788,9 +948,7 @@ def write_flamegraph_stacks(stack_data, flamegraph_type, t1=-0.0000001, t2=sys.m
                         f.write(out.encode())
         f.close()
     elif flamegraph_type == "trace":
-        max_lines = 2000
-        line_num = 0
-        f = open(output_file, "wb")
+        time_ordered_stacks = []
         for task_id in stack_data.tasks:
             sample_weight = stack_data.tasks[task_id].sample_weight
             pids = [
@@ -817,20 +975,11 @@ def write_flamegraph_stacks(stack_data, flamegraph_type, t1=-0.0000001, t2=sys.m
                                     elapsed_delta = time_scale * (
                                         x1 - max(last_sample, t1)
                                     )
-                                    n = int(elapsed_delta)
-                                    if n > 0:
-                                        out = "no_samples " + str(n) + "\n"
-                                        f.write(out.encode())
-                                        line_num += 1
+                                    time_ordered_stacks.append(
+                                        ("no_samples", elapsed_delta)
+                                    )
                                 delta = time_scale * (x2 - max(last_sample, t1))
-                                n = int(delta)
-                                if n > 0:
-                                    out = trace + " " + str(n) + "\n"
-                                    f.write(out.encode())
-                                    line_num += 1
-                                    if line_num > max_lines:
-                                        f.close()
-                                        return
+                                time_ordered_stacks.append((trace, delta))
                                 last_sample = x2
                                 if n_samples > 0:
                                     av_delta = last_sample / float(n_samples)
@@ -839,24 +988,75 @@ def write_flamegraph_stacks(stack_data, flamegraph_type, t1=-0.0000001, t2=sys.m
                 if t2 < sys.maxsize:
                     if t2 - last_sample > 1.25 * av_delta:  # Ignore random noise
                         elapsed_delta = time_scale * (t2 - last_sample)
-                        n = int(elapsed_delta)
-                        if n > 0:
-                            out = "no_samples " + str(n) + "\n"
-                            f.write(out.encode())
-                            line_num += 1
+                        time_ordered_stacks.append(("no_samples", elapsed_delta))
+        f = open(output_file, "wb")
+        for trace, delta in coalesce_time_ordered_stacks(
+            time_ordered_stacks, imagewidth - 2 * xpad
+        ):
+            n = int(delta)
+            if n > 0:
+                out = trace + " " + str(n) + "\n"
+                f.write(out.encode())
         f.close()
 
 
+def coalesce_time_ordered_stacks(time_ordered_stacks, pixels):
+    """Merge adjacent identical stacks, and replace each run of stacks narrower than a
+    pixel by the widest stack in the run, so that the number of stacks written for the
+    time ordered flamegraph is bounded by the image width rather than the trace length"""
+    total = sum(delta for trace, delta in time_ordered_stacks if delta > 0.0)
+    pixel_width = total / float(pixels) if pixels > 0 else 0.0
+    coalesced = []
+
+    def append_stack(trace, delta):
+        if len(coalesced) > 0 and coalesced[-1][0] == trace:
+            coalesced[-1] = (trace, coalesced[-1][1] + delta)
+        else:
+            coalesced.append((trace, delta))
+
+    run_stack = None
+    run_max = 0.0
+    run_total = 0.0
+    for trace, delta in time_ordered_stacks:
+        if delta <= 0.0:
+            continue
+        if delta >= pixel_width:
+            if run_total > 0.0:
+                append_stack(run_stack, run_total)
+                run_stack, run_max, run_total = None, 0.0, 0.0
+            append_stack(trace, delta)
+            continue
+        if delta > run_max:
+            run_stack = trace
+            run_max = delta
+        run_total += delta
+        if run_total >= pixel_width:
+            append_stack(run_stack, run_total)
+            run_stack, run_max, run_total = None, 0.0, 0.0
+    if run_total > 0.0:
+        append_stack(run_stack, run_total)
+    return coalesced
+
+
 def get_timeline_data(stack_data):
+    """Return the timelines of the selected processes, as run length encoded
+    (node, start, end, count) tuples, sample rates as (time, rate) tuples and secondary
+    events as (event, time) tuples, each indexed by pid and tid"""
     dt = stack_data.timeline_dt
     t1 = stack_data.timeline_start
-    data = []
+    data = TimelineData(OrderedDict(), OrderedDict(), OrderedDict())
     ids = stack_data.get_selected_process_ids()
     for task_id in stack_data.tasks:
         pids = [
             (proc_id.pid, proc_id.tid) for proc_id in ids if proc_id.task_id == task_id
         ]
         for pid, tid in pids:
+            for values in data:
+                if pid not in values:
+                    values[pid] = OrderedDict()
+                if tid not in values[pid]:
+                    values[pid][tid] = []
+            timeline = data.timelines[pid][tid]
             prev_stack = stack_data.timelines[task_id][pid][tid][0]
             count = 0
             start = t1
@@ -865,25 +1065,15 @@ def get_timeline_data(stack_data):
                     count += 1
                 else:
                     end = start + count * dt
-                    out = "{}/{};{} {} {} {}\n".format(
-                        str(pid), str(tid), prev_stack, str(start), str(end), str(count)
-                    )
-                    data.append(out)
+                    timeline.append((prev_stack, start, end, count))
                     count = 1
                     prev_stack = stack
                     start = end
             end = start + count * dt
-            out = "{}/{};{} {} {} {}\n".format(
-                str(pid), str(tid), prev_stack, str(start), str(end), str(count)
-            )
-            data.append(out)
+            timeline.append((prev_stack, start, end, count))
             for i, rate in enumerate(stack_data.sample_rates[task_id][pid][tid]):
                 time = t1 + (i + 0.5) * dt
-                rate = stack_data.sample_rates[task_id][pid][tid][i]
-                out = "sample-rate;{}/{} {} {}\n".format(
-                    str(pid), str(tid), str(time), str(rate)
-                )
-                data.append(out)
+                data.sample_rates[pid][tid].append((time, rate))
             if task_id in stack_data.secondary_events:
                 if pid in stack_data.secondary_events[task_id]:
                     if tid in stack_data.secondary_events[task_id][pid]:
@@ -891,8 +1081,5 @@ def get_timeline_data(stack_data):
                             for time in stack_data.secondary_events[task_id][pid][tid][
                                 event
                             ]:
-                                out = "secondary-event;{}/{} {} {}\n".format(
-                                    str(pid), str(tid), event, str(time)
-                                )
-                                data.append(out)
+                                data.secondary_events[pid][tid].append((event, time))
     return data
@@ -0,0 +1,73 @@
+import re
+import sys
+import os
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from src.DataAnalysis import GeneralAnalysis
+
+
+class ProcessID:
+    def __init__(self, raw_event):
+        self.job = "job"
+        self.pid = "1"
+        self.tid = "1"
+        self.raw_event = raw_event
+        self.event_type = "original"
+        self.label = "job_proc1_" + raw_event + "-pid:1-tid:1"
+
+
+class StackData:
+    """Stack data of one thread, with counts for each event, filtered by text"""
+
+    def __init__(self, counts):
+        self.counts = counts
+        self.process = "job_proc1"
+        self.start = 0.0
+        self.stop = 1.0
+        self.text_filter = ""
+        self.stack_map = None
+        self.ids = [ProcessID(event) for event in counts]
+
+    def get_selected_process_ids(self):
+        return self.ids
+
+    def get_original_event_stack_data(self, process_id):
+        return {
+            stack: count
+            for stack, count in self.counts[process_id.raw_event].items()
+            if re.search(self.text_filter, stack)
+        }
+
+    def set_stack_map(self, stack_map):
+        self.stack_map = stack_map
+
+
+def make_analysis(stack_data):
+    analysis = GeneralAnalysis()
+    analysis.set_events({"All": ["cycles", "instructions"], "Ratios": []})
+    analysis.add_data(stack_data, stack_data.process)
+    analysis.make_data(stack_data.process)
+    analysis.group_data(3, "cycles", "instructions", None, None, None, None, False)
+    return analysis
+
+
+def test_cluster_labels_kept_after_text_filter():
+    """Test the stacks keep the cluster label of their node when the stack data is
+    filtered after the clusters are calculated"""
+    stacks = ["job-1/1;a", "job-1/1;main;b", "job-1/1;main;c"]
+    stack_data = StackData(
+        {
+            "cycles": dict(zip(stacks, [100.0, 1.0, 50.0])),
+            "instructions": dict(zip(stacks, [1.0, 100.0, 50.0])),
+        }
+    )
+    analysis = make_analysis(stack_data)
+    analysis.make_stack_map([0, 1, 2], True)
+    labels = dict(stack_data.stack_map)
+    assert len(set(labels.values())) == 3
+    stack_data.text_filter = "main"
+    analysis.make_stack_map([0, 1, 2], True)
+    assert stack_data.stack_map == {
+        stack: labels[stack] for stack in stacks if "main" in stack
+    }